@@ -1,57 +1,80 @@
+from __future__ import annotations
+
 import sys
 import os
-import ast  # for safely parsing list strings
 import json
-import pandas as pd
-from uncertainties import ufloat
 
 sys.path.append(os.path.abspath('../..'))
+from utils import lazy_import
 from utils import root_tools as rt
+from utils import fit_tools as ft
+from utils import export_tools as et
+from utils import results_tools as rs
 
-df = pd.read_csv("Pulse_NMR_61/create_databases/all_T.csv") 
+# pandas is only imported once the results are read
+pd = lazy_import('pandas')
 
-# Parse the list strings into actual Python lists
-df['T2'] = df['T2'].apply(ast.literal_eval)
-df['T2_Eff'] = df['T2_Eff'].apply(ast.literal_eval)
+csv_path = "Pulse_NMR_61/create_databases/all_T.csv"
+output_path = "Pulse_NMR_61/create_databases/magnetic_field_std.json"
+plot_directory = 'Pulse_NMR_61/Plots/T2_eff/T2_eff_against_T2/'
 
-# Extract values and errors
-t2_vals = [entry[0] for entry in df['T2']]
-t2_errs = [entry[1] for entry in df['T2']]
 
-t2_eff_vals = [entry[0] for entry in df['T2_Eff']]
-t2_eff_errs = [entry[1] for entry in df['T2_Eff']]
+def analyse_magnetic_field(df: pd.DataFrame, backend: str = 'root') -> dict:
+    """Fits T2* against T2; with a backend other than 'root' the fit runs in SciPy without ROOT and no canvas is drawn."""
+    # Values and errors are typed columns of the results table (see rs.results_table)
+    t2_vals, t2_errs = rs.value_error(df, 'T2')
+    t2_eff_vals, t2_eff_errs = rs.value_error(df, 'T2_Eff')
 
-experiment = t2_vals, t2_eff_vals, t2_errs, t2_eff_errs
+    experiment = t2_vals, t2_eff_vals, t2_errs, t2_eff_errs
 
+    file_name = plot_directory + 'Magnetic_field_variance'
+    titles = {'title': 'T_{2}^{*} as a function of T_{2}', 'x_title': 'T_{2} [ms]', 'y_title': 'T_{2}^{*} [ms]'}
+    x_range = (0, 1.1 * max(t2_vals))
+    fit_str = 'x / ([0] * x + 1)'
+    par_limits = {0: (0, 20)}
 
-plot_directory = 'Pulse_NMR_61/Plots/T2_eff/T2_eff_against_T2/'
-file_name = plot_directory + 'Magnetic_field_variance'
-titles = {'title': 'T_{2}^{*} as a function of T_{2}', 'x_title': 'T_{2} [ms]', 'y_title': 'T_{2}^{*} [ms]'}
-x_range = (0, 1.1 * max(t2_vals))
-fit_str = 'x / ([0] * x + 1)'
-par_limits = {0: (0, 20)}
-
-canvas = rt.draw_canvas(experiment, titles, fit_str, x_range, par_limits, file_name=file_name, file_type='.eps')
-Param_list = canvas['fitted_params']['par0']
-chi2_red = canvas['statistics']['chi2_red']
-p_val = canvas['statistics']['p_value']
-
-gamma = ufloat(4.255, 0.034)
-p0 = ufloat(*Param_list)
-Delta_B = p0 / gamma
-
-
-# Convert to dict format
-data = {
-    "gamma": [gamma.n, gamma.s],
-    "Delta_B": [Delta_B.n, Delta_B.s],
-    "p0": [p0.n, p0.s],
-    "statistics": {
-            "chi2_red": chi2_red,
-            "p_value": p_val
-            }
-}
-
-# Save to JSON
-with open("Pulse_NMR_61/create_databases/magnetic_field_std.json", "w") as f:
-    json.dump(data, f, indent=4)
+    if backend == 'root':
+        canvas = rt.fit_graph(experiment, fit_str, x_range, par_limits)
+    else:
+        canvas = ft.fit_formula(experiment, fit_str, par_limits)
+    Param_list = canvas['fitted_params']['par0']
+    chi2_red = canvas['statistics']['chi2_red']
+    p_val = canvas['statistics']['p_value']
+
+    if backend == 'root':
+        # The canvas is only redrawn if the points or the fit changed
+        with et.ExportQueue(plot_directory + et.MANIFEST_FILE, processes=True) as exports:
+            params = {0: canvas['fit'].GetParameter(0)}
+            exports.submit(file_name + '.eps', rt.render_canvas, experiment, titles, fit_str, x_range, params, file_name, '.eps')
+
+    from uncertainties import ufloat  # Only paid for when the field is analysed
+
+    gamma = ufloat(4.255, 0.034)
+    p0 = ufloat(*Param_list)
+    Delta_B = p0 / gamma
+
+    # Convert to dict format
+    return {
+        "gamma": [gamma.n, gamma.s],
+        "Delta_B": [Delta_B.n, Delta_B.s],
+        "p0": [p0.n, p0.s],
+        "statistics": {
+                "chi2_red": chi2_red,
+                "p_value": p_val
+                }
+    }
+
+
+def main(df: pd.DataFrame | None = None, backend: str = 'root') -> dict:
+    if df is None:
+        df = rs.read_results(csv_path)
+
+    data = analyse_magnetic_field(df, backend=backend)
+    # Save to JSON
+    with open(output_path, "w") as f:
+        json.dump(data, f, indent=4)
+    return data
+
+
+if __name__ == '__main__':
+    main()
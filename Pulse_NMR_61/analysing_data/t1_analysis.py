@@ -1,39 +1,134 @@
 import sys
 import os
 import json
-from tqdm import tqdm
+from functools import partial
 
 sys.path.append(os.path.abspath('../..'))
 from utils import root_tools as rt
-
+from utils import fit_tools as ft
+from utils import pipeline_tools as pl
+from utils import export_tools as et
 
 
 T1_path = 'Pulse_NMR_61/create_databases/T1_Data.json'
-with open(T1_path, "r") as f:
-    T1_Data = json.load(f)
+plot_directory = 'Pulse_NMR_61/Plots/T1/'
+fit_str = 'abs([0] * (1 - 2 * exp(- x / [1])))'
 
 
-plot_directory = 'Pulse_NMR_61/Plots/T1/'
-for material, data in tqdm(T1_Data.items()):
-    # if material in ('8 para', '4 para', '2 para', '1 para', '0.5 para', '0.125 para', 'water', 'glycerine'): continue
-    print(material)
-    # if material != '8 para': continue
+def figure_inputs(material: str, data: dict) -> tuple:
+    """The data points, titles, x range and file name of a material's canvas."""
     results = data['tau'], data['volt'], data['delta_tau'], data['delta_v']
     titles = {'title': f'Peak voltage as a function of time delay in {material}', 'x_title': '#tau [ms]', 'y_title': 'V [Volt]'}
-    fit_str = 'abs([0] * (1 - 2 * exp(- x / [1])))'
-    
     x_range = 0, 1.1 * max(data['tau'])
-    print(data['param_lim'])
     file_name = plot_directory + f'T1_{material}'
+    return results, titles, x_range, file_name
 
-    t1_c = rt.draw_canvas(results, titles, fit_str, x_range, data['param_lim'], file_name=file_name, file_type='.png')
+
+def fit_start(data: dict) -> tuple[dict, dict]:
+    """Limits and start values of a material's fit, seeded from its points (see `ft.seed_fit`); the builder's limits are the fallback."""
+    return ft.seed_fit((data['tau'], data['volt'], data['delta_tau'], data['delta_v']), fit_str, data['param_lim'])
+
+
+def fit_material(material: str, data: dict, backend: str = 'root', refit: bool = False) -> dict:
+    """
+    Fits one material; returns only picklable results so it can run in a worker process.
+    With backend='numpy' the fit runs in SciPy without ROOT. The canvas is drawn later by `export_figure`.
+    Unchanged fits are taken from the fit cache unless `refit` is set.
+    """
+    cache = ft.FitCache(refresh=refit)
+    print(material)
+    results, titles, x_range, file_name = figure_inputs(material, data)
+    par_limits, initial = fit_start(data)
+    print(par_limits)
+
+    if backend == 'numpy':
+        t1_c = ft.fit_formula(results, fit_str, par_limits, initial=initial, cache=cache)
+        return {
+            'params': {f'par{i}': (val, err) for i, (val, err) in enumerate(zip(t1_c['popt'], t1_c['perr']))},
+            'statistics': t1_c['statistics']
+        }
+
+    t1_c = rt.fit_graph(results, fit_str, x_range, par_limits, cache=cache, initial=initial)
 
     fit_func = t1_c['fit']
-    T1_Data[material]['params'] = {
-        f'par{i}': (fit_func.GetParameter(i), fit_func.GetParError(i))
-        for i in range(fit_func.GetNpar())
+    return {
+        'params': {
+            f'par{i}': (fit_func.GetParameter(i), fit_func.GetParError(i))
+            for i in range(fit_func.GetNpar())
+        },
+        'statistics': t1_c['statistics']
+    }
+
+
+def export_figure(exports: et.ExportQueue, material: str, data: dict) -> None:
+    """Queues the canvas of a fitted material; it is only redrawn if its data or parameters changed."""
+    results, titles, x_range, file_name = figure_inputs(material, data)
+    params = {i: val for i, (val, _) in enumerate(data['params'].values())}
+    exports.submit(file_name + '.png', rt.render_canvas, results, titles, fit_str, x_range, params, file_name, '.png')
+
+
+def fit_all_materials(T1_Data: dict[str, dict]) -> dict[str, dict]:
+    """Fits every material as one stacked SciPy problem; no plots are drawn."""
+    datasets = {material: (data['tau'], data['volt'], data['delta_tau'], data['delta_v']) for material, data in T1_Data.items()}
+    starts = {material: fit_start(data) for material, data in T1_Data.items()}
+    batch = ft.fit_batch(datasets, fit_str, {material: limits for material, (limits, _) in starts.items()},
+                         initial={material: initial for material, (_, initial) in starts.items()})
+    return {
+        material: {
+            'params': {f'par{i}': (val, err) for i, (val, err) in enumerate(zip(result['popt'], result['perr']))},
+            'statistics': result['statistics']
+        }
+        for material, result in batch['samples'].items()
     }
-    T1_Data[material]['statistics'] = t1_c['statistics']
-    
-with open(T1_path, 'w') as f:
-    json.dump(T1_Data, f, indent=4)
+
+
+def bootstrap_materials(T1_Data: dict[str, dict], n_replicates: int, workers: int | None = 1,
+                        refit: bool = False) -> dict[str, dict]:
+    """Bootstrap errors of every material (see `ft.bootstrap`), the replicates spread over `workers` processes."""
+    starts = {material: fit_start(data) for material, data in T1_Data.items()}
+    return ft.bootstrap(
+        {material: figure_inputs(material, data)[0] for material, data in T1_Data.items()}, fit_str,
+        {material: limits for material, (limits, _) in starts.items()},
+        n_replicates=n_replicates, workers=workers, cache=ft.FitCache(refresh=refit),
+        initial={material: initial for material, (_, initial) in starts.items()})
+
+
+def fit_t1(T1_Data: dict[str, dict], workers: int | None = 1, backend: str = 'root',
+           refit: bool = False, bootstrap: int = 0) -> dict[str, dict]:
+    fit_func = partial(fit_material, backend=backend, refit=refit)
+    if backend == 'batch':
+        all_results = fit_all_materials(T1_Data)
+    elif backend == 'numpy':
+        # Materials are independent fits; with workers != 1 they run in separate processes
+        all_results = pl.map_materials(fit_func, T1_Data, workers=workers)
+    else:
+        # Each canvas is rendered in the background as soon as its fit is done
+        with et.ExportQueue(plot_directory + et.MANIFEST_FILE, processes=True) as exports:
+            all_results = pl.map_materials(
+                fit_func, T1_Data, workers=workers,
+                on_result=lambda material, fit_results: export_figure(exports, material, {**T1_Data[material], **fit_results}))
+
+    if bootstrap:
+        # Stored next to the covariance errors in 'params'
+        for material, result in bootstrap_materials(T1_Data, bootstrap, workers=workers, refit=refit).items():
+            all_results[material]['bootstrap'] = result
+
+    for material, fit_results in all_results.items():
+        T1_Data[material].update(fit_results)
+    return T1_Data
+
+
+def main(T1_Data: dict[str, dict] | None = None, workers: int | None = 1, backend: str = 'root',
+         refit: bool = False, bootstrap: int = 0) -> dict[str, dict]:
+    if T1_Data is None:
+        with open(T1_path, "r") as f:
+            T1_Data = json.load(f)
+
+    T1_Data = fit_t1(T1_Data, workers=workers, backend=backend, refit=refit, bootstrap=bootstrap)
+    with open(T1_path, 'w') as f:
+        json.dump(T1_Data, f, indent=4)
+    return T1_Data
+
+
+if __name__ == '__main__':
+    main()
@@ -1,38 +1,131 @@
 import sys
 import os
-import json
-from tqdm import tqdm
+from functools import partial
 
 sys.path.append(os.path.abspath('../..'))
 from utils import root_tools as rt
+from utils import fit_tools as ft
+from utils import pipeline_tools as pl
+from utils import export_tools as et
+from utils import store_tools as st
 
 
-T2_path = 'Pulse_NMR_61/create_databases/T2_Data.json'
+T2_path = 'Pulse_NMR_61/create_databases/T2_Data/'
 plot_directory = 'Pulse_NMR_61/Plots/T2/'
+fit_str = '[0] * exp(- x / [1]) + [2]'
+# Limits of the parameters the pre-fit of an envelope cannot estimate (see ft.seed_fit)
+par_limits = {0: (10, 50), 1: (1, 800), 2: (1, 8)}
 
-with open(T2_path, "r") as f:
-    T2_Data = json.load(f)
 
-
-for material, data in tqdm(T2_Data.items()):
-    print(material)
+def figure_inputs(material: str, data: dict) -> tuple:
+    """The data points, titles, x range and file name of an envelope's canvas."""
     results = data['x_peak'], data['y_peak'], data['delta_t'], data['delta_v']
     titles = {'title': f'Envelope of voltage as a function of time in {material}', 'x_title': 't [ms]', 'y_title': 'V [Volt]'}
-    par_limits = {0: (10, 50), 1: (1, 800), 2: (1, 8)}
     x_range = 0, 1.1 * max(data['x_peak'])
-    fit_str = '[0] * exp(- x / [1]) + [2]'
     file_name = plot_directory + f'T2_{material}'
+    return results, titles, x_range, file_name
+
+
+def fit_start(data: dict) -> tuple[dict, dict]:
+    """Limits and start values of an envelope's fit, seeded from its peaks (see `ft.seed_fit`)."""
+    return ft.seed_fit((data['x_peak'], data['y_peak'], data['delta_t'], data['delta_v']), fit_str, par_limits)
+
+
+def fit_material(material: str, data: dict, backend: str = 'root', refit: bool = False) -> dict:
+    """
+    Fits one envelope; returns only picklable results so it can run in a worker process.
+    With backend='numpy' the fit runs in SciPy without ROOT. The canvas is drawn later by `export_figure`.
+    Unchanged fits are taken from the fit cache unless `refit` is set.
+    """
+    cache = ft.FitCache(refresh=refit)
+    print(material)
+    results, titles, x_range, file_name = figure_inputs(material, data)
+    limits, initial = fit_start(data)
+
+    if backend == 'numpy':
+        t2_c = ft.fit_formula(results, fit_str, limits, initial=initial, cache=cache)
+        popt = t2_c['popt']
+    else:
+        t2_c = rt.fit_graph(results, fit_str, x_range, par_limits=limits, cache=cache, initial=initial)
+        popt = [t2_c['fit'].GetParameter(i) for i in range(t2_c['fit'].GetNpar())]
+
+    # The unrounded values draw the fitted curve; the rounded ones in 'params' are for display
+    return {
+        'param_lim': limits,
+        'params': t2_c['fitted_params'],
+        'statistics': t2_c['statistics'],
+        'popt': popt
+    }
+
+
+def export_figure(exports: et.ExportQueue, material: str, data: dict) -> None:
+    """Queues the canvas of a fitted envelope; it is only redrawn if its data or parameters changed."""
+    results, titles, x_range, file_name = figure_inputs(material, data)
+    params = dict(enumerate(data['popt']))
+    exports.submit(file_name + '.png', rt.render_canvas, results, titles, fit_str, x_range, params, file_name, '.png')
+
+
+def fit_all_materials(T2_Data: dict[str, dict]) -> dict[str, dict]:
+    """Fits every envelope as one stacked SciPy problem; no plots are drawn."""
+    datasets = {material: (data['x_peak'], data['y_peak'], data['delta_t'], data['delta_v']) for material, data in T2_Data.items()}
+    starts = {material: fit_start(data) for material, data in T2_Data.items()}
+    batch = ft.fit_batch(datasets, fit_str, {material: limits for material, (limits, _) in starts.items()},
+                         initial={material: initial for material, (_, initial) in starts.items()})
+    return {
+        material: {'param_lim': starts[material][0], 'params': result['fitted_params'], 'statistics': result['statistics'],
+                   'popt': result['popt']}
+        for material, result in batch['samples'].items()
+    }
+
+
+def bootstrap_materials(T2_Data: dict[str, dict], n_replicates: int, workers: int | None = 1,
+                        refit: bool = False) -> dict[str, dict]:
+    """Bootstrap errors of every envelope (see `ft.bootstrap`), the replicates spread over `workers` processes."""
+    starts = {material: fit_start(data) for material, data in T2_Data.items()}
+    return ft.bootstrap(
+        {material: figure_inputs(material, data)[0] for material, data in T2_Data.items()}, fit_str,
+        {material: limits for material, (limits, _) in starts.items()},
+        n_replicates=n_replicates, workers=workers, cache=ft.FitCache(refresh=refit),
+        initial={material: initial for material, (_, initial) in starts.items()})
+
+
+def fit_t2(T2_Data: dict[str, dict], workers: int | None = 1, backend: str = 'root',
+           refit: bool = False, bootstrap: int = 0) -> dict[str, dict]:
+    fit_func = partial(fit_material, backend=backend, refit=refit)
+    if backend == 'batch':
+        all_results = fit_all_materials(T2_Data)
+    elif backend == 'numpy':
+        # Materials are independent fits; with workers != 1 they run in separate processes
+        all_results = pl.map_materials(fit_func, T2_Data, workers=workers)
+    else:
+        # Each canvas is rendered in the background as soon as its fit is done
+        with et.ExportQueue(plot_directory + et.MANIFEST_FILE, processes=True) as exports:
+            all_results = pl.map_materials(
+                fit_func, T2_Data, workers=workers,
+                on_result=lambda material, fit_results: export_figure(exports, material, {**T2_Data[material], **fit_results}))
+
+    if bootstrap:
+        # Stored next to the covariance errors in 'params'
+        for material, result in bootstrap_materials(T2_Data, bootstrap, workers=workers, refit=refit).items():
+            all_results[material]['bootstrap'] = result
+
+    # The store is only written from this process, in database order
+    for material, fit_results in all_results.items():
+        T2_Data[material].update(fit_results)
+    st.update_materials(T2_path, all_results)
+    return T2_Data
+
 
-    t2_c = rt.draw_canvas(
-        results, titles,
-        fit_str, x_range,
-        par_limits=par_limits,
-        file_name=file_name, file_type='.png')
+def main(T2_Data: dict[str, dict] | None = None, workers: int | None = 1, backend: str = 'root',
+         refit: bool = False, bootstrap: int = 0) -> dict[str, dict]:
+    if T2_Data is None:
+        # Only the envelopes are needed, the full traces stay on disk
+        T2_Data = {
+            material: st.load_material(T2_path, material, keys=('x_peak', 'y_peak', 'delta_t', 'delta_v'))
+            for material in st.load_meta(T2_path)
+            }
+    return fit_t2(T2_Data, workers=workers, backend=backend, refit=refit, bootstrap=bootstrap)
 
-    fit_func = t2_c['fit']
-    T2_Data[material]['param_lim'] = par_limits
-    T2_Data[material]['params'] = t2_c['fitted_params']
-    T2_Data[material]['statistics'] = t2_c['statistics']
 
-# with open(T2_path, 'w') as f:
-#     json.dump(T2_Data, f, indent=4)
\ No newline at end of file
+if __name__ == '__main__':
+    main()
@@ -1,55 +1,248 @@
 import sys
 import os
 import json
+from itertools import product
 import numpy as np
-import matplotlib.pyplot as plt
 from tqdm import tqdm
 
 sys.path.append(os.path.abspath('../..'))
 from utils import pandas_tools as pt
+from utils import store_tools as st
+from utils import export_tools as et
+from utils import profile_tools as pf
+from utils import fit_tools as ft
+from utils import pipeline_tools as pl
+from utils.uncertainty_tools import Uncertainty
+from Pulse_NMR_61.analysing_data import t2_analysis
 
-T2_path = 'Pulse_NMR_61/create_databases/T2_Data.json'
+T2_path = 'Pulse_NMR_61/create_databases/T2_Data/'
 plot_directory = 'Pulse_NMR_61/Plots/T2/Peaks/'
+chunk_size: int = 1 << 16  # Samples read from the memory-mapped traces at a time
 
-with open(T2_path, "r") as f:
-    T2_Data = json.load(f)
+# Envelope settings chosen by the autotuner, per sample (sheet), shared by every day it was measured on;
+# kept with the T2 store together with the fingerprint of the sheet they were tuned on
+tuned_settings_path = T2_path + 'peak_settings.json'
+# With autotune, samples without tuned settings are tuned on their first material (otherwise they keep the
+# hand-tuned defaults); retune tunes every sample again
+autotune: bool = False
+retune: bool = False
+# Worker processes of the sweep (None: one per CPU, 1: in this process)
+tune_workers: int | None = None
+# The grid: minimum peak distance in units of tau, minimum height and prominence in volts, and the
+# Savitzky-Golay window the trace is smoothed with before the peaks are found (0: the raw trace)
+peak_spacings: tuple[float, ...] = (1.5, 1.6, 1.7, 1.8, 1.9)
+min_heights: tuple[float, ...] = (3., 4., 4.4, 5., 6.)
+prominences: tuple[float, ...] = (0.25, 0.5, 1.)
+smoothing_windows: tuple[int, ...] = (0, 15, 31)
+# Envelopes with fewer peaks are not fitted (the T2 fit has three parameters)
+min_envelope_peaks: int = 6
+# Candidates whose T2 fit has a p-value below this are only chosen if none passes
+min_p_value: float = 0.05
 
-# Getting the envelopes for all T2 data. stds should be adjusted 
-for material, data in tqdm(T2_Data.items()):
-    print(material)
-    x, y = np.array(data['time']), np.array(data['volt'])
-    tau = data['tau']
-    peak_diff = 1.8 * tau if tau == 0.1 else 1.7 * tau
-    min_h = 4.4 if material == '2 para' else 5.
-    x_peaks, y_peaks = pt.get_peaks(x, y, min_time_between_peaks=peak_diff, min_height=min_h)
 
-    x, y_smooth = pt.smooth_xy_data(x, y, window_length=31, polyorder=2)
-    x_speak, y_speak = pt.get_peaks(x, y_smooth, min_time_between_peaks=0.9*peak_diff, min_height = 5.)
+def render_peaks(x: np.ndarray, y: np.ndarray, x_peaks: np.ndarray, y_peaks: np.ndarray, material: str, file_path: str) -> None:
+    """Draws a trace with its envelope peaks; uses a bare Figure (no pyplot), so nothing is left open."""
+    from matplotlib.figure import Figure  # Imported here so importing the stage stays cheap
 
-    data['x_peak'], data['y_peak'] = list(x_peaks), list(y_peaks)
-    data['delta_t'] = [0.2 * tau] * len(x_peaks)
+    fig = Figure(figsize=(10, 5))
+    ax = fig.subplots()
+    ax.plot(x, y, label='Signal', alpha=0.5)
+    ax.plot(x_peaks, y_peaks, 'go', label='Envelope Peaks')
+    # ax.plot(x, y_smooth, label='Smooth', color='purple', alpha=0.3)
+    # ax.plot(x_speak, y_speak, 'co', label='Smooth Peaks')
+    ax.set_xlabel('Time [ms]')
+    ax.set_ylabel('Voltage [V]')
+    ax.set_title(f'Envelope Detection from {material}')
+    ax.legend()
+    ax.grid(True)
+    fig.savefig(file_path)
 
+
+def voltage_error(sample: str) -> float:
+    """Error of the envelope voltages of a sample."""
     dv = 0.15
-    if material in ('water', '2 para', '1 para'): dv = 0.5
-    if material in ('4 para', '0.5 para', '0.25 para', '0.125 para'): dv = 0.3
-    if material in ('glycerine'): data['delta_v']: dv = 0.2
-    data['delta_v'] = [dv] * len(y_peaks)
-    
-    T2_Data[material] = data
-
-    # Plotting
-    plt.figure(figsize=(10, 5))
-    plt.plot(x, y, label='Signal', alpha=0.5)
-    plt.plot(x_peaks, y_peaks, 'go', label='Envelope Peaks')
-    # plt.plot(x, y_smooth, label='Smooth', color='purple', alpha=0.3)
-    # plt.plot(x_speak, y_speak, 'co', label='Smooth Peaks')
-    plt.xlabel('Time [ms]')
-    plt.ylabel('Voltage [V]')
-    plt.title(f'Envelope Detection from {material}')
-    plt.legend()
-    plt.grid(True)
-    file_name = f'peaks_for_{material}.png'
-    plt.savefig(plot_directory + file_name)
-
-with open(T2_path, 'w') as f:
-    json.dump(T2_Data, f, indent=4)
\ No newline at end of file
+    if sample in ('water', '2 para', '1 para'): dv = 0.5
+    if sample in ('4 para', '0.5 para', '0.25 para', '0.125 para'): dv = 0.3
+    if sample == 'glycerine': dv = 0.2
+    return dv
+
+
+def default_settings(sample: str, tau: float) -> dict:
+    """The hand-tuned envelope settings, used for samples that have not been tuned."""
+    return {
+        'peak_spacing': 1.8 if tau == 0.1 else 1.7,
+        'min_height': 4.4 if sample == '2 para' else 5.,
+        'prominence': 0.5,
+        'smoothing_window': 0
+    }
+
+
+def score_candidates(task: str, job: dict) -> list[dict]:
+    """
+    Finds the envelope of a trace with every minimum height and prominence of the grid, for one
+    smoothing window and peak spacing, and fits T2 to each envelope (seeded SciPy fit, see `ft.seed_fit`).
+    Module-level so the sweep can run in worker processes.
+    """
+    x, y, tau, dv = job['x'], job['y'], job['tau'], job['delta_v']
+    if job['smoothing_window']:
+        _, y = pt.smooth_xy_data(x, y, window_length=job['smoothing_window'], polyorder=2)
+    candidates = []
+    for min_height, prominence in product(min_heights, prominences):
+        candidate = {'peak_spacing': job['peak_spacing'], 'min_height': min_height, 'prominence': prominence,
+                     'smoothing_window': job['smoothing_window']}
+        x_peaks, y_peaks = pt.get_peaks(x, y, job['peak_spacing'] * tau, min_height, prominence)
+        candidate['n_peaks'] = len(x_peaks)
+        if len(x_peaks) < min_envelope_peaks:
+            continue
+        envelope = x_peaks, y_peaks, Uncertainty.constant(0.2 * tau, len(x_peaks)), Uncertainty.constant(dv, len(y_peaks))
+        limits, initial = ft.seed_fit(envelope, t2_analysis.fit_str, t2_analysis.par_limits)
+        try:
+            fit = ft.fit_formula(envelope, t2_analysis.fit_str, limits, initial=initial)
+        except (RuntimeError, ValueError):  # curve_fit gave up or the start values were unusable
+            continue
+        T2, T2_err = fit['popt'][1], fit['perr'][1]
+        candidates.append({**candidate, **fit['statistics'], 'T2_relative_error': abs(T2_err / T2) if T2 else np.inf})
+    return candidates
+
+
+def candidate_rank(candidate: dict) -> tuple:
+    """
+    Sort key of the sweep, best first: a T2 fit whose p-value passes `min_p_value`, then the smallest
+    relative error of T2, scaled by sqrt(chi2_red) when the envelope fits worse than its errors allow
+    (spurious or missed echoes), then the envelope with more peaks.
+    """
+    inflation = np.sqrt(max(candidate['chi2_red'], 1.))
+    return candidate['p_value'] < min_p_value, round(candidate['T2_relative_error'] * inflation, 6), -candidate['n_peaks']
+
+
+def tune_envelope(material: str, data: dict, workers: int | None = 1) -> dict | None:
+    """
+    Sweeps the envelope settings of one material over the grid and returns the best (see `candidate_rank`),
+    with its 'n_peaks', 'chi2_red', 'p_value', and the 'material' it was tuned on and that material's 'fingerprint';
+    None if no envelope could be fitted.
+
+    Each task of the sweep is one smoothing window and peak spacing, so a trace is smoothed once per task;
+    with `workers` other than 1 the tasks run in worker processes (see `pl.map_materials`).
+    """
+    # One copy of the trace in memory (the store maps it from disk), sent once to every task
+    x, y = np.array(data['time'], dtype=np.float64), np.array(data['volt'], dtype=np.float64)
+    sample = data.get('sheet', material)
+    jobs = {
+        f'{material} window {window} spacing {spacing}': {
+            'x': x, 'y': y, 'tau': data['tau'], 'delta_v': voltage_error(sample),
+            'smoothing_window': window, 'peak_spacing': spacing
+        }
+        for window, spacing in product(smoothing_windows, peak_spacings)
+        if window < len(y)
+    }
+    candidates = [candidate for result in pl.map_materials(score_candidates, jobs, workers=workers, phase='tune').values()
+                  for candidate in result]
+    if not candidates:
+        return None
+    # Many settings find the same envelope: of the equally good ones (in grid order), the middle one
+    # is the farthest from the edges of the range that works, so it is the safest for the other days
+    best_rank = min(map(candidate_rank, candidates))
+    ties = [candidate for candidate in candidates if candidate_rank(candidate) == best_rank]
+    best = ties[len(ties) // 2]
+    print(f"Tuned {sample} on {material} over {len(jobs) * len(min_heights) * len(prominences)} settings: {best}")
+    return {**best, 'material': material, 'fingerprint': data.get('fingerprint')}
+
+
+def load_tuned_settings() -> dict[str, dict]:
+    if not os.path.exists(tuned_settings_path):
+        return {}
+    with open(tuned_settings_path, 'r') as f:
+        return json.load(f)
+
+def save_tuned_settings(tuned: dict[str, dict]) -> None:
+    os.makedirs(os.path.dirname(tuned_settings_path), exist_ok=True)
+    with open(tuned_settings_path, 'w') as f:
+        json.dump(tuned, f, indent=4)
+
+def stale_tuned_settings(tuned: dict[str, dict], T2_Data: dict[str, dict]) -> list[str]:
+    """Samples whose settings were tuned on a material that was since removed or rebuilt from an edited sheet."""
+    return [sample for sample, settings in tuned.items()
+            if settings.get('material') not in T2_Data
+            or T2_Data[settings['material']].get('fingerprint') != settings.get('fingerprint')]
+
+
+def extract_envelopes(T2_Data: dict[str, dict], tune: bool | None = None) -> dict[str, dict]:
+    """
+    Finds the envelope of every material whose peaks are missing or were found with other settings.
+
+    Args:
+        T2_Data (dict[str, dict]): The T2 database; the envelopes are added to it and to the store.
+        tune (bool, optional): Tune the settings of samples without valid tuned settings. Defaults to `autotune`.
+    """
+    if tune is None:
+        tune = autotune
+    tuned = load_tuned_settings()
+    # Settings tuned on a sheet that was edited or removed no longer describe the sample
+    stale = stale_tuned_settings(tuned, T2_Data)
+    for sample in stale:
+        print(f"Dropping the tuned envelope settings of {sample}: {tuned[sample].get('material')} was edited or removed.")
+        del tuned[sample]
+    if stale:
+        save_tuned_settings(tuned)
+    tuned_now: set[str] = set()
+    envelopes: dict[str, dict] = {}  # Written to the store at once after the loop
+    # The plots are drawn in a background thread while the next material is processed
+    with et.ExportQueue(plot_directory + et.MANIFEST_FILE) as exports:
+        for material, data in tqdm(T2_Data.items()):
+            print(material)
+            sample = data.get('sheet', material)  # The settings below are per sample, whichever day it was measured on
+            tau = data['tau']
+
+            # New samples (or all of them with retune) are tuned once, on the first material measured
+            if tune and sample not in tuned_now and (retune or sample not in tuned):
+                result = tune_envelope(material, data, workers=tune_workers)
+                tuned_now.add(sample)
+                if result is not None:
+                    tuned[sample] = result
+                    save_tuned_settings(tuned)
+
+            chosen = tuned.get(sample) or default_settings(sample, tau)
+            peak_diff = chosen['peak_spacing'] * tau
+            min_h, prominence, window = chosen['min_height'], chosen['prominence'], chosen['smoothing_window']
+            dv = voltage_error(sample)
+
+            # Peaks stored with the same settings are reused; a material rebuilt from an edited sheet has none
+            settings = {'min_time_between_peaks': float(peak_diff), 'min_height': min_h, 'prominence': prominence,
+                        'smoothing_window': window, 'delta_v': dv}
+            if 'x_peak' in data and data.get('peak_settings') == settings:
+                continue
+
+            with pf.span(material, 'peaks', material=material):
+                # The traces are streamed in chunks, so only one chunk of a long echo train is in memory at a time
+                x, y = data['time'], data['volt']
+                chunks = pt.iter_chunks(x, y, chunk_size=chunk_size)
+                if window:
+                    chunks = pt.smooth_chunks(chunks, window_length=window, polyorder=2)
+                x_peaks, y_peaks = pt.stream_peaks(chunks, min_time_between_peaks=peak_diff, min_height=min_h, prominence=prominence)
+
+            data['x_peak'], data['y_peak'] = x_peaks, y_peaks
+            data['delta_t'] = Uncertainty.constant(0.2 * tau, len(x_peaks))
+            data['delta_v'] = Uncertainty.constant(dv, len(y_peaks))
+            data['peak_settings'] = settings
+
+            envelopes[material] = {
+                'x_peak': data['x_peak'], 'y_peak': data['y_peak'],
+                'delta_t': data['delta_t'], 'delta_v': data['delta_v'],
+                'peak_settings': settings
+                }
+
+            # Plotting
+            file_path = plot_directory + f'peaks_for_{material}.png'
+            exports.submit(file_path, render_peaks, x, y, x_peaks, y_peaks, material, file_path)
+    st.update_materials(T2_path, envelopes)
+    return T2_Data
+
+
+def main(T2_Data: dict[str, dict] | None = None, tune: bool | None = None) -> dict[str, dict]:
+    if T2_Data is None:
+        T2_Data = st.load_database(T2_path)
+    return extract_envelopes(T2_Data, tune=tune)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,125 +1,200 @@
 import sys
 import os
-import json
-from tqdm import tqdm
+from functools import partial
+from contextlib import ExitStack
 import numpy as np
-import matplotlib.pyplot as plt
-
-from scipy.optimize import curve_fit
-from scipy.stats import chi2
 
 sys.path.append(os.path.abspath('../..'))
 from utils import root_tools as rt
+from utils import fit_tools as ft
+from utils import pipeline_tools as pl
+from utils import export_tools as et
+from utils import store_tools as st
+from utils.uncertainty_tools import Uncertainty
 
 plot_directory = 'Pulse_NMR_61/Plots/T2_eff/eps/'
-T2_eff_path = 'Pulse_NMR_61/create_databases/T2_Eff_Data.json'
+T2_eff_path = 'Pulse_NMR_61/create_databases/T2_Eff_Data/'
+save_plt: bool = False
 
-with open(T2_eff_path, "r") as f:
-    T2_Eff_Data = json.load(f)
+# A * (1 - exp(-(x - t0) / T_RC)) * exp(-(x - t0) / T2) + C, compiled once for SciPy and used as is by ROOT
+fit_str = "[0] * (1 - exp(- (x - [3]) / [4])) * exp(- (x - [3]) / [1]) + [2]"
+fit_function = ft.compile_formula(fit_str)
+param_names = ['0', '1', '2', '3', '4']  # Same keys as after a JSON round trip
+# Parameters common to every material in the batch fit: T_RC is a property of the apparatus
+batch_shared_params: tuple[int, ...] = (4,)
 
 
-def fit_function(x, A, T2, C, t0, T_RC):
-    """Fit function: A * (1 - exp(-x / T_RC)) * exp(-(x-t0) / T2)"""
-    return A * (1 - np.exp(- (x - t0) / T_RC)) * np.exp(-(x - t0) / T2) + C
+def initial_values(data: dict) -> list[float]:
+    """Start values where the pre-fit cannot estimate a parameter (see `fit_start`)."""
+    bounds = list(data['param_lim'].values())
+    return [np.max(data['volt']), (bounds[1][0] + bounds[1][1]) / 2, 3, 0.01, 0.1]
 
-save_plt: bool = False
-for material, data in tqdm(T2_Eff_Data.items()):    
-    time = np.array(data['time'])
-    volt = np.array(data['volt'])
-    sigma_time = np.array(data['delta_time'])
-    sigma_volt = np.array(data['delta_v'])
-
-    T_RC = data['T_RC']
-    param_bounds = data['param_lim']
-    
-    # Convert bounds from dict form to tuples (A_min, A_max), (T2_min, T2_max)
-    lower_bounds = [val[0] for val in param_bounds.values()]
-    upper_bounds = [val[1] for val in param_bounds.values()]
-
-    # Initial guess
-    p0 = [np.max(volt), (lower_bounds[1] + upper_bounds[1]) / 2, 3, 0.01, 0.1]
-
-    # Fit using curve_fit
-    popt, pcov = curve_fit(
-        fit_function,
-        time,
-        volt,
-        sigma=sigma_volt,
-        p0=p0,
-        bounds=(lower_bounds, upper_bounds),
-        absolute_sigma=True
-    )
-
-    # Residuals and fit statistics
-    residuals = volt - fit_function(time, *popt)
-    chi2_val = np.sum((residuals / sigma_volt) ** 2)
-    dof = len(time) - len(popt)
-    chi2_red = chi2_val / dof
-    p_val = 1 - chi2.cdf(chi2_val, dof)
-
-    # Parameter errors
-    perr = np.sqrt(np.diag(pcov))
-    param_names = [0, 1, 2, 3, 4]
-    param_dict = {
-        i: (
-            rt.round_respect_to_error(val, err),
-            rt.sig_digits_round(err)
-            )
-            for i, val, err in zip(param_names, popt, perr)
-        }
-
-    stat_dict = {
-        'chi2_red': rt.sig_digits_round(chi2_red, n=3),
-        'p_value':  rt.sig_digits_round(p_val, n=3)
-        }
-
-    T2_Eff_Data[material]['params'] = param_dict
-    T2_Eff_Data[material]['statistics'] = stat_dict
-    print(param_dict)
-    print(stat_dict)
 
-    root_data = (
+def root_data_of(data: dict) -> tuple:
+    """The decimated (time, volt, delta_time, delta_v) samples used by the fits and the ROOT canvas."""
+    return (
         data['root_data']['time'],
         data['root_data']['volt'],
         data['root_data']['delta_time'],
         data['root_data']['delta_v']
         )
-    root_params = {i: val for i, val in zip(param_names, popt)}
-    fit_str = "[0] * (1 - exp(- (x - [3]) / [4])) * exp(- (x - [3]) / [1]) + [2]"
-    titles = {'title': f'Voltage as a function of time in {material}', 'x_title': 'Time [ms]', 'y_title': 'V [Volt]'}
-    x_range = 0, 1.1 * max(root_data[0])
-    root_file_name = plot_directory + f'root_T2_Eff_{material}'
 
-    t2_eff_canvas = rt.draw_canvas(
-        root_data, titles,fit_str, 
-        x_range, root_params,
-        file_name=root_file_name, file_type='.eps')
 
-    # Plot result
-    if save_plt:
-        plt.figure(figsize=(8, 5))
-        # plt.errorbar(time, volt, xerr=sigma_time, yerr=sigma_volt, fmt='o', label='Data', alpha=0.6)
-        plt.plot(time, volt, 'o', label='Data', alpha=0.6)
+def fit_data_of(data: dict) -> tuple:
+    """The points the SciPy fits use: the decimated samples, without the time errors (zero x errors)."""
+    root_data = root_data_of(data)
+    return root_data[0], root_data[1], Uncertainty.constant(0., len(root_data[0])), root_data[3]
 
-        x_fit = np.linspace(0, 1.1 * max(time), 500)
-        y_fit = fit_function(x_fit, *popt)  
-        label = f'Fit: A={popt[0]:.2f}, T2={popt[1]:.2f}, C={popt[2]:.2f}, t0={popt[3]:.2f}, T_RC={popt[4]:.2f}'
-        plt.plot(x_fit, y_fit, 'r-', label=label)
 
-        plt.title(titles['title'])
-        plt.xlabel(titles['x_title'])
-        plt.ylabel(titles['y_title'])
-        plt.grid(True)
-        plt.legend()
-        plt.tight_layout()
-        plt.savefig(plot_directory + f'plt_T2_Eff_{material}.png')
-        # plt.show()
-        plt.close()
+def fit_start(data: dict) -> tuple[dict, dict]:
+    """
+    Limits and start values of a material's fit, seeded from its samples (see `ft.seed_fit`). The limits of
+    t0 and T_RC, and whatever the pre-fit cannot estimate, come from the builder and `initial_values`.
+    """
+    return ft.seed_fit(fit_data_of(data), fit_str, data['param_lim'], dict(enumerate(initial_values(data))))
 
 
+def fit_material(material: str, data: dict, backend: str = 'root', refit: bool = False) -> dict:
+    """
+    Fits one material; returns only picklable results so it can run in a worker process.
+    The fit always runs in SciPy; the plots are drawn later by `export_figures`.
+    Unchanged fits are taken from the fit cache unless `refit` is set.
+    """
+    # Limits and initial guess from the pre-fit
+    param_bounds, p0 = fit_start(data)
 
-with open(T2_eff_path, 'w') as f:
-    json.dump(T2_Eff_Data, f, indent=4)
+    # Fit with SciPy on the decimated samples the ROOT canvas shows
+    fit_results = ft.fit_formula(
+        fit_data_of(data), fit_str, param_bounds,
+        initial=p0,
+        cache=ft.FitCache(refresh=refit)
+    )
 
+    # Parameter errors, keyed as after a JSON round trip
+    param_dict = dict(zip(param_names, fit_results['fitted_params'].values()))
+    stat_dict = fit_results['statistics']
 
-    
+    print(param_dict)
+    print(stat_dict)
+    # The unrounded values draw the fitted curve; the rounded ones in 'params' are for display
+    return {'params': param_dict, 'statistics': stat_dict, 'popt': fit_results['popt']}
+
+
+def render_fit_plot(time: np.ndarray, volt: np.ndarray, popt: list[float], rounded: list[float],
+                    titles: dict[str, str], file_path: str) -> None:
+    """
+    Draws the matplotlib version of a fit; uses a bare Figure (no pyplot) so it can run in a background thread.
+    The curve is drawn from the fitted values `popt`, the legend shows the `rounded` ones.
+    """
+    from matplotlib.figure import Figure  # Only paid for when the plots are wanted
+
+    fig = Figure(figsize=(8, 5))
+    ax = fig.subplots()
+    # ax.errorbar(time, volt, xerr=sigma_time, yerr=sigma_volt, fmt='o', label='Data', alpha=0.6)
+    ax.plot(time, volt, 'o', label='Data', alpha=0.6)
+
+    x_fit = np.linspace(0, 1.1 * max(time), 500)
+    y_fit = fit_function(x_fit, popt)
+    label = f'Fit: A={rounded[0]}, T2={rounded[1]}, C={rounded[2]}, t0={rounded[3]}, T_RC={rounded[4]}'
+    ax.plot(x_fit, y_fit, 'r-', label=label)
+
+    ax.set_title(titles['title'])
+    ax.set_xlabel(titles['x_title'])
+    ax.set_ylabel(titles['y_title'])
+    ax.grid(True)
+    ax.legend()
+    fig.tight_layout()
+    fig.savefig(file_path)
+
+
+def export_figures(root_exports: et.ExportQueue | None, plt_exports: et.ExportQueue | None, material: str, data: dict) -> None:
+    """Queues the plots of a fitted material; each is only redrawn if its data or parameters changed."""
+    popt = data['popt']
+    rounded = [val for val, _ in data['params'].values()]
+    titles = {'title': f'Voltage as a function of time in {material}', 'x_title': 'Time [ms]', 'y_title': 'V [Volt]'}
+
+    if root_exports is not None:
+        root_data = root_data_of(data)
+        root_params = {i: val for i, val in zip(param_names, popt)}
+        x_range = 0, 1.1 * max(root_data[0])
+        root_file_name = plot_directory + f'root_T2_Eff_{material}'
+        root_exports.submit(root_file_name + '.eps', rt.render_canvas,
+                            root_data, titles, fit_str, x_range, root_params, root_file_name, '.eps')
+
+    if plt_exports is not None:
+        plt_file = plot_directory + f'plt_T2_Eff_{material}.png'
+        plt_exports.submit(plt_file, render_fit_plot, data['time'], data['volt'], popt, rounded, titles, plt_file)
+
+
+def fit_all_materials(T2_Eff_Data: dict[str, dict], shared: tuple[int, ...] = batch_shared_params) -> dict[str, dict]:
+    """Fits every material as one stacked problem, with the `shared` parameters common to all; no plots are drawn."""
+    datasets = {material: fit_data_of(data) for material, data in T2_Eff_Data.items()}
+    starts = {material: fit_start(data) for material, data in T2_Eff_Data.items()}
+    batch = ft.fit_batch(
+        datasets, fit_str,
+        par_limits={material: limits for material, (limits, _) in starts.items()},
+        initial={material: initial for material, (_, initial) in starts.items()},
+        shared=shared
+    )
+    return {
+        material: {'params': dict(zip(param_names, result['fitted_params'].values())), 'statistics': result['statistics'],
+                   'popt': result['popt']}
+        for material, result in batch['samples'].items()
+    }
+
+
+def bootstrap_materials(T2_Eff_Data: dict[str, dict], n_replicates: int, workers: int | None = 1,
+                        refit: bool = False) -> dict[str, dict]:
+    """Bootstrap errors of every material (see `ft.bootstrap`), the replicates spread over `workers` processes."""
+    starts = {material: fit_start(data) for material, data in T2_Eff_Data.items()}
+    results = ft.bootstrap(
+        {material: fit_data_of(data) for material, data in T2_Eff_Data.items()}, fit_str,
+        {material: limits for material, (limits, _) in starts.items()},
+        n_replicates=n_replicates, workers=workers, cache=ft.FitCache(refresh=refit),
+        initial={material: initial for material, (_, initial) in starts.items()})
+    # Keyed like 'params'
+    for result in results.values():
+        for field in ('errors', 'interval_68'):
+            result[field] = dict(zip(param_names, result[field].values()))
+    return results
+
+
+def fit_t2_eff(T2_Eff_Data: dict[str, dict], workers: int | None = 1, backend: str = 'root',
+               refit: bool = False, bootstrap: int = 0) -> dict[str, dict]:
+    if backend == 'batch':
+        all_results = fit_all_materials(T2_Eff_Data)
+    else:
+        # Materials are independent fits; with workers != 1 they run in separate processes.
+        # Each plot is rendered in the background as soon as its fit is done: ROOT canvases
+        # in a worker process, matplotlib figures in a thread.
+        manifest = plot_directory + et.MANIFEST_FILE
+        with ExitStack() as stack:
+            root_exports = stack.enter_context(et.ExportQueue(manifest, processes=True)) if backend == 'root' else None
+            plt_exports = stack.enter_context(et.ExportQueue(manifest)) if save_plt else None
+            fit_func = partial(fit_material, backend=backend, refit=refit)
+            all_results = pl.map_materials(
+                fit_func, T2_Eff_Data, workers=workers,
+                on_result=lambda material, fit_results: export_figures(
+                    root_exports, plt_exports, material, {**T2_Eff_Data[material], **fit_results}))
+
+    if bootstrap:
+        # Stored next to the covariance errors in 'params'
+        for material, result in bootstrap_materials(T2_Eff_Data, bootstrap, workers=workers, refit=refit).items():
+            all_results[material]['bootstrap'] = result
+
+    # The store is only written from this process, in database order
+    for material, fit_results in all_results.items():
+        T2_Eff_Data[material].update(fit_results)
+    st.update_materials(T2_eff_path, all_results)
+    return T2_Eff_Data
+
+
+def main(T2_Eff_Data: dict[str, dict] | None = None, workers: int | None = 1, backend: str = 'root',
+         refit: bool = False, bootstrap: int = 0) -> dict[str, dict]:
+    if T2_Eff_Data is None:
+        T2_Eff_Data = st.load_database(T2_eff_path)
+    return fit_t2_eff(T2_Eff_Data, workers=workers, backend=backend, refit=refit, bootstrap=bootstrap)
+
+
+if __name__ == '__main__':
+    main()
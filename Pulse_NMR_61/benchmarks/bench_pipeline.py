@@ -0,0 +1,287 @@
+import sys
+import os
+import io
+import json
+import argparse
+import platform
+import tempfile
+import subprocess
+import importlib.util
+from datetime import datetime
+from contextlib import redirect_stdout, redirect_stderr
+from collections.abc import Callable
+from statistics import median
+from time import perf_counter
+import numpy as np
+
+# Run from the repository root, like the other scripts
+repo_root = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.append(repo_root)
+
+from utils import model_tools as mt
+
+results_directory = 'Pulse_NMR_61/benchmarks/results/'
+layout_path = os.path.join(repo_root, 'Pulse_NMR_61/create_databases/sheet_layout.json')
+
+# Default sizes: samples per trace and number of materials (one trace each)
+trace_lengths: list[int] = [10_000, 100_000]
+material_counts: list[int] = [1, 4]
+# Writing and parsing a workbook is slow, so longer traces are not ingested from Excel
+excel_max_points: int = 50_000
+
+# Synthetic traces, shaped like the measured ones
+echo_spacing = 0.01         # T2: time between two echoes
+echo_width = 5e-4           # T2: width of one echo
+fid_params = [40., 0.15, 3., 0.01, 0.1]     # T2*: A, T2, C, t0, T_RC
+fid_fit_str = "[0] * (1 - exp(- (x - [3]) / [4])) * exp(- (x - [3]) / [1]) + [2]"
+fid_param_limits = {0: (0, 100), 1: (0.01, 1), 2: (-10, 10), 3: (0, 0.05), 4: (0.01, 1)}
+noise = 0.2
+
+ROOT_AVAILABLE = importlib.util.find_spec('ROOT') is not None
+
+
+def echo_train(n_points: int, seed: int = 0) -> tuple[np.ndarray, np.ndarray]:
+    """A T2 (CPMG) trace: Gaussian echoes every `echo_spacing` under an exponential envelope, plus noise."""
+    rng = np.random.default_rng(seed)
+    time = np.linspace(0, 0.5, n_points)
+    phase = (time % echo_spacing) - echo_spacing / 2
+    volt = 30 * np.exp(- time / 0.15) * np.exp(- 0.5 * (phase / echo_width) ** 2) + 3
+    return time, volt + rng.normal(0, noise, n_points)
+
+def fid(n_points: int, seed: int = 0) -> tuple[np.ndarray, ...]:
+    """A T2* free induction decay through the RC filter, plus noise, as (time, volt, delta_time, delta_v)."""
+    rng = np.random.default_rng(seed)
+    time = np.linspace(fid_params[3], 1.5, n_points)
+    volt = mt.rc_fid(time, fid_params) + rng.normal(0, noise, n_points)
+    return time, volt, np.zeros(n_points), np.full(n_points, noise)
+
+
+def setup_excel_ingestion(n_points: int, n_materials: int, workdir: str) -> Callable | str:
+    if n_points > excel_max_points:
+        return f"longer than excel_max_points ({excel_max_points})"
+    import pandas as pd
+    from Pulse_NMR_61.create_databases import create_synthetic_workbook as sw
+    file_path = os.path.join(workdir, f'workbook_{n_points}_{n_materials}.xlsx')
+    if not os.path.exists(file_path):
+        sw.write_workbook(file_path, sw.sample_parameters(n_materials), n_points)
+    return lambda: pd.read_excel(file_path, sheet_name=None)
+
+def setup_excel_ranges(n_points: int, n_materials: int, workdir: str) -> Callable | str:
+    if n_points > excel_max_points:
+        return f"longer than excel_max_points ({excel_max_points})"
+    from utils import pandas_tools as pt
+    from Pulse_NMR_61.create_databases import create_synthetic_workbook as sw
+    file_path = os.path.join(workdir, f'workbook_{n_points}_{n_materials}.xlsx')
+    if not os.path.exists(file_path):
+        sw.write_workbook(file_path, sw.sample_parameters(n_materials), n_points)
+    layout = pt.load_layout(layout_path)
+    return lambda: pt.read_ranges(file_path, layout)
+
+def setup_smooth(n_points: int, n_materials: int, workdir: str) -> Callable | str:
+    from utils import pandas_tools as pt
+    traces = [echo_train(n_points, seed=m) for m in range(n_materials)]
+    return lambda: [pt.smooth_xy_data(x, y, window_length=31, polyorder=2) for x, y in traces]
+
+def setup_peaks(n_points: int, n_materials: int, workdir: str) -> Callable | str:
+    from utils import pandas_tools as pt
+    traces = [echo_train(n_points, seed=m) for m in range(n_materials)]
+    return lambda: [pt.get_peaks(x, y, min_time_between_peaks=0.9 * echo_spacing, min_height=5.) for x, y in traces]
+
+def setup_data_points(n_points: int, n_materials: int, workdir: str) -> Callable | str:
+    from utils import root_tools as rt
+    traces = [fid(n_points, seed=m) for m in range(n_materials)]
+    return lambda: [rt.generate_data_points(*data) for data in traces]
+
+def setup_residuals(n_points: int, n_materials: int, workdir: str) -> Callable | str:
+    from utils import root_tools as rt
+    traces = [fid(n_points, seed=m) for m in range(n_materials)]
+    fitline = rt.create_tf1(fid_fit_str, 'bench_fit', 0, 1.5, dict(enumerate(fid_params)))
+    return lambda: [rt.generate_residuals(fitline, *data, fit_str=fid_fit_str) for data in traces]
+
+def setup_tf1_construct(n_points: int, n_materials: int, workdir: str) -> Callable | str:
+    import ROOT
+    # As before the pool: a TF1 parsed and compiled from the formula string for every material
+    return lambda: [ROOT.TF1(f'bench_tf1_{m}', fid_fit_str, 0, 1.5) for m in range(n_materials)]
+
+def setup_tf1_pooled(n_points: int, n_materials: int, workdir: str) -> Callable | str:
+    from utils import root_tools as rt
+    rt.pooled_tf1(fid_fit_str, 0, 1.5)
+    return lambda: [rt.pooled_tf1(fid_fit_str, 0, 1.5) for _ in range(n_materials)]
+
+def setup_draw_canvas(n_points: int, n_materials: int, workdir: str, save: bool = False) -> Callable | str:
+    from utils import root_tools as rt
+    traces = [fid(n_points, seed=m) for m in range(n_materials)]
+    titles = {'title': 'Benchmark', 'x_title': 'Time', 'y_title': 'Voltage'}
+    def run():
+        for m, data in enumerate(traces):
+            file_name = os.path.join(workdir, f'canvas_{m}') if save else None
+            rt.draw_canvas(data, titles, fid_fit_str, (0, 1.5), fid_param_limits, file_name=file_name)
+    return run
+
+def setup_t2_eff_fit(n_points: int, n_materials: int, workdir: str) -> Callable | str:
+    from utils import fit_tools as ft
+    traces = [fid(n_points, seed=m) for m in range(n_materials)]
+    initial = {0: 40., 1: 0.5, 2: 3., 3: 0.01, 4: 0.1}
+    return lambda: [ft.fit_formula(data, fid_fit_str, fid_param_limits, initial=initial) for data in traces]
+
+def setup_t2_eff_seeded_fit(n_points: int, n_materials: int, workdir: str) -> Callable | str:
+    from utils import fit_tools as ft
+    traces = [fid(n_points, seed=m) for m in range(n_materials)]
+    initial = {0: 40., 1: 0.5, 2: 3., 3: 0.01, 4: 0.1}
+    def run():
+        for data in traces:
+            limits, start = ft.seed_fit(data, fid_fit_str, fid_param_limits, initial)
+            ft.fit_formula(data, fid_fit_str, limits, initial=start)
+    return run
+
+
+# name: (setup(n_points, n_materials, workdir) -> callable to time or a reason to skip, needs ROOT)
+benchmarks: dict[str, tuple[Callable, bool]] = {
+    'excel_ingestion':          (setup_excel_ingestion, False),
+    'excel_ranges':             (setup_excel_ranges, False),
+    'smooth_xy_data':           (setup_smooth, False),
+    'get_peaks':                (setup_peaks, False),
+    'generate_data_points':     (setup_data_points, True),
+    'generate_residuals':       (setup_residuals, True),
+    'tf1_construct':            (setup_tf1_construct, True),
+    'tf1_pooled':               (setup_tf1_pooled, True),
+    'draw_canvas':              (setup_draw_canvas, True),
+    'draw_canvas_saved':        (lambda n, m, workdir: setup_draw_canvas(n, m, workdir, save=True), True),
+    't2_eff_curve_fit':         (setup_t2_eff_fit, False),
+    't2_eff_seeded_fit':        (setup_t2_eff_seeded_fit, False),
+}
+
+
+def time_call(func: Callable, repeats: int) -> list[float]:
+    """Wall times of `repeats` calls of `func`, after one untimed warm-up call; its printed output is discarded."""
+    times = []
+    with redirect_stdout(io.StringIO()):
+        func()  # Lazy imports and first-call set-up are not part of the measurement
+    for _ in range(repeats):
+        with redirect_stdout(io.StringIO()):
+            start = perf_counter()
+            func()
+            times.append(perf_counter() - start)
+    return times
+
+
+def git_revision() -> tuple[str, bool]:
+    """The current commit (short hash) and whether the working tree has uncommitted changes."""
+    def git(*args):
+        return subprocess.run(['git', *args], cwd=repo_root, capture_output=True, text=True).stdout.strip()
+    return git('rev-parse', '--short', 'HEAD') or 'unknown', bool(git('status', '--porcelain', '--untracked-files=no'))
+
+
+def run(names: list[str], lengths: list[int], materials: list[int], repeats: int) -> list[dict]:
+    """Runs every selected benchmark at every (trace length, material count) and prints one line per case."""
+    if ROOT_AVAILABLE:
+        import ROOT
+        ROOT.gROOT.SetBatch(True)
+
+    cases = []
+    print(f"{'benchmark':<24} {'points':>9} {'materials':>9} {'median':>12} {'min':>12}")
+    with tempfile.TemporaryDirectory() as workdir:
+        for name in names:
+            setup, needs_root = benchmarks[name]
+            for n_points in lengths:
+                for n_materials in materials:
+                    case = {'name': name, 'n_points': n_points, 'n_materials': n_materials}
+                    if needs_root and not ROOT_AVAILABLE:
+                        func = "ROOT is not installed"
+                    else:
+                        with redirect_stdout(io.StringIO()), redirect_stderr(io.StringIO()):
+                            func = setup(n_points, n_materials, workdir)
+
+                    if isinstance(func, str):
+                        case['skipped'] = func
+                        print(f"{name:<24} {n_points:>9} {n_materials:>9}   skipped: {func}")
+                    else:
+                        times = time_call(func, repeats)
+                        case.update({'median': median(times), 'min': min(times), 'repeats': repeats})
+                        print(f"{name:<24} {n_points:>9} {n_materials:>9} {case['median'] * 1e3:9.2f} ms {case['min'] * 1e3:9.2f} ms")
+                    cases.append(case)
+    return cases
+
+
+def save_results(cases: list[dict], directory: str = results_directory) -> str:
+    """Saves the cases with the commit and machine they were measured on; one file per commit."""
+    commit, dirty = git_revision()
+    import scipy
+    results = {
+        'commit': commit,
+        'dirty': dirty,
+        'date': datetime.now().isoformat(timespec='seconds'),
+        'machine': {
+            'platform': platform.platform(),
+            'processor': platform.processor() or platform.machine(),
+            'cpu_count': os.cpu_count(),
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'scipy': scipy.__version__,
+            'root': ROOT_AVAILABLE,
+        },
+        'cases': cases,
+    }
+    os.makedirs(directory, exist_ok=True)
+    file_path = os.path.join(directory, f"{commit}{'-dirty' if dirty else ''}.json")
+    with open(file_path, 'w') as f:
+        json.dump(results, f, indent=4)
+    print(f"Results saved to {file_path}")
+    return file_path
+
+
+def load_results(revision: str, directory: str = results_directory) -> dict:
+    """Loads the results of a commit, given a results file or a (prefix of the) commit hash."""
+    if os.path.isfile(revision):
+        file_path = revision
+    else:
+        full_hash = subprocess.run(['git', 'rev-parse', '--short', revision], cwd=repo_root,
+                                   capture_output=True, text=True).stdout.strip() or revision
+        matches = sorted((f for f in os.listdir(directory) if f.startswith(full_hash)), key=len)  # Clean runs first
+        if not matches:
+            raise FileNotFoundError(f"No benchmark results for '{revision}' in {directory}")
+        file_path = os.path.join(directory, matches[0])
+    with open(file_path, 'r') as f:
+        return json.load(f)
+
+
+def compare(baseline: dict, current: dict) -> None:
+    """Prints the median time of every case measured in both runs and the speed-up of `current`."""
+    def timed(results):
+        return {(c['name'], c['n_points'], c['n_materials']): c['median'] for c in results['cases'] if 'median' in c}
+    before, after = timed(baseline), timed(current)
+    print(f"{baseline['commit']} -> {current['commit']}")
+    print(f"{'benchmark':<24} {'points':>9} {'materials':>9} {'before':>12} {'after':>12} {'speed-up':>9}")
+    for key in [key for key in before if key in after]:
+        name, n_points, n_materials = key
+        print(f"{name:<24} {n_points:>9} {n_materials:>9} {before[key] * 1e3:9.2f} ms {after[key] * 1e3:9.2f} ms {before[key] / after[key]:8.2f}x")
+
+
+def main(names: list[str] | None = None, lengths: list[int] = trace_lengths, materials: list[int] = material_counts,
+         repeats: int = 3, save: bool = True) -> list[dict]:
+    """Runs the benchmarks (all by default) and saves the results under the current commit."""
+    cases = run(names or list(benchmarks), lengths, materials, repeats)
+    if save:
+        save_results(cases)
+    return cases
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmarks every pipeline stage on synthetic traces.")
+    parser.add_argument('names', nargs='*', metavar='benchmark',
+                        help=f"benchmarks to run (default: all): {', '.join(benchmarks)}")
+    parser.add_argument('--lengths', type=int, nargs='+', default=trace_lengths, help="samples per trace")
+    parser.add_argument('--materials', type=int, nargs='+', default=material_counts, help="numbers of materials")
+    parser.add_argument('--repeats', type=int, default=3)
+    parser.add_argument('--no-save', action='store_true', help="do not save the results")
+    parser.add_argument('--compare', nargs='+', metavar='COMMIT',
+                        help="compare saved results instead of running: BASELINE [CURRENT] (default CURRENT: HEAD)")
+    args = parser.parse_args()
+    unknown = [name for name in args.names if name not in benchmarks]
+    if unknown:
+        parser.error(f"unknown benchmarks: {', '.join(unknown)}")
+
+    if args.compare:
+        compare(load_results(args.compare[0]), load_results(args.compare[1] if len(args.compare) > 1 else 'HEAD'))
+    else:
+        main(args.names, args.lengths, args.materials, args.repeats, save=not args.no_save)
@@ -0,0 +1,49 @@
+import sys
+import os
+import subprocess
+from statistics import median
+from time import perf_counter
+
+# Run from the repository root, like the other scripts
+repo_root = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+entry_modules = [
+    "Pulse_NMR_61.main_json",
+    "Pulse_NMR_61.create_databases.create_measurements_snapshot",
+    "Pulse_NMR_61.create_databases.create_T1_database",
+    "Pulse_NMR_61.create_databases.create_T2_database",
+    "Pulse_NMR_61.create_databases.create_T2_eff_database",
+    "Pulse_NMR_61.create_databases.create_all_T_csv",
+    "Pulse_NMR_61.analysing_data.t1_analysis",
+    "Pulse_NMR_61.analysing_data.t2_analysis_peaks",
+    "Pulse_NMR_61.analysing_data.t2_analysis",
+    "Pulse_NMR_61.analysing_data.t2_eff_analysis",
+    "Pulse_NMR_61.analysing_data.magnetic_field_analysis",
+]
+
+
+def time_import(module: str | None, repeats: int = 5) -> float:
+    """Median wall time of a fresh interpreter importing `module` (None: an empty interpreter)."""
+    code = f"import {module}" if module else "pass"
+    times = []
+    for _ in range(repeats):
+        start = perf_counter()
+        subprocess.run([sys.executable, "-c", code], cwd=repo_root, check=True, capture_output=True)
+        times.append(perf_counter() - start)
+    return median(times)
+
+
+def main(repeats: int = 5) -> dict[str, float]:
+    """Measures the start-up cost of every entry script; the cost of the bare interpreter is subtracted."""
+    interpreter = time_import(None, repeats)
+    print(f"{'python -c pass':<60} {interpreter * 1e3:8.1f} ms")
+
+    startup = {}
+    for module in entry_modules:
+        startup[module] = time_import(module, repeats) - interpreter
+        print(f"{module:<60} {startup[module] * 1e3:8.1f} ms")
+    return startup
+
+
+if __name__ == '__main__':
+    main(repeats=int(sys.argv[1]) if len(sys.argv) > 1 else 5)
@@ -3,37 +3,35 @@ import os
 sys.path.append(os.path.abspath('../../..'))
 
 import json
-from tqdm import tqdm
-import pandas as pd
 import numpy as np
 
 from utils import pandas_tools as pt
 
-filename = "Pulse_NMR_61/Measurements/Measurements_day_3.xlsx"
-xls = pd.ExcelFile(filename)
-
-T1_Database = {}
-time_col = 'T'
-time_idx = pt.excel_col_to_index(time_col)
-header_row = 5
-end_row = 18
+# Every workbook matching the pattern is ingested, one day per workbook (Measurements_day_<N>.xlsx)
+measurements_glob = "Pulse_NMR_61/Measurements/Measurements_day_*.xlsx"
+output_directory = "Pulse_NMR_61/create_databases/"
+output_file_path = output_directory + f"T1_Data.json"
+# Cell ranges of every measurement in a sheet; the T1 points are the 'T1' ranges
+layout_path = output_directory + "sheet_layout.json"
+measurement = 'T1'
 
-for sheet_name in tqdm(xls.sheet_names):
-    if sheet_name in ('question'): continue
-    df = pd.read_excel(xls, sheet_name=sheet_name)
 
-    # Extract full columns
-    tau = df.iloc[header_row + 1: end_row, time_idx].dropna()
-    volt = df.iloc[header_row + 1: end_row, time_idx + 2].dropna()
+def build_t1_material(sheet_name: str, cells: dict) -> dict:
+    """Reads the inversion recovery points of one sheet and estimates the T1 fit limits."""
+    # Empty cells are read as NaN and left out of every column
+    tau, volt, delta_tau, delta_v = (np.asarray(cells[name], dtype=np.float64)
+                                     for name in ('tau', 'volt', 'delta_tau', 'delta_v'))
+    filled_tau, filled_volt = ~np.isnan(tau), ~np.isnan(volt)
 
-    delta_tau = df.iloc[header_row + 1: end_row, time_idx + 1].dropna()
-    delta_v = df.iloc[header_row + 1: end_row, time_idx + 3].dropna()
+    # Null-point estimate; the analysis seeds the fit from all points and falls back to these limits (ft.seed_fit)
+    T1 = tau[np.flatnonzero(filled_volt)[np.argmin(volt[filled_volt])]] / np.log(2)
 
-    T1 = tau[volt.idxmin()] / np.log(2)
+    tau, volt = tau[filled_tau], volt[filled_volt]
+    delta_tau, delta_v = delta_tau[~np.isnan(delta_tau)], delta_v[~np.isnan(delta_v)]
 
     param_lim = {0: (0.8*max(volt), 1.2*max(volt)), 1: (0.9*T1, 1.1*T1)}
 
-    T1_Database[sheet_name] = {
+    return {
         'tau': tau.tolist(),
         'volt': volt.tolist(),
         'delta_tau': delta_tau.tolist(),
@@ -41,7 +39,37 @@ for sheet_name in tqdm(xls.sheet_names):
         'param_lim': param_lim
     }
 
-output_directory = "Pulse_NMR_61/create_databases/"
-output_file_path = output_directory + f"T1_Data.json"
-with open(output_file_path, "w") as f:
-    json.dump(T1_Database, f, indent=4)
\ No newline at end of file
+
+def fingerprint_t1_sheet(sheet_name: str, cells: dict) -> str:
+    """Hash of the cells build_t1_material reads."""
+    return pt.cells_fingerprint(cells)
+
+
+def build_t1_database(workbooks: dict[str, dict], database: dict[str, dict] | None = None) -> tuple[dict[str, dict], list[str]]:
+    """Materials of the sheets that changed since `database` was built, and the materials to delete (see pt.ingest_workbooks)."""
+    return pt.ingest_workbooks(workbooks, measurement, build_t1_material, fingerprint_t1_sheet, database or {})
+
+
+def main(workbooks: dict[str, dict] | None = None) -> dict[str, dict]:
+    if workbooks is None:
+        workbooks = pt.load_workbooks(measurements_glob, pt.load_layout(layout_path))
+
+    # Only the sheets whose cells changed (or new days) are rebuilt; the other materials are kept as they are
+    T1_Database = {}
+    if os.path.exists(output_file_path):
+        with open(output_file_path, "r") as f:
+            T1_Database = json.load(f)
+    new_materials, stale = build_t1_database(workbooks, T1_Database)
+    for material in stale:
+        del T1_Database[material]
+    T1_Database.update(new_materials)
+
+    if new_materials or stale:
+        with open(output_file_path, "w") as f:
+            json.dump(T1_Database, f, indent=4)
+    print(f"Rebuilt {len(new_materials)} of {len(T1_Database)} materials.")
+    return T1_Database
+
+
+if __name__ == '__main__':
+    main()
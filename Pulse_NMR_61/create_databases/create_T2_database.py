@@ -3,43 +3,63 @@ import os
 # Add the parent directory to Python's path
 sys.path.append(os.path.abspath('../../..'))
 
-import json
-from tqdm import tqdm
-import pandas as pd
+import numpy as np
 
 from utils import pandas_tools as pt
+from utils import store_tools as st
 
-filename = "Pulse_NMR_61/Measurements/Measurements_day_3.xlsx"
-xls = pd.ExcelFile(filename)
-
-T2_Database = {}
-time_col = 'AA'
-time_idx = pt.excel_col_to_index(time_col)
-header_row = 7
+# Every workbook matching the pattern is ingested, one day per workbook (Measurements_day_<N>.xlsx)
+measurements_glob = "Pulse_NMR_61/Measurements/Measurements_day_*.xlsx"
+output_directory = "Pulse_NMR_61/create_databases/"
+store_path = output_directory + "T2_Data/"
+# Cell ranges of every measurement in a sheet; the echo train is the 'T2' ranges
+layout_path = output_directory + "sheet_layout.json"
+measurement = 'T2'
 
-for sheet_name in tqdm(xls.sheet_names):
-    if sheet_name in ('question'): continue
-    df = pd.read_excel(xls, sheet_name=sheet_name)
 
-    # Extract full columns AA and AB
-    time = df.iloc[header_row + 1:, time_idx].dropna() * 1e3  # Convert to milliseconds
-    volt = df.iloc[header_row + 1:, time_idx + 1].dropna()
+def build_t2_material(sheet_name: str, cells: dict) -> dict:
+    """Reads the echo train of one sheet, with its tau and repetition time."""
+    time = np.asarray(cells['time'], dtype=np.float64) * 1e3  # Convert to milliseconds
+    volt = np.asarray(cells['volt'], dtype=np.float64)
 
-    mask = time >= 0
+    # Samples with both cells filled (empty cells are read as NaN), from t = 0 on
+    mask = ~np.isnan(time) & ~np.isnan(volt) & (time >= 0)
     time = time[mask]
     volt = volt[mask]
 
-    tau = df.iloc[3, time_idx]       # Cell AA5
-    repetition_time = df.iloc[3, time_idx + 3]  # Cell AD5 → index 29
-
-    T2_Database[sheet_name] = {
+    return {
         'time': time.tolist(),
         'volt': volt.tolist(),
-        'repetition_time': repetition_time,
-        'tau': tau
+        'repetition_time': cells['repetition_time'],
+        'tau': cells['tau']
     }
 
-output_directory = "Pulse_NMR_61/create_databases/"
-output_file_path = output_directory + "T2_Data.json"
-with open(output_file_path, "w") as f:
-    json.dump(T2_Database, f, indent=4)
\ No newline at end of file
+
+def fingerprint_t2_sheet(sheet_name: str, cells: dict) -> str:
+    """Hash of the cells build_t2_material reads."""
+    return pt.cells_fingerprint(cells)
+
+
+def build_t2_database(workbooks: dict[str, dict], database: dict[str, dict] | None = None) -> tuple[dict[str, dict], list[str]]:
+    """Materials of the sheets that changed since `database` was built, and the materials to delete (see pt.ingest_workbooks)."""
+    return pt.ingest_workbooks(workbooks, measurement, build_t2_material, fingerprint_t2_sheet, database or {})
+
+
+def main(workbooks: dict[str, dict] | None = None) -> dict[str, dict]:
+    if workbooks is None:
+        workbooks = pt.load_workbooks(measurements_glob, pt.load_layout(layout_path))
+
+    # Only the sheets whose cells changed (or new days) are rebuilt and written; the other materials stay in the store
+    T2_Database = st.load_database(store_path)
+    new_materials, stale = build_t2_database(workbooks, T2_Database)
+    st.remove_materials(store_path, stale)
+    st.save_database(new_materials, store_path)
+    for material in stale:
+        del T2_Database[material]
+    T2_Database.update(new_materials)
+    print(f"Rebuilt {len(new_materials)} of {len(T2_Database)} materials.")
+    return T2_Database
+
+
+if __name__ == '__main__':
+    main()
@@ -4,67 +4,64 @@ import os
 sys.path.append(os.path.abspath('../../..'))
 
 
-import json
-from tqdm import tqdm
-import pandas as pd
 import numpy as np
 
 from utils import pandas_tools as pt
+from utils import store_tools as st
+from utils.uncertainty_tools import Uncertainty
 
-filename = "Pulse_NMR_61/Measurements/Measurements_day_3.xlsx"
-xls = pd.ExcelFile(filename)
-
-T2_Database = {}
-time_col = 'K'
-time_idx = pt.excel_col_to_index(time_col)
-header_row = 5
-
-for sheet_name in tqdm(xls.sheet_names):
-    if sheet_name in ('question'): continue
-    df = pd.read_excel(xls, sheet_name=sheet_name)
-
-    time = df.iloc[header_row + 1:, time_idx].dropna() * 1e3
-    volt = df.iloc[header_row + 1:, time_idx + 1].dropna()
-
-    # Find first index where volt > 5
+# Every workbook matching the pattern is ingested, one day per workbook (Measurements_day_<N>.xlsx)
+measurements_glob = "Pulse_NMR_61/Measurements/Measurements_day_*.xlsx"
+output_directory = "Pulse_NMR_61/create_databases/"
+store_path = output_directory + "T2_Eff_Data/"
+
+# Cell ranges of every measurement in a sheet; the FID is the 'T2_eff' ranges
+layout_path = output_directory + "sheet_layout.json"
+measurement = 'T2_eff'
+# Samples kept for the fits: a point budget, an error bound in volts, or both (see pt.decimate_trace)
+fit_points: int | None = 400
+fit_tolerance: float | None = None
+# Savitzky-Golay filter of the copy the samples are picked on; a trace shorter than the window is
+# smoothed with the largest odd window it holds, and one too short for the polynomial is not smoothed
+smoothing_window: int = 31
+smoothing_polyorder: int = 2
+
+
+def build_t2_eff_material(sheet_name: str, cells: dict) -> dict:
+    """Reads the FID of one sheet and keeps the samples used by the fits."""
+    time = np.asarray(cells['time'], dtype=np.float64) * 1e3
+    volt = np.asarray(cells['volt'], dtype=np.float64)
+    filled = ~np.isnan(time) & ~np.isnan(volt)  # Empty cells are read as NaN
+    time, volt = time[filled], volt[filled]
+
+    # Keep the data from the first sample where volt > v_min on (none: the trace is empty)
     v_min: float = 5. if sheet_name == '0.5 para' else 4.
-    first_valid_idx = volt[volt > v_min].index.min()
-
-    # Apply mask: keep data only after (and including) first_valid_idx
-    mask_v_min = time.index >= first_valid_idx
-    time = time[mask_v_min]
-    volt = volt[mask_v_min]
+    above = np.flatnonzero(volt > v_min)
+    first_valid_idx = above[0] if len(above) else len(volt)
+    time = time[first_valid_idx:]
+    volt = volt[first_valid_idx:]
 
     mask_t0 = time >= 0
     time = time[mask_t0]
     volt = volt[mask_t0]
 
-    time = time.reset_index(drop=True)
-    volt = volt.reset_index(drop=True) 
-    
+    # The resolution of the scope: one error for every sample, stored as a single value
     dt, dv = 0.01 / np.sqrt(12), 0.2 / np.sqrt(12)
-    delta_time = [dt] * len(time)
-    delta_v    = [dv] * len(volt)
-
-    # Assume time and volt are already defined Series with aligned indices
-    max_idx = volt.idxmax()
-
-    # Split at global max index
-    before_max = time.index <= max_idx
-    after_max = time.index > max_idx
-
-    # Select parts
-    time_before = time[before_max].iloc[::50]
-    volt_before = volt[before_max].iloc[::50]
-
-    time_after = time[after_max].iloc[::300]
-    volt_after = volt[after_max].iloc[::300]
-
-    # Combine
-    time_root = pd.concat([time_before, time_after])
-    volt_root = pd.concat([volt_before, volt_after])
-    delta_t_root = [dt] * len(time_root)
-    delta_v_root = [dv] * len(volt_root)
+    delta_time = Uncertainty.constant(dt, len(time))
+    delta_v    = Uncertainty.constant(dv, len(volt))
+
+    # Keep the samples that best describe the rise, peak and decay. Distances are measured
+    # on a smoothed copy so noise spikes are not picked, the kept samples are the raw ones.
+    window = min(smoothing_window, len(volt))
+    window -= 1 - window % 2
+    volt_smooth = None
+    if window > smoothing_polyorder:
+        _, volt_smooth = pt.smooth_xy_data(time, volt, window_length=window, polyorder=smoothing_polyorder)
+    kept = pt.decimate_trace(time, volt, n_points=fit_points, tolerance=fit_tolerance, reference=volt_smooth)
+    time_root = time[kept]
+    volt_root = volt[kept]
+    delta_t_root = Uncertainty.constant(dt, len(time_root))
+    delta_v_root = Uncertainty.constant(dv, len(volt_root))
     root_dic = {
         "time": time_root.tolist(),
         "volt": volt_root.tolist(),
@@ -72,11 +69,13 @@ for sheet_name in tqdm(xls.sheet_names):
         "delta_v": delta_v_root
     }
 
-    T_RC = df.iloc[3, time_idx - 1]
+    T_RC = cells['T_RC']
 
+    # The analysis seeds V0, T2* and C from the samples (ft.seed_fit): these limits hold for t0 and T_RC,
+    # and for the parameters the pre-fit cannot estimate
     param_lim = {0: (15, 70), 1: (0.01, 1), 2: (1, 8), 3: (-0.3, 0.3), 4: (0.05, 0.5)}
     # 0: V0, 1: T2*, 2: C, 3: t0, 4: T_RC
-    T2_Database[sheet_name] = {
+    return {
         'time': time.tolist(),
         'volt': volt.tolist(),
         'delta_time': delta_time,
@@ -86,7 +85,32 @@ for sheet_name in tqdm(xls.sheet_names):
         'param_lim': param_lim
     }
 
-output_directory = "Pulse_NMR_61/create_databases/"
-output_file_path = output_directory + "T2_Eff_Data.json"
-with open(output_file_path, "w") as f:
-    json.dump(T2_Database, f, indent=4)
\ No newline at end of file
+
+def fingerprint_t2_eff_sheet(sheet_name: str, cells: dict) -> str:
+    """Hash of the cells build_t2_eff_material reads and of its settings."""
+    return pt.cells_fingerprint(cells, sheet_name, fit_points, fit_tolerance, smoothing_window, smoothing_polyorder)
+
+
+def build_t2_eff_database(workbooks: dict[str, dict], database: dict[str, dict] | None = None) -> tuple[dict[str, dict], list[str]]:
+    """Materials of the sheets that changed since `database` was built, and the materials to delete (see pt.ingest_workbooks)."""
+    return pt.ingest_workbooks(workbooks, measurement, build_t2_eff_material, fingerprint_t2_eff_sheet, database or {})
+
+
+def main(workbooks: dict[str, dict] | None = None) -> dict[str, dict]:
+    if workbooks is None:
+        workbooks = pt.load_workbooks(measurements_glob, pt.load_layout(layout_path))
+
+    # Only the sheets whose cells changed (or new days) are rebuilt and written; the other materials stay in the store
+    T2_Database = st.load_database(store_path)
+    new_materials, stale = build_t2_eff_database(workbooks, T2_Database)
+    st.remove_materials(store_path, stale)
+    st.save_database(new_materials, store_path)
+    for material in stale:
+        del T2_Database[material]
+    T2_Database.update(new_materials)
+    print(f"Rebuilt {len(new_materials)} of {len(T2_Database)} materials.")
+    return T2_Database
+
+
+if __name__ == '__main__':
+    main()
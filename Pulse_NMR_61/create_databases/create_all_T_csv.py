@@ -1,36 +1,65 @@
+from __future__ import annotations
+
+import sys
+import os
+sys.path.append(os.path.abspath('../../..'))
+
 import json
-import pandas as pd
 
-databases_dir: str = '/Users/liam/Documents/Lab_C/Pulse_NMR_61/create_databases/'
+from utils import lazy_import
+from utils import store_tools as st
+from utils import results_tools as rs
+
+# pandas is only imported once the table is built
+pd = lazy_import('pandas')
+
+# Relative to the repository root, like the other stages
+databases_dir: str = 'Pulse_NMR_61/create_databases/'
 t1_path: str = databases_dir + 'T1_Data.json'
-t2_path: str = databases_dir + 'T2_Data.json'
-t2_eff_path: str = databases_dir + 'T2_Eff_Data.json'
+t2_path: str = databases_dir + 'T2_Data/'
+t2_eff_path: str = databases_dir + 'T2_Eff_Data/'
+csv_path: str = databases_dir + 'all_T.csv'
+
+
+def build_results_table(T1_Data: dict, T2_Data: dict, T2_Eff_Data: dict) -> pd.DataFrame:
+    """The value and error of T1, T2 and T2* of every material, indexed by material, concentration and day (see rs.results_table)."""
+    rows_results: list[dict] = []
+
+    for material, data in T1_Data.items():
+        T1_list = list(data['params']['par1'])
+
+        data2 = T2_Data[material]
+        T2_list = list(data2['params']['par1'])
+
+        data_eff = T2_Eff_Data[material]
+        T2_eff_list= [data_eff['params']['1'][0], data_eff['params']['1'][1]*1e3]
 
-with open(t1_path, "r") as f:
-    T1_Data: dict = json.load(f)
-with open(t2_path, "r") as f:
-    T2_Data : dict = json.load(f)
-with open(t2_eff_path, "r") as f:
-    T2_Eff_Data: dict = json.load(f)
+        rows_results.append({
+            'material': material,
+            'sheet': data.get('sheet'),
+            'day': data.get('day'),
+            'T1': T1_list,
+            'T2': T2_list,
+            'T2_Eff': T2_eff_list
+        })
 
-cols_results: list = ['material', 'T1', 'T2', 'T2_Eff']
-rows_results: dict = []
+    return rs.results_table(rows_results)
 
-for material, data in T1_Data.items():
-    T1_list = data['params']['par1']
 
-    data2 = T2_Data[material]
-    T2_list = data2['params']['par1']
+def main(T1_Data: dict | None = None, T2_Data: dict | None = None, T2_Eff_Data: dict | None = None) -> pd.DataFrame:
+    if T1_Data is None:
+        with open(t1_path, "r") as f:
+            T1_Data = json.load(f)
+    # Only the fitted results are needed, so the traces are never read
+    if T2_Data is None:
+        T2_Data = st.load_meta(t2_path)
+    if T2_Eff_Data is None:
+        T2_Eff_Data = st.load_meta(t2_eff_path)
 
-    data_eff = T2_Eff_Data[material]
-    T2_eff_list= [data_eff['params']['1'][0], data_eff['params']['1'][1]*1e3]
+    df_res = build_results_table(T1_Data, T2_Data, T2_Eff_Data)
+    rs.write_results(df_res, csv_path)
+    return df_res
 
-    rows_results.append({
-        'material': material,
-        'T1': T1_list,
-        'T2': T2_list,
-        'T2_Eff': T2_eff_list
-    })
 
-df_res = pd.DataFrame(rows_results, columns=cols_results)
-df_res.to_csv('/Users/liam/Documents/Lab_C/Pulse_NMR_61/create_databases/all_T.csv', index=False)
\ No newline at end of file
+if __name__ == '__main__':
+    main()
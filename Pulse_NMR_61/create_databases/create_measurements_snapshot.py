@@ -0,0 +1,24 @@
+import sys
+import os
+sys.path.append(os.path.abspath('../../..'))
+
+from utils import pandas_tools as pt
+
+# Every workbook matching the pattern is ingested, one day per workbook (Measurements_day_<N>.xlsx)
+measurements_glob = "Pulse_NMR_61/Measurements/Measurements_day_*.xlsx"
+# Cell ranges of every measurement (T1, T2, T2*) in a sheet; only these cells are read
+layout_path = "Pulse_NMR_61/create_databases/sheet_layout.json"
+# Worker processes parsing new workbooks (None: one per CPU, 1: parse serially)
+parse_workers: int | None = None
+
+
+def main(workers: int | None = parse_workers) -> dict[str, dict]:
+    # Read the layout's ranges of every new or edited workbook once, concurrently; the create_* builders read these cached snapshots
+    workbooks = pt.load_workbooks(measurements_glob, pt.load_layout(layout_path), workers=workers)
+    for day, workbook in workbooks.items():
+        print(f"Day {day}: {len(workbook['sheets'])} sheets of {os.path.basename(workbook['file'])}.")
+    return workbooks
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,143 @@
+import sys
+import os
+sys.path.append(os.path.abspath('../../..'))
+
+from tqdm import tqdm
+import numpy as np
+
+from utils import pandas_tools as pt
+from utils import model_tools as mt
+
+filename = "Pulse_NMR_61/Measurements/Synthetic_measurements.xlsx"
+n_sheets: int = 9
+n_points: int = 20_000  # Samples per T2 and T2* trace
+seed: int = 0
+
+# Physical parameters of a sample at concentration c (times in ms, voltages in V); T1 and T2 scale as 1 / c
+concentrations = [8, 4, 2, 1, 0.5, 0.25, 0.125]
+base_params = {
+    'T1': 12.5, 'A1': 15.,                                              # Inversion recovery, T1 = 12.5 / c
+    'T2': 13., 'A2': 30., 'C2': 3., 'tau': 0.5, 'echo_width': 0.02,     # CPMG echo train, T2 = 13 / c
+    'T2_eff': 0.15, 'A2_eff': 40., 'C2_eff': 2.5, 't0': 0.01, 'T_RC': 0.1,  # RC-filtered FID
+    'repetition_time': 100.,
+    'noise': 0.2,
+}
+# T1 delays, in units of T1; 0.69 is the zero crossing the T1 builder looks for
+t1_delays = [0.06, 0.13, 0.3, 0.45, 0.69, 1., 1.5, 2., 3.2, 4., 5.]
+# Sampling of the echo train: the trace holds at most n_points / min_samples_per_echo echoes
+min_samples_per_echo: int = 50
+
+# Layout of Measurements_day_3.xlsx: every sheet is read with its first row as the header, so
+# DataFrame row r is Excel row r + 2. Columns are 0-based indices, rows are Excel (1-based) rows.
+t1_col = pt.excel_col_to_index('T')         # tau, delta_tau, volt, delta_v in T:W, rows 8-19
+t1_first_row = 8
+t1_max_points = 12
+t2_col = pt.excel_col_to_index('AA')        # time [s], volt in AA:AB from row 10; tau in AA5, repetition time in AD5
+t2_first_row = 10
+t2_eff_col = pt.excel_col_to_index('K')     # time [s], volt in K:L from row 8; T_RC in J5
+t2_eff_first_row = 8
+parameter_row = 5
+excel_max_rows = 1_048_576
+
+
+def sample_parameters(n_sheets: int) -> dict[str, dict]:
+    """Names and physical parameters of `n_sheets` samples, cycling through the concentrations."""
+    samples = {}
+    for i in range(n_sheets):
+        cycle, c = divmod(i, len(concentrations))
+        c = concentrations[c]
+        name = f'{c:g} para' if cycle == 0 else f'{c:g} para ({cycle + 1})'
+        samples[name] = {**base_params, 'T1': base_params['T1'] / c, 'T2': base_params['T2'] / c}
+    return samples
+
+
+def t1_points(params: dict, rng: np.random.Generator) -> list[tuple[float, ...]]:
+    """(tau, delta_tau, volt, delta_v) of the inversion recovery, measured as a magnitude."""
+    tau = np.round(params['T1'] * np.array(t1_delays), 3)
+    volt = mt.inversion_recovery(tau, [params['A1'], params['T1']]) + rng.normal(0, params['noise'], len(tau))
+    return [(t, 0.01, round(abs(v), 2), 0.2) for t, v in zip(tau, volt)]
+
+def t2_trace(params: dict, n_points: int, rng: np.random.Generator) -> tuple[np.ndarray, np.ndarray]:
+    """CPMG echo train over about four T2 (fewer echoes if they would be undersampled), as (time [s], volt)."""
+    n_echoes = max(min(int(4 * params['T2'] / (2 * params['tau'])), n_points // min_samples_per_echo), 1)
+    time = np.linspace(0, (n_echoes + 0.5) * 2 * params['tau'], n_points)
+    volt = mt.echo_train(time, [params['A2'], params['T2'], params['C2'], params['tau'], params['echo_width']])
+    return time * 1e-3, volt + rng.normal(0, params['noise'], n_points)
+
+def t2_eff_trace(params: dict, n_points: int, rng: np.random.Generator) -> tuple[np.ndarray, np.ndarray]:
+    """RC-filtered FID, with a short baseline before the pulse, as (time [s], volt)."""
+    time = np.linspace(-0.1, 10 * params['T2_eff'], n_points)
+    p = [params['A2_eff'], params['T2_eff'], params['C2_eff'], params['t0'], params['T_RC']]
+    volt = np.where(time < params['t0'], params['C2_eff'], mt.rc_fid(time, p))
+    return time * 1e-3, volt + rng.normal(0, params['noise'], n_points)
+
+
+def sheet_rows(params: dict, n_points: int, rng: np.random.Generator):
+    """Yields the rows of one sheet, from Excel row 1, in the layout of the measurements workbook."""
+    t1 = t1_points(params, rng)[:t1_max_points]
+    t2_time, t2_volt = t2_trace(params, n_points, rng)
+    t2_eff_time, t2_eff_volt = t2_eff_trace(params, n_points, rng)
+
+    cells: dict[int, dict[int, object]] = {
+        1: {0: 'Synthetic measurements'},  # Header row; also fixes the sheet's origin at A1
+        parameter_row - 1: {t2_eff_col - 1: 'T_RC [ms]', t2_col: 'tau [ms]', t2_col + 3: 'Repetition time [ms]'},
+        parameter_row: {t2_eff_col - 1: params['T_RC'], t2_col: params['tau'], t2_col + 3: params['repetition_time']},
+        t1_first_row - 1: {t1_col: 'tau [ms]', t1_col + 1: 'delta tau', t1_col + 2: 'V [V]', t1_col + 3: 'delta V',
+                           t2_eff_col: 'time [s]', t2_eff_col + 1: 'V [V]'},
+        t2_first_row - 1: {t2_col: 'time [s]', t2_col + 1: 'V [V]'},
+    }
+    for i, values in enumerate(t1):
+        cells.setdefault(t1_first_row + i, {}).update(zip(range(t1_col, t1_col + 4), values))
+
+    last_row = max(t2_first_row, t2_eff_first_row) + n_points - 1
+    for row in range(1, last_row + 1):
+        cell = dict(cells.get(row, ()))
+        i = row - t2_eff_first_row
+        if 0 <= i < n_points:
+            cell[t2_eff_col], cell[t2_eff_col + 1] = float(t2_eff_time[i]), float(t2_eff_volt[i])
+        i = row - t2_first_row
+        if 0 <= i < n_points:
+            cell[t2_col], cell[t2_col + 1] = float(t2_time[i]), float(t2_volt[i])
+        values = [None] * (max(cell) + 1 if cell else 0)
+        for col, value in cell.items():
+            values[col] = value
+        yield values
+
+
+def write_workbook(filename: str, samples: dict[str, dict], n_points: int, seed: int = 0) -> None:
+    """
+    Writes a workbook in the layout of the measurements, one sheet per sample.
+
+    Args:
+        filename (str): Path of the .xlsx file to write.
+        samples (dict[str, dict]): Sheet name -> physical parameters, see `base_params`.
+        n_points (int): Samples per T2 and T2* trace.
+        seed (int, optional): Seed of the measurement noise. Defaults to 0.
+    """
+    from openpyxl import Workbook  # Imported here so importing the script stays cheap
+
+    if max(t2_first_row, t2_eff_first_row) + n_points - 1 > excel_max_rows:
+        raise ValueError(f"{n_points} samples per trace do not fit in a sheet of {excel_max_rows} rows.")
+
+    rng = np.random.default_rng(seed)
+    workbook = Workbook(write_only=True)  # Rows are streamed to disk, so any trace length fits in memory
+    for name, params in tqdm(samples.items()):
+        sheet = workbook.create_sheet(name)
+        for values in sheet_rows(params, n_points, rng):
+            sheet.append(values)
+
+    os.makedirs(os.path.dirname(filename) or '.', exist_ok=True)
+    workbook.save(filename)
+
+
+def main(filename: str = filename, n_sheets: int = n_sheets, n_points: int = n_points, seed: int = seed) -> dict[str, dict]:
+    samples = sample_parameters(n_sheets)
+    write_workbook(filename, samples, n_points, seed)
+    print(f"Wrote {n_sheets} sheets of {n_points} samples to {filename}.")
+    return samples
+
+
+if __name__ == '__main__':
+    # python create_synthetic_workbook.py [n_sheets] [n_points]
+    main(n_sheets=int(sys.argv[1]) if len(sys.argv) > 1 else n_sheets,
+         n_points=int(sys.argv[2]) if len(sys.argv) > 2 else n_points)
@@ -1,36 +1,105 @@
-import subprocess
+import sys
 import os
+import argparse
 from time import time
 
-start_time = time()
-# List your Python scripts in the desired order
-scripts = [
-    "Pulse_NMR_61/create_databases/create_T1_database.py",
-    "Pulse_NMR_61/create_databases/create_T2_database.py",
-    "Pulse_NMR_61/create_databases/create_T2_eff_database.py",
-    "Pulse_NMR_61/analysing_data/t1_analysis.py",
-    "Pulse_NMR_61/analysing_data/t2_analysis_peaks.py",
-    "Pulse_NMR_61/analysing_data/t2_analysis.py",
-    "Pulse_NMR_61/analysing_data/t2_eff_analysis.py",
-    "Pulse_NMR_61/create_databases/create_all_T_csv.py",
-    "Pulse_NMR_61/analysing_data/magnetic_field_analysis.py"
+# The stages are imported as modules, so the repository root must be importable
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils import pipeline_tools as pl
+from utils import profile_tools as pf
+from Pulse_NMR_61.create_databases import (
+    create_measurements_snapshot, create_T1_database, create_T2_database,
+    create_T2_eff_database, create_all_T_csv
+)
+from Pulse_NMR_61.analysing_data import (
+    t1_analysis, t2_analysis_peaks, t2_analysis, t2_eff_analysis, magnetic_field_analysis
+)
+
+# Number of worker processes for the per-material fits (None: one per CPU, 1: fit serially)
+fit_workers: int | None = None
+# 'root' fits with Minuit and draws the ROOT canvases, 'numpy' fits with SciPy only (no ROOT needed),
+# 'batch' fits all materials of a stage as one stacked SciPy problem (no plots)
+fit_backend: str = 'root'
+# Fits whose data, formula and limits are unchanged are read from the fit cache; True refits everything
+refit: bool = False
+# Tune the envelope settings of every sample without valid tuned settings by a parallel sweep of the T2 fits
+# (see t2_analysis_peaks.py); otherwise untuned samples keep the hand-tuned defaults
+autotune_envelopes: bool = False
+# Replicates per material of the bootstrap errors, stored as 'bootstrap' next to 'params' (0: covariance errors only)
+bootstrap_replicates: int = 0
+# Every stage, material and phase (read, fit, peaks, render, write) is recorded with its wall and CPU time,
+# peak memory and fit counters, as JSON lines plus a Chrome trace (chrome://tracing, Perfetto); None disables it
+profile_path: str | None = 'Pulse_NMR_61/profile/run.jsonl'
+# With --watch the measurement workbooks are polled every watch_interval seconds and the pipeline reruns when one
+# is saved; only the edited sheets are rebuilt, refitted and redrawn, the aggregates are recomputed from all materials
+watch_interval: float = 1.
+
+# Each stage declares the results it consumes and produces; independent branches
+# (T1 versus T2 versus T2*) run concurrently. ROOT keeps global state, so with the 'root'
+# backend the stages using it are serialised on a shared lock; the SciPy backends need no
+# lock. matplotlib plots are drawn on bare Figures (no pyplot), which are not shared either.
+root_resources: tuple[str, ...] = ('ROOT',) if fit_backend == 'root' else ()
+stages = [
+    pl.Stage("create_measurements_snapshot.py", create_measurements_snapshot.main,
+             outputs=('workbooks',)),
+    pl.Stage("create_T1_database.py", create_T1_database.main,
+             inputs=('workbooks',), outputs=('T1_Data',)),
+    pl.Stage("create_T2_database.py", create_T2_database.main,
+             inputs=('workbooks',), outputs=('T2_Data',)),
+    pl.Stage("create_T2_eff_database.py", create_T2_eff_database.main,
+             inputs=('workbooks',), outputs=('T2_Eff_Data',)),
+    pl.Stage("t1_analysis.py",
+             lambda T1_Data: t1_analysis.main(T1_Data, workers=fit_workers, backend=fit_backend, refit=refit,
+                                              bootstrap=bootstrap_replicates),
+             inputs=('T1_Data',), outputs=('T1_Results',), resources=root_resources),
+    pl.Stage("t2_analysis_peaks.py", lambda T2_Data: t2_analysis_peaks.main(T2_Data, tune=autotune_envelopes),
+             inputs=('T2_Data',), outputs=('T2_Envelopes',)),
+    pl.Stage("t2_analysis.py",
+             lambda T2_Envelopes: t2_analysis.main(T2_Envelopes, workers=fit_workers, backend=fit_backend, refit=refit,
+                                                   bootstrap=bootstrap_replicates),
+             inputs=('T2_Envelopes',), outputs=('T2_Results',), resources=root_resources),
+    pl.Stage("t2_eff_analysis.py",
+             lambda T2_Eff_Data: t2_eff_analysis.main(T2_Eff_Data, workers=fit_workers, backend=fit_backend, refit=refit,
+                                                      bootstrap=bootstrap_replicates),
+             inputs=('T2_Eff_Data',), outputs=('T2_Eff_Results',), resources=root_resources),
+    pl.Stage("create_all_T_csv.py",
+             lambda T1_Results, T2_Results, T2_Eff_Results: create_all_T_csv.main(T1_Results, T2_Results, T2_Eff_Results),
+             inputs=('T1_Results', 'T2_Results', 'T2_Eff_Results'), outputs=('all_T',)),
+    pl.Stage("magnetic_field_analysis.py", lambda all_T: magnetic_field_analysis.main(df=all_T, backend=fit_backend),
+             inputs=('all_T',), outputs=('magnetic_field',), resources=root_resources),
 ]
 
-# Loop through and run each script
-for path in scripts:
-    script = os.path.basename(path)
-    print(f"Running {script}...")
-    result = subprocess.run(["python", path])
-    if result.returncode != 0:
-        print(f"Error running {path}, stopped.")
-        break
-    print(f"Finished {script}.\n")
-
-run_time = time() - start_time
-
-if run_time >= 60:
-    minutes = int(run_time // 60)
-    seconds = run_time % 60
-    print(f"Data analysis took {minutes} minutes and {seconds:.2f} seconds.")
-else:
-    print(f"Data analysis took {run_time:.2f} seconds.")
\ No newline at end of file
+
+def run() -> dict:
+    """Runs every stage once and prints the timings; returns the stages' results."""
+    if profile_path is not None:
+        pf.enable(profile_path)
+    start_time = time()
+    try:
+        results, timings = pl.run_pipeline(stages)
+    finally:
+        run_time = time() - start_time
+        if profile_path is not None:
+            pf.write_chrome_trace(profile_path, profile_path.removesuffix('.jsonl') + '.trace.json')
+
+    pl.print_timings(timings)
+    if profile_path is not None:
+        pf.print_summary(profile_path)
+    print(f"Data analysis took {pl.format_duration(run_time)}.")
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Runs the Pulsed NMR analysis.")
+    parser.add_argument('--watch', action='store_true',
+                        help="rerun whenever a measurements workbook is saved, on the changed sheets only")
+    args = parser.parse_args()
+
+    if args.watch:
+        # Fit in this process: after the first run only a few materials change at a time,
+        # and starting a pool of worker processes for each run would cost more than their fits
+        fit_workers = 1
+        pl.watch(create_measurements_snapshot.measurements_glob, run, interval=watch_interval)
+    else:
+        run()
@@ -0,0 +1,5 @@
+import sys
+import os
+
+# The scripts import `utils` and `Pulse_NMR_61` from the repository root
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,26 @@
+import numpy as np
+import pytest
+
+from Pulse_NMR_61.create_databases import create_T2_eff_database as t2e
+
+
+def fid_cells(n_points: int) -> dict:
+    """Cells of a sheet with an RC-filtered FID of n_points samples, in seconds and volts."""
+    time = np.linspace(-1e-4, 2e-3, n_points)
+    t = np.clip(time * 1e3, 0, None)
+    volt = 30 * (1 - np.exp(-t / 0.05)) * np.exp(-t / 0.4) + 3
+    return {'time': time, 'volt': volt, 'T_RC': 0.1}
+
+
+@pytest.mark.parametrize('n_points', [25, 31, 32, 4, 3])
+def test_short_traces_are_built(n_points):
+    material = t2e.build_t2_eff_material('water', fid_cells(n_points))
+    root_data = material['root_data']
+    assert 0 < len(root_data['time']) <= len(material['time'])
+    assert len(root_data['delta_v']) == len(root_data['volt']) == len(root_data['time'])
+
+
+def test_long_traces_keep_the_point_budget():
+    material = t2e.build_t2_eff_material('water', fid_cells(5000))
+    assert len(material['root_data']['time']) == t2e.fit_points
+    assert np.all(np.diff(material['root_data']['time']) > 0)
@@ -0,0 +1,80 @@
+import os
+import json
+
+import numpy as np
+import pytest
+
+from utils import export_tools as et
+from utils.uncertainty_tools import Uncertainty
+
+
+def render(file_path: str, data: np.ndarray, title: str = '') -> None:
+    with open(file_path, 'w') as f:
+        f.write(f"{title} {data.sum()}")
+
+def broken(file_path: str) -> None:
+    raise RuntimeError("cannot draw")
+
+
+def read_manifest(manifest: str) -> dict:
+    with open(manifest, 'r') as f:
+        return json.load(f)
+
+def read_figure(path: str) -> str:
+    with open(path, 'r') as f:
+        return f.read()
+
+def export(manifest, path, data, title='', **kwargs) -> tuple[int, int]:
+    with et.ExportQueue(manifest, **kwargs) as queue:
+        queue.submit(path, render, path, data, title=title)
+    return queue.written, queue.skipped
+
+
+def test_unchanged_figures_are_skipped(tmp_path):
+    manifest, path = str(tmp_path / et.MANIFEST_FILE), str(tmp_path / 'fig.txt')
+    data = np.linspace(0, 1, 100)
+    assert export(manifest, path, data) == (1, 0)
+    assert read_manifest(manifest)[path] == et.inputs_hash(render.__module__, render.__qualname__, path, (path, data), {'title': ''})
+
+    assert export(manifest, path, data.copy()) == (0, 1)
+
+def test_changed_or_missing_figures_are_redrawn(tmp_path):
+    manifest, path = str(tmp_path / et.MANIFEST_FILE), str(tmp_path / 'fig.txt')
+    data = np.linspace(0, 1, 100)
+    export(manifest, path, data)
+
+    edited = data.copy()
+    edited[50] += 1e-9
+    assert export(manifest, path, edited) == (1, 0)
+    assert export(manifest, path, edited, title='T2') == (1, 0)
+    assert export(manifest, path, edited.astype(np.float32), title='T2') == (1, 0)
+
+    os.remove(path)
+    assert export(manifest, path, edited.astype(np.float32), title='T2') == (1, 0)
+    assert os.path.exists(path)
+
+def test_failed_renders_are_not_recorded(tmp_path):
+    manifest, path = str(tmp_path / et.MANIFEST_FILE), str(tmp_path / 'fig.txt')
+    with pytest.raises(RuntimeError):
+        with et.ExportQueue(manifest) as queue:
+            queue.submit(path, broken, path)
+    assert read_manifest(manifest) == {}
+
+def test_queues_share_a_manifest(tmp_path):
+    manifest = str(tmp_path / et.MANIFEST_FILE)
+    paths = [str(tmp_path / f'fig_{i}.txt') for i in range(2)]
+    for path in paths:
+        export(manifest, path, np.arange(3.))
+    assert sorted(read_manifest(manifest)) == paths
+
+def test_renders_in_a_worker_process(tmp_path):
+    manifest, path = str(tmp_path / et.MANIFEST_FILE), str(tmp_path / 'fig.txt')
+    assert export(manifest, path, np.arange(3.), processes=True) == (1, 0)
+    assert read_figure(path) == ' 3.0'
+    assert export(manifest, path, np.arange(3.)) == (0, 1)
+
+def test_inputs_hash_uses_compact_uncertainties():
+    error = Uncertainty.constant(0.1, 1000)
+    assert et.inputs_hash(error) == et.inputs_hash(Uncertainty.constant(0.1, 1000))
+    assert et.inputs_hash(error) != et.inputs_hash(Uncertainty.constant(0.2, 1000))
+    assert et.inputs_hash({'b': 1, 'a': 2}) == et.inputs_hash({'a': 2, 'b': 1})
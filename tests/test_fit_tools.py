@@ -0,0 +1,122 @@
+import os
+
+import numpy as np
+import pytest
+
+from utils import fit_tools as ft
+
+fit_str = '[0] * exp(- x / [1]) + [2]'
+par_limits = {0: (0., 20.), 1: (0.1, 50.), 2: (-5., 5.)}
+
+
+def envelope(seed: int = 0, n: int = 40) -> tuple:
+    rng = np.random.default_rng(seed)
+    x = np.linspace(0.5, 20, n)
+    dy = np.full(n, 0.1)
+    y = 8 * np.exp(-x / 4) + 0.3 + rng.normal(0, 0.1, n)
+    return x, y, np.zeros(n), dy
+
+
+@pytest.fixture
+def no_fits(monkeypatch):
+    """Makes any actual fit fail, so a result can only come from the cache."""
+    def fit(*args, **kwargs):
+        pytest.fail("the fit was run instead of read from the cache")
+    def enable():
+        monkeypatch.setattr(ft.optimize, 'curve_fit', fit)
+    return enable
+
+
+def test_cached_fit_is_reused(tmp_path, no_fits):
+    cache = ft.FitCache(str(tmp_path))
+    data = envelope()
+    fitted = ft.fit_formula(data, fit_str, par_limits, cache=cache)
+
+    no_fits()
+    cached = ft.fit_formula(tuple(np.copy(column) for column in data), fit_str, par_limits, cache=cache)
+    assert cached['popt'] == fitted['popt'] and cached['fitted_params'] == fitted['fitted_params']
+    assert cached['function'](np.array([1.]), cached['popt']) == pytest.approx(fitted['function'](np.array([1.]), fitted['popt']))
+
+def test_fit_key_follows_every_input():
+    data = envelope()
+    key = ft.fit_key('scipy', data, fit_str, par_limits)
+    assert key == ft.fit_key('scipy', tuple(list(column) for column in data), fit_str, par_limits)
+
+    edited = tuple(np.copy(column) for column in data)
+    edited[1][3] += 1e-12
+    assert key != ft.fit_key('scipy', edited, fit_str, par_limits)
+    assert key != ft.fit_key('root', data, fit_str, par_limits)
+    assert key != ft.fit_key('scipy', data, fit_str + ' + 0', par_limits)
+    assert key != ft.fit_key('scipy', data, fit_str, {**par_limits, 1: (0.1, 40.)})
+    assert key != ft.fit_key('scipy', data, fit_str, par_limits, {1: 3.})
+
+def test_changed_inputs_are_refitted(tmp_path):
+    cache = ft.FitCache(str(tmp_path))
+    data = envelope()
+    ft.fit_formula(data, fit_str, par_limits, cache=cache)
+    ft.fit_formula(envelope(seed=1), fit_str, par_limits, cache=cache)
+    ft.fit_formula(data, fit_str, {**par_limits, 2: (-1., 1.)}, cache=cache)
+    ft.fit_formula(data, fit_str, par_limits, initial={1: 3.}, cache=cache)
+    assert len(os.listdir(tmp_path)) == 4
+
+def test_refresh_refits_and_stores(tmp_path, no_fits):
+    data = envelope()
+    ft.fit_formula(data, fit_str, par_limits, cache=ft.FitCache(str(tmp_path)))
+    key = ft.fit_key('scipy', data, fit_str, par_limits, None, 5)
+    ft.FitCache(str(tmp_path)).put(key, {'popt': [0., 0., 0.]})
+
+    refreshed = ft.fit_formula(data, fit_str, par_limits, cache=ft.FitCache(str(tmp_path), refresh=True))
+    assert refreshed['popt'] != [0., 0., 0.]
+    no_fits()
+    assert ft.fit_formula(data, fit_str, par_limits, cache=ft.FitCache(str(tmp_path)))['popt'] == refreshed['popt']
+
+def test_least_recently_used_results_are_evicted(tmp_path):
+    cache = ft.FitCache(str(tmp_path), max_bytes=1 << 20)
+    for i, key in enumerate('abc'):
+        cache.put(key, np.zeros(40_000))  # About 320 kB each
+        os.utime(cache._path(key), (i, i))
+    assert cache.get('a') is not None  # Now the most recently used
+
+    cache.put('d', np.zeros(40_000))
+    assert sorted(os.listdir(tmp_path)) == ['a.pkl', 'c.pkl', 'd.pkl']
+
+    cache.clear()
+    assert cache.get('a') is None and os.listdir(tmp_path) == []
+
+def test_unreadable_results_are_misses(tmp_path):
+    cache = ft.FitCache(str(tmp_path))
+    with open(cache._path('broken'), 'wb') as f:
+        f.write(b'not a pickle')
+    assert cache.get('broken') is None
+    assert ft.FitCache(str(tmp_path / 'missing')).get('key') is None
+
+
+@pytest.fixture(scope='module')
+def bootstrap_data() -> dict[str, tuple]:
+    return {'8 para day 1': envelope(seed=2), '4 para day 1': envelope(seed=3, n=30)}
+
+
+@pytest.mark.parametrize('method', ft.BOOTSTRAP_METHODS)
+def test_bootstrap_does_not_depend_on_workers(bootstrap_data, method):
+    kwargs = dict(n_replicates=60, method=method, seed=7, chunk_size=25)
+    serial = ft.bootstrap(bootstrap_data, fit_str, par_limits, workers=1, **kwargs)
+    parallel = ft.bootstrap(bootstrap_data, fit_str, par_limits, workers=2, **kwargs)
+    assert parallel == serial
+    assert list(serial) == list(bootstrap_data)
+    assert serial['8 para day 1']['replicates'] == 60 and serial['8 para day 1']['converged'] > 50
+
+def test_bootstrap_follows_the_seed(bootstrap_data):
+    first = ft.bootstrap(bootstrap_data, fit_str, par_limits, n_replicates=40, seed=1, chunk_size=20)
+    assert first == ft.bootstrap(bootstrap_data, fit_str, par_limits, n_replicates=40, seed=1, chunk_size=20)
+    assert first != ft.bootstrap(bootstrap_data, fit_str, par_limits, n_replicates=40, seed=2, chunk_size=20)
+
+def test_bootstrap_errors_match_the_fit(bootstrap_data):
+    data = bootstrap_data['8 para day 1']
+    errors = ft.bootstrap({'8 para day 1': data}, fit_str, par_limits, n_replicates=400, seed=0)['8 para day 1']['errors']
+    perr = ft.fit_formula(data, fit_str, par_limits)['perr']
+    for i, err in enumerate(perr):
+        assert errors[f'par{i}'] == pytest.approx(err, rel=0.25)
+
+def test_unknown_bootstrap_method(bootstrap_data):
+    with pytest.raises(ValueError):
+        ft.bootstrap(bootstrap_data, fit_str, par_limits, method='jackknife')
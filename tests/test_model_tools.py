@@ -0,0 +1,89 @@
+import numpy as np
+import pytest
+
+from utils import fit_tools as ft
+from utils import model_tools as mt
+
+# Parameters and x ranges of each library model, as in the measurements
+cases = {
+    'abs([0] * (1 - 2 * exp(- x / [1])))': ((6., 40.), np.linspace(1., 200., 60)),
+    '[0] * exp(- x / [1]) + [2]': ((8., 15., 0.3), np.linspace(0.5, 60., 50)),
+    '[0] * (1 - exp(- (x - [3]) / [4])) * exp(- (x - [3]) / [1]) + [2]': ((5., 2e-3, 0.1, 1e-4, 3e-4), np.linspace(2e-4, 1e-2, 80)),
+}
+
+
+@pytest.mark.parametrize('fit_str', cases)
+def test_function_matches_the_formula(fit_str):
+    params, x = cases[fit_str]
+    model = mt.get_model(fit_str)
+    np.testing.assert_allclose(model.function(x, params), ft.compile_formula(fit_str)(x, params), rtol=1e-12)
+    assert len(model.param_names) == ft.count_parameters(fit_str)
+
+@pytest.mark.parametrize('fit_str', cases)
+def test_jacobian_matches_central_differences(fit_str):
+    params, x = cases[fit_str]
+    model = mt.get_model(fit_str)
+    jacobian = model.jacobian(x, params)
+    assert jacobian.shape == (len(x), len(params))
+    for i, value in enumerate(params):
+        step = 1e-6 * abs(value)
+        up, down = list(params), list(params)
+        up[i], down[i] = value + step, value - step
+        numeric = (model.function(x, up) - model.function(x, down)) / (2 * step)
+        np.testing.assert_allclose(jacobian[:, i], numeric, rtol=1e-5, atol=1e-7 * np.max(np.abs(numeric)))
+
+def test_models_are_found_by_formula():
+    assert mt.get_model(' [0]*exp(-x/[1])  + [2]') is mt.MODELS[1]
+    assert mt.get_model('[0] * exp(- x / [1])') is None
+
+def test_fits_use_the_closed_form_gradient(monkeypatch):
+    params, x = cases['[0] * exp(- x / [1]) + [2]']
+    model = mt.get_model('[0] * exp(- x / [1]) + [2]')
+    calls = []
+    monkeypatch.setattr(ft.mt, 'get_model', lambda fit_str: mt.Model(model.fit_str, model.param_names, model.function,
+                                                                      lambda *args: calls.append(1) or model.jacobian(*args)))
+    data = x, model.function(x, params), np.zeros_like(x), np.full_like(x, 0.05)
+    result = ft.fit_formula(data, model.fit_str, {0: (1., 20.), 1: (1., 50.), 2: (-1., 1.)})
+    assert calls
+    np.testing.assert_allclose(result['popt'], params, rtol=1e-6)
+
+
+def noisy(fit_str: str, noise: float, seed: int = 0) -> tuple:
+    params, x = cases[fit_str]
+    y = mt.get_model(fit_str).function(x, params)
+    dy = np.full_like(x, noise * np.max(np.abs(y)))
+    return x, y + np.random.default_rng(seed).normal(0, 1, len(x)) * dy, np.zeros_like(x), dy
+
+
+@pytest.mark.parametrize('fit_str', cases)
+@pytest.mark.parametrize('noise', [0., 0.02])
+def test_seed_brackets_the_true_parameters(fit_str, noise):
+    params, _ = cases[fit_str]
+    x, y, _, dy = noisy(fit_str, noise)
+    start, limits = mt.get_model(fit_str).seed(x, y, dy)
+    assert start, "the pre-fit found nothing"
+    for i, value in start.items():
+        assert value == pytest.approx(params[i], rel=0.3, abs=0.1 * params[0])  # Offsets and t0 are near 0
+    for i, (low, high) in limits.items():
+        assert low <= params[i] <= high and low <= start[i] <= high
+
+def test_seed_gives_up_on_data_without_decay():
+    x = np.linspace(1., 10., 20)
+    for model in mt.MODELS:
+        assert model.seed(x, np.full_like(x, 2.), np.full_like(x, 0.1)) == ({}, {})
+        assert model.seed(x[:2], x[:2], x[:2]) == ({}, {})
+
+@pytest.mark.parametrize('fit_str', cases)
+def test_seeded_fit_starts_inside_the_limits(fit_str):
+    params, _ = cases[fit_str]
+    wide = {i: (-1e3, 1e3) if i in (2, 3) else (1e-6, 1e3) for i in range(len(params))}
+    limits, start = ft.seed_fit(noisy(fit_str, 0.02), fit_str, wide, {0: -5e3})
+    assert set(limits) == set(wide)
+    for i, value in start.items():
+        assert limits[i][0] <= value <= limits[i][1]
+    result = ft.fit_formula(noisy(fit_str, 0.02), fit_str, limits, initial=start)
+    np.testing.assert_allclose(result['popt'][:2], params[:2], rtol=0.1)
+
+def test_formulas_without_a_model_keep_their_limits():
+    limits, start = ft.seed_fit(noisy('[0] * exp(- x / [1]) + [2]', 0.), 'x / ([0] * x + 1)', {'0': (0., 2.)}, {'0': 5.})
+    assert limits == {0: (0., 2.)} and start == {0: 2.}
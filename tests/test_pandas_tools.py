@@ -0,0 +1,141 @@
+import os
+import sys
+import subprocess
+
+import numpy as np
+import pytest
+
+from utils import pandas_tools as pt
+from Pulse_NMR_61.create_databases import create_synthetic_workbook as sw
+
+layout_path = 'Pulse_NMR_61/create_databases/sheet_layout.json'
+
+
+@pytest.fixture(scope='module')
+def layout():
+    return pt.load_layout(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), layout_path))
+
+
+def write_day(path, seed: int = 0, n_sheets: int = 2) -> str:
+    sw.write_workbook(str(path), sw.sample_parameters(n_sheets), n_points=200, seed=seed)
+    return str(path)
+
+
+def test_snapshot_is_read_once(tmp_path, layout, monkeypatch):
+    workbook = write_day(tmp_path / 'Measurements_day_1.xlsx')
+    cache = str(tmp_path / 'cache')
+    first = pt.load_workbook_snapshot(workbook, layout, cache)
+    assert list(first) == ['8 para', '4 para']
+    assert len(first['8 para']['T2']['time']) == 200
+
+    monkeypatch.setattr(pt, 'read_ranges', lambda *args: pytest.fail("an unchanged workbook was parsed again"))
+    second = pt.load_workbook_snapshot(workbook, layout, cache)
+    np.testing.assert_array_equal(second['4 para']['T2']['volt'], first['4 para']['T2']['volt'])
+    assert second['8 para']['T2']['tau'] == first['8 para']['T2']['tau']
+
+
+def test_snapshot_follows_the_content_and_the_layout(tmp_path, layout):
+    workbook = write_day(tmp_path / 'Measurements_day_1.xlsx')
+    cache = str(tmp_path / 'cache')
+    first = pt.load_workbook_snapshot(workbook, layout, cache)
+
+    # Edited workbook: new content hash, new snapshot
+    write_day(tmp_path / 'Measurements_day_1.xlsx', seed=1)
+    edited = pt.load_workbook_snapshot(workbook, layout, cache)
+    assert not np.array_equal(edited['8 para']['T2']['volt'], first['8 para']['T2']['volt'])
+
+    # Edited layout: the same workbook is read again with the new ranges
+    narrow = {**layout, 'T2': {**layout['T2'], 'time': 'AA10:AA19'}}
+    assert pt.snapshot_path(pt.file_sha256(workbook), narrow, cache) != pt.snapshot_path(pt.file_sha256(workbook), layout, cache)
+    assert len(pt.load_workbook_snapshot(workbook, narrow, cache)['8 para']['T2']['time']) == 10
+
+
+def test_only_edited_sheets_are_rebuilt(tmp_path, layout):
+    cache = str(tmp_path / 'cache')
+    day_1 = write_day(tmp_path / 'Measurements_day_1.xlsx')
+    workbooks = pt.load_workbooks(str(tmp_path / 'Measurements_day_*.xlsx'), layout, cache, workers=1)
+    built = []
+    def build(sheet_name, cells):
+        built.append(sheet_name)
+        return {'tau': cells['tau']}
+    fingerprint = lambda sheet_name, cells: pt.cells_fingerprint(cells)
+
+    database, stale = pt.ingest_workbooks(workbooks, 'T2', build, fingerprint, {})
+    assert sorted(database) == ['4 para day 1', '8 para day 1'] and stale == []
+    assert database['8 para day 1']['day'] == '1' and database['8 para day 1']['sheet'] == '8 para'
+
+    # Unchanged: nothing is rebuilt
+    built.clear()
+    assert pt.ingest_workbooks(workbooks, 'T2', build, fingerprint, database) == ({}, [])
+    assert built == []
+
+    # One sheet edited: only its material is rebuilt
+    workbooks['1']['sheets']['4 para']['T2']['volt'][0] += 1
+    new, stale = pt.ingest_workbooks(workbooks, 'T2', build, fingerprint, database)
+    assert list(new) == ['4 para day 1'] and built == ['4 para'] and stale == []
+
+    # A new day is added, and a sheet removed from day 1
+    write_day(tmp_path / 'Measurements_day_2.xlsx', seed=2, n_sheets=1)
+    workbooks = pt.load_workbooks(str(tmp_path / 'Measurements_day_*.xlsx'), layout, cache, workers=1)
+    del workbooks['1']['sheets']['4 para']
+    new, stale = pt.ingest_workbooks(workbooks, 'T2', build, fingerprint, database)
+    assert list(new) == ['8 para day 2'] and stale == ['4 para day 1']
+
+
+def echo_train(seed: int, n: int = 5000) -> tuple[np.ndarray, np.ndarray]:
+    """A noisy decaying echo train, quantised like a scope trace so it has plateaus."""
+    rng = np.random.default_rng(seed)
+    x = np.arange(n) * 1e-3
+    y = 8 * np.exp(-x / 2) * np.abs(np.sin(np.pi * x / 0.25)) ** 8 + rng.normal(0, 0.2, n)
+    return x, np.round(y, 1)
+
+
+@pytest.mark.parametrize('seed', range(5))
+@pytest.mark.parametrize('chunk_size', [7, 100, 1024, 1 << 16])
+def test_stream_peaks_matches_get_peaks(seed, chunk_size):
+    x, y = echo_train(seed)
+    for min_time, min_height, prominence in [(0.0555, 0.5, 0.5), (0.0105, None, 0.1), (0.2005, 1.0, 2.0)]:
+        expected = pt.get_peaks(x, y, min_time, min_height, prominence)
+        streamed = pt.stream_peaks(pt.iter_chunks(x, y, chunk_size=chunk_size), min_time, min_height, prominence)
+        np.testing.assert_array_equal(streamed[0], expected[0])
+        np.testing.assert_array_equal(streamed[1], expected[1])
+
+
+@pytest.mark.parametrize('chunk_size', [50, 333, 1 << 16])
+def test_smoothed_stream_matches_whole_trace(chunk_size):
+    x, y = echo_train(0)
+    x_smooth, y_smooth = pt.smooth_xy_data(x, y, window_length=101, polyorder=3)
+    streamed = list(pt.smooth_chunks(pt.iter_chunks(x, y, chunk_size=chunk_size), window_length=101, polyorder=3))
+    np.testing.assert_array_equal(np.concatenate([c[0] for c in streamed]), x_smooth)
+    np.testing.assert_allclose(np.concatenate([c[1] for c in streamed]), y_smooth, atol=1e-12)
+
+    expected = pt.get_peaks(x_smooth, y_smooth, 0.0555, 0.5)
+    peaks = pt.stream_peaks(pt.smooth_chunks(pt.iter_chunks(x, y, chunk_size=chunk_size), 101, 3), 0.0555, 0.5)
+    np.testing.assert_array_equal(peaks[0], expected[0])
+    np.testing.assert_allclose(peaks[1], expected[1], atol=1e-12)
+
+
+def test_short_stream_is_rejected():
+    x, y = echo_train(0, n=50)
+    with pytest.raises(ValueError):
+        list(pt.smooth_chunks(pt.iter_chunks(x, y, chunk_size=16), window_length=101))
+
+
+def test_snapshot_hit_needs_neither_pandas_nor_openpyxl(tmp_path, layout):
+    workbook = write_day(tmp_path / 'Measurements_day_1.xlsx')
+    cache = str(tmp_path / 'cache')
+    pt.load_workbook_snapshot(workbook, layout, cache)
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    script = (f"import sys; sys.path.insert(0, {root!r})\n"
+              "from utils import pandas_tools as pt\n"
+              f"sheets = pt.load_workbook_snapshot({workbook!r}, pt.load_layout({os.path.join(root, layout_path)!r}), {cache!r})\n"
+              "assert list(sheets) == ['8 para', '4 para']\n"
+              "print(sorted(name for name in ('pandas', 'openpyxl') if name in sys.modules))\n")
+    output = subprocess.run([sys.executable, '-c', script], capture_output=True, text=True, check=True).stdout
+    assert output.splitlines()[-1] == '[]'
+
+
+def test_import_prints_nothing():
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    result = subprocess.run([sys.executable, '-c', 'import utils.pandas_tools'], cwd=root, capture_output=True, text=True, check=True)
+    assert result.stdout == ''
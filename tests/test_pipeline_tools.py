@@ -0,0 +1,79 @@
+import threading
+from time import sleep
+
+import pytest
+
+from utils import pipeline_tools as pl
+
+
+def test_stages_run_in_dependency_order():
+    stages = [
+        pl.Stage('sum', lambda a, b: a + b, inputs=('a', 'b'), outputs=('total',)),
+        pl.Stage('split', lambda x: (x, 2 * x), inputs=('x',), outputs=('a', 'b')),
+        pl.Stage('log', lambda total: None, inputs=('total',)),
+    ]
+    results, timings = pl.run_pipeline(stages, initial={'x': 3})
+    assert results == {'x': 3, 'a': 3, 'b': 6, 'total': 9}
+    assert sorted(timings) == ['log', 'split', 'sum']
+
+def test_independent_stages_overlap():
+    barrier = threading.Barrier(2, timeout=5)
+    stages = [pl.Stage(name, barrier.wait, outputs=(name,)) for name in ('t1', 't2')]
+    pl.run_pipeline(stages, max_workers=2)  # Would time out if the stages ran one after the other
+
+def test_stages_sharing_a_resource_never_overlap():
+    lock = threading.Lock()
+    running, seen = set(), []
+    def stage(name):
+        def run():
+            with lock:
+                running.add(name)
+                seen.append(set(running))
+            sleep(0.05)
+            with lock:
+                running.discard(name)
+        return run
+    stages = [pl.Stage('t1', stage('t1'), resources=('ROOT',)),
+              pl.Stage('t2', stage('t2'), resources=('ROOT',)),
+              pl.Stage('peaks', stage('peaks'))]
+    pl.run_pipeline(stages, max_workers=3)
+    assert not any({'t1', 't2'} <= running_then for running_then in seen)
+    assert any(len(running_then) == 2 for running_then in seen)  # peaks ran alongside one of them
+
+
+@pytest.mark.parametrize('stages', [
+    [pl.Stage('a', int, outputs=('x',)), pl.Stage('b', int, outputs=('x',))],
+    [pl.Stage('a', int, inputs=('missing',))],
+    [pl.Stage('a', int, inputs=('y',), outputs=('x',)), pl.Stage('b', int, inputs=('x',), outputs=('y',))],
+])
+def test_invalid_graphs_are_rejected(stages):
+    with pytest.raises(ValueError):
+        pl.run_pipeline(stages)
+
+def test_failing_stage_stops_the_pipeline():
+    def fail():
+        raise RuntimeError("fit failed")
+    ran = []
+    stages = [pl.Stage('fit', fail, outputs=('fit',)),
+              pl.Stage('export', lambda fit: ran.append(fit), inputs=('fit',))]
+    with pytest.raises(RuntimeError, match="fit failed"):
+        pl.run_pipeline(stages)
+    assert ran == []
+
+
+def slow_square(material: str, data: dict) -> dict:
+    sleep(data['delay'])
+    return {'material': material, 'square': data['value'] ** 2}
+
+
+@pytest.mark.parametrize('workers', [1, 2])
+def test_map_materials_keeps_the_database_order(workers):
+    # The first material finishes last, so with workers the completion order differs from the database order
+    database = {f'{i} para day 1': {'value': i, 'delay': 0.3 if i == 0 else 0.} for i in range(4)}
+    completed = []
+    results = pl.map_materials(slow_square, database, workers=workers, on_result=lambda material, result: completed.append(material))
+    assert list(results) == list(database)
+    assert results == {material: {'material': material, 'square': data['value'] ** 2} for material, data in database.items()}
+    assert sorted(completed) == sorted(database)
+    if workers == 1:
+        assert completed == list(database)
@@ -0,0 +1,60 @@
+import sys
+import pytest
+
+from utils import lazy_import
+from utils import profile_tools as pf
+
+
+@pytest.fixture
+def trace(tmp_path):
+    path = str(tmp_path / 'run.jsonl')
+    pf.enable(path)
+    yield path
+    pf.disable()
+
+
+@pytest.fixture
+def slow_module(tmp_path, monkeypatch):
+    """Name of a module that takes 0.2 s to import."""
+    (tmp_path / 'slow_module_for_profile.py').write_text("import time\ntime.sleep(0.2)\nvalue = 1\n")
+    monkeypatch.syspath_prepend(str(tmp_path))
+    yield 'slow_module_for_profile'
+    sys.modules.pop('slow_module_for_profile', None)
+
+
+def test_spans_nest_and_sum_counters(trace):
+    with pf.span('t1_analysis.py', 'stage', stage='t1_analysis.py'):
+        with pf.span('water day 1', 'fit', material='water day 1'):
+            pf.record_fit('scipy', evaluations=12, iterations=4)
+            pf.count('fit_cache_hits')
+    material, stage = pf.read_trace(trace)
+    assert material['stage'] == 't1_analysis.py' and material['material'] == 'water day 1'
+    assert material['counters'] == {'fits': 1, 'fits_scipy': 1, 'evaluations': 12, 'iterations': 4, 'fit_cache_hits': 1}
+    assert stage['counters'] == material['counters']
+
+
+def test_imports_are_their_own_phase(trace, slow_module, capsys):
+    module = lazy_import(slow_module)
+    with pf.span('water day 1', 'fit', material='water day 1'):
+        assert module.value == 1
+    with pf.span('oil day 1', 'fit', material='oil day 1'):
+        assert module.value == 1
+    imported, water, oil = pf.read_trace(trace)
+    assert imported['phase'] == 'import' and imported['name'] == slow_module
+    assert imported['material'] == 'water day 1'
+    assert water['import_wall'] == imported['wall'] >= 0.2
+    assert pf.own_time(water)[0] < 0.1
+    assert oil['import_wall'] == 0
+
+    pf.print_summary(trace)
+    summary = capsys.readouterr().out
+    assert 'import' in summary and '(+0.2' in summary
+    fit_total = float(summary.split('\nfit')[1].split()[0].rstrip('s'))
+    assert fit_total < 0.1
+
+
+def test_nothing_is_recorded_when_disabled(tmp_path, slow_module):
+    pf.disable()
+    with pf.span('water day 1', 'fit'):
+        assert lazy_import(slow_module).value == 1
+    assert not list(tmp_path.glob('*.jsonl'))
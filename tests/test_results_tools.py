@@ -0,0 +1,78 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from utils import results_tools as rs
+
+rows = [
+    {'material': '8 para day 1', 'T1': (12.5, 0.31), 'T2': (10.123456789012345, 0.2), 'T2_Eff': (1.5, 0.05)},
+    {'material': '0.5 para day 10', 'T1': (250.0, 4.0), 'T2': (240.0, 3.5), 'T2_Eff': (np.nan, np.nan)},
+    {'material': 'glycerine', 'sheet': 'glycerine', 'day': 2, 'T1': (30.0, 1.0), 'T2': (28.0, 0.9), 'T2_Eff': (2.0, 0.1)},
+    {'material': '4 para day 1', 'T1': (25.0, 0.5), 'T2': (21.0, 0.4), 'T2_Eff': (1.9, 0.06)},
+]
+
+
+@pytest.fixture
+def table() -> pd.DataFrame:
+    return rs.results_table(rows)
+
+
+def test_results_table(table):
+    assert list(table.index.names) == list(rs.INDEX)
+    assert list(table.columns) == rs.value_columns()
+    assert all(dtype == np.float64 for dtype in table.dtypes)
+    assert rs.query_results(table, material='glycerine').index[0][2] == '2'
+    row = table.xs('4 para day 1', level='material')
+    assert row.index[0] == (4.0, '1') and row['T1_err'].iloc[0] == 0.5
+
+def test_round_trip_is_exact(tmp_path, table):
+    path = str(tmp_path / 'results.csv')
+    rs.write_results(table, path)
+    read = rs.read_results(path)
+    pd.testing.assert_frame_equal(read, table)
+    assert read.loc[('8 para day 1', 8.0, '1'), 'T2'] == 10.123456789012345
+    assert np.isnan(read.loc[('0.5 para day 10', 0.5, '10'), 'T2_Eff'])
+
+def test_legacy_results_are_converted(tmp_path):
+    # Written like the old create_all_T_csv.py: '[value, error]' lists in the cells, no index
+    path = str(tmp_path / 'all_T.csv')
+    pd.DataFrame([
+        {'material': '8 para', 'T1': [12.5, 0.31], 'T2': [10.1, 0.2], 'T2_Eff': [1.5, 0.05]},
+        {'material': '2 para day 3', 'T1': [60.0, 1.5], 'T2': [55.0, 1.2], 'T2_Eff': [1.7, 0.04]},
+        {'material': 'glycerine', 'T1': [30.0, 1.0], 'T2': [28.0, 0.9], 'T2_Eff': [2.0, 0.1]},
+    ], columns=['material', 'T1', 'T2', 'T2_Eff']).to_csv(path, index=False)
+
+    legacy = rs.read_results(path)
+    expected = rs.results_table([
+        {'material': '8 para', 'T1': (12.5, 0.31), 'T2': (10.1, 0.2), 'T2_Eff': (1.5, 0.05)},
+        {'material': '2 para day 3', 'T1': (60.0, 1.5), 'T2': (55.0, 1.2), 'T2_Eff': (1.7, 0.04)},
+        {'material': 'glycerine', 'T1': (30.0, 1.0), 'T2': (28.0, 0.9), 'T2_Eff': (2.0, 0.1)},
+    ])
+    pd.testing.assert_frame_equal(legacy, expected)
+    assert rs.query_results(legacy, material='8 para').index[0][1:] == (8.0, '')
+
+    # Converted tables are written in the new format
+    rs.write_results(legacy, path)
+    pd.testing.assert_frame_equal(rs.read_results(path), expected)
+
+@pytest.mark.parametrize('query, materials', [
+    ({'day': 1}, ['4 para day 1', '8 para day 1']),
+    ({'day': ['1', 10]}, ['0.5 para day 10', '4 para day 1', '8 para day 1']),
+    ({'concentration': (1, 8)}, ['4 para day 1', '8 para day 1']),
+    ({'concentration': [0.5, 4]}, ['0.5 para day 10', '4 para day 1']),
+    ({'material': '8 para day 1', 'day': 2}, []),
+    ({}, ['0.5 para day 10', '4 para day 1', '8 para day 1', 'glycerine']),
+])
+def test_query_results(table, query, materials):
+    assert list(rs.query_results(table, **query).index.get_level_values('material')) == materials
+
+def test_split_material_and_concentration():
+    assert rs.split_material('2 para day 3') == ('2 para', '3')
+    assert rs.split_material('glycerine') == ('glycerine', '')
+    assert rs.concentration_of('0.5 para') == 0.5 and rs.concentration_of('.25 para') == 0.25
+    assert np.isnan(rs.concentration_of('glycerine'))
+
+def test_value_error(table):
+    values, errors = rs.value_error(table, 'T1')
+    assert values.dtype == errors.dtype == np.float64
+    assert values.tolist() == [250.0, 25.0, 12.5, 30.0]
@@ -0,0 +1,83 @@
+import ctypes
+import warnings
+import numpy as np
+import pytest
+
+ROOT = pytest.importorskip('ROOT')
+
+from utils import root_tools as rt
+from utils import fit_tools as ft
+
+fit_str = '[0] * exp(- x / [1]) + [2]'
+
+
+def envelope(A: float, T2: float, C: float, seed: int) -> tuple:
+    """A noisy T2 envelope as (x, y, delta_x, delta_y)."""
+    x = np.linspace(0.2, 20, 40)
+    y = A * np.exp(- x / T2) + C + np.random.default_rng(seed).normal(0, 0.05, len(x))
+    return x, y, np.full(len(x), 0.02), np.full(len(x), 0.05)
+
+
+def parameters(fit_func) -> list[float]:
+    return [fit_func.GetParameter(i) for i in range(fit_func.GetNpar())]
+
+def limits(fit_func) -> list[tuple[float, float]]:
+    bounds = []
+    for i in range(fit_func.GetNpar()):
+        low, high = ctypes.c_double(), ctypes.c_double()
+        fit_func.GetParLimits(i, low, high)
+        bounds.append((low.value, high.value))
+    return bounds
+
+
+def test_second_material_does_not_inherit_the_first():
+    first = rt.fit_custom(rt.generate_data_points(*envelope(30, 8, 3, seed=0)), fit_str, None, 0, 20,
+                          par_limits={0: (10, 50), 1: (1, 40), 2: (1, 8)}, initial={0: 25, 1: 5, 2: 2}, fit_options='Q')
+    first_params = parameters(first)
+
+    fresh = rt.pooled_tf1(fit_str, 0, 20)
+    assert parameters(fresh) == [0., 0., 0.]
+    assert [fresh.GetParError(i) for i in range(3)] == [0., 0., 0.]
+    assert limits(fresh) == [(0., 0.)] * 3
+    assert fresh.GetChisquare() == 0 and fresh.GetNDF() == 0
+
+    # Fitted without limits, the second material matches a TF1 built from the string
+    data = envelope(20, 3, 1, seed=1)
+    second = rt.fit_custom(rt.generate_data_points(*data), fit_str, None, 0, 20, initial={0: 15, 1: 2, 2: 0.5}, fit_options='Q')
+    direct = ROOT.TF1('direct_envelope', fit_str, 0, 20)
+    direct.SetParameters(15, 2, 0.5)
+    rt.generate_data_points(*data).Fit(direct, 'QS')
+    assert limits(second) == [(0., 0.)] * 3
+    np.testing.assert_allclose(parameters(second), parameters(direct), rtol=1e-9)
+    assert second.GetChisquare() == pytest.approx(direct.GetChisquare(), rel=1e-9)
+    # And the first fit is left as it was
+    assert parameters(first) == first_params
+
+
+def test_pool_compiles_each_formula_once():
+    rt.clear_tf1_pool()
+    copies = [rt.pooled_tf1(fit_str, 0, 10 + i) for i in range(3)]
+    assert len(rt._tf1_pool) == 1
+    assert len({copy.GetName() for copy in copies}) == 3
+    assert [copy.GetXmax() for copy in copies] == [10, 11, 12]
+    # Copies are not registered in ROOT's list of functions, so they never replace one another there
+    assert not any(ROOT.gROOT.GetListOfFunctions().FindObject(copy.GetName()) for copy in copies)
+    rt.pooled_tf1('[0] * x + [1]', 0, 1)
+    assert len(rt._tf1_pool) == 2
+
+    # Nor do they claim to be, so fitting them does not warn
+    with warnings.catch_warnings():
+        warnings.simplefilter('error', RuntimeWarning)
+        rt.generate_data_points(*envelope(30, 8, 3, seed=3)).Fit(copies[0], 'Q')
+
+
+def test_cached_fit_is_rebuilt_on_a_clean_copy(tmp_path):
+    cache = ft.FitCache(str(tmp_path))
+    data = envelope(30, 8, 3, seed=2)
+    par_limits = {0: (10, 50), 1: (1, 40), 2: (1, 8)}
+    fitted = rt.fit_graph(data, fit_str, (0, 20), par_limits, cache=cache)
+    cached = rt.fit_graph(data, fit_str, (0, 20), par_limits, cache=cache)
+    assert cached['fit'] is not fitted['fit']
+    assert parameters(cached['fit']) == parameters(fitted['fit'])
+    assert cached['statistics'] == fitted['statistics']
+    assert cached['fitted_params'] == fitted['fitted_params']
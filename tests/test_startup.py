@@ -0,0 +1,17 @@
+import os
+import sys
+import subprocess
+
+import pytest
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(root, 'Pulse_NMR_61', 'benchmarks'))
+from bench_startup import entry_modules
+
+
+@pytest.mark.parametrize('module', entry_modules)
+def test_entry_scripts_import_no_heavy_dependencies(module):
+    script = (f"import sys, {module}\n"
+              "print(sorted(name for name in ('pandas', 'uncertainties', 'openpyxl', 'scipy', 'matplotlib', 'ROOT') if name in sys.modules))\n")
+    result = subprocess.run([sys.executable, '-c', script], cwd=root, capture_output=True, text=True, check=True)
+    assert result.stdout.splitlines()[-1] == '[]'
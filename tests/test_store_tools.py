@@ -0,0 +1,148 @@
+import os
+import collections
+import numpy as np
+import pytest
+
+from utils import store_tools as st
+from utils.uncertainty_tools import Uncertainty
+from Pulse_NMR_61.create_databases import create_synthetic_workbook as sw
+
+
+def material(n: int = 50, offset: float = 0.) -> dict:
+    time = np.linspace(0, 1, n)
+    return {
+        'time': time, 'volt': np.exp(-time) + offset,
+        'delta_v': Uncertainty.constant(0.05, n),
+        'root_data': {'time': time[::5], 'volt': np.exp(-time[::5]) + offset},
+        'tau': 0.5, 'param_lim': {'0': [0, 1]}
+    }
+
+
+def test_round_trip(tmp_path):
+    store = str(tmp_path)
+    st.save_database({'water day 1': material()}, store)
+    loaded = st.load_database(store)['water day 1']
+    expected = material()
+    np.testing.assert_array_equal(loaded['volt'], expected['volt'])
+    np.testing.assert_array_equal(loaded['root_data']['time'], expected['root_data']['time'])
+    assert isinstance(loaded['delta_v'], Uncertainty) and loaded['delta_v'] == expected['delta_v']
+    assert loaded['tau'] == 0.5 and loaded['param_lim'] == {'0': [0, 1]}
+    # The constant error is kept in the sidecar, not as a trace
+    assert not os.path.exists(os.path.join(store, 'water day 1', 'delta_v.npy'))
+
+
+def test_replaced_material_leaves_no_old_arrays(tmp_path):
+    store = str(tmp_path)
+    st.save_database({'water day 1': material(), 'oil day 1': material()}, store)
+    st.update_material(store, 'water day 1', {'x_peak': np.arange(3.), 'params': {'par0': [1, 0.1]}})
+
+    replacement = material(20, offset=1.)
+    del replacement['root_data']
+    st.save_database({'water day 1': replacement}, store)
+
+    assert sorted(os.listdir(os.path.join(store, 'water day 1'))) == ['time.npy', 'volt.npy']
+    loaded = st.load_database(store)
+    assert 'x_peak' not in loaded['water day 1'] and 'params' not in loaded['water day 1']
+    np.testing.assert_array_equal(loaded['water day 1']['volt'], replacement['volt'])
+    # Materials not in the saved database stay as they were
+    np.testing.assert_array_equal(loaded['oil day 1']['volt'], material()['volt'])
+
+
+def test_sidecar_is_written_once_per_save(tmp_path, monkeypatch):
+    writes = []
+    write_meta = st._write_meta
+    monkeypatch.setattr(st, '_write_meta', lambda *args: (writes.append(args), write_meta(*args)))
+    st.save_database({f'{c} para day 1': material() for c in range(10)}, str(tmp_path))
+    assert len(writes) == 1
+    # Replacing materials removes them from the sidecar first, then writes it once more at the end
+    st.save_database({f'{c} para day 1': material() for c in range(3)}, str(tmp_path))
+    assert len(writes) == 3
+
+
+def test_update_material_keeps_other_traces(tmp_path):
+    store = str(tmp_path)
+    st.save_database({'water day 1': material()}, store)
+    st.update_material(store, 'water day 1', {'y_peak': [1., 2.], 'statistics': {'chi2_red': 1.1}})
+    loaded = st.load_material(store, 'water day 1')
+    np.testing.assert_array_equal(loaded['y_peak'], [1., 2.])
+    np.testing.assert_array_equal(loaded['time'], material()['time'])
+    assert st.load_meta(store)['water day 1']['statistics'] == {'chi2_red': 1.1}
+
+
+def test_remove_materials(tmp_path):
+    store = str(tmp_path)
+    st.save_database({'water day 1': material(), 'oil day 1': material()}, store)
+    st.remove_materials(store, ['oil day 1'])
+    assert list(st.load_database(store)) == ['water day 1']
+    assert not os.path.exists(os.path.join(store, 'oil day 1'))
+
+
+def test_update_materials_writes_the_sidecar_once(tmp_path, monkeypatch):
+    store = str(tmp_path)
+    st.save_database({f'{c} para day 1': material() for c in range(5)}, store)
+    writes = []
+    write_meta = st._write_meta
+    monkeypatch.setattr(st, '_write_meta', lambda *args: (writes.append(args), write_meta(*args)))
+    st.update_materials(store, {f'{c} para day 1': {'x_peak': np.arange(3.) + c, 'params': {'par0': [c, 0.1]}}
+                                for c in range(5)})
+    assert len(writes) == 1
+    loaded = st.load_database(store)
+    for c in range(5):
+        np.testing.assert_array_equal(loaded[f'{c} para day 1']['x_peak'], np.arange(3.) + c)
+        assert loaded[f'{c} para day 1']['params'] == {'par0': [c, 0.1]}
+        np.testing.assert_array_equal(loaded[f'{c} para day 1']['volt'], material()['volt'])
+    st.update_materials(store, {})
+    assert len(writes) == 1
+
+
+@pytest.fixture
+def count_writes(monkeypatch):
+    """Counts the sidecar writes of each store directory."""
+    writes = collections.Counter()
+    write_meta = st._write_meta
+    def counted(store_dir, meta):
+        writes[os.path.normpath(store_dir)] += 1
+        write_meta(store_dir, meta)
+    monkeypatch.setattr(st, '_write_meta', counted)
+    return writes
+
+def test_t2_stages_write_the_sidecar_once(tmp_path, monkeypatch, count_writes):
+    from Pulse_NMR_61.analysing_data import t2_analysis, t2_analysis_peaks
+    monkeypatch.chdir(tmp_path)  # The fit cache too
+    T2_path = str(tmp_path / 'T2_Data') + '/'
+    for module in (t2_analysis, t2_analysis_peaks):
+        monkeypatch.setattr(module, 'T2_path', T2_path)
+    monkeypatch.setattr(t2_analysis_peaks, 'tuned_settings_path', T2_path + 'peak_settings.json')
+    monkeypatch.setattr(t2_analysis_peaks, 'plot_directory', str(tmp_path) + '/')
+
+    T2_Data = {}
+    for i, (sheet, params) in enumerate(sw.sample_parameters(3).items()):
+        time, volt = sw.t2_trace(params, 20_000, np.random.default_rng(i))
+        T2_Data[f'{sheet} day 1'] = {'time': time * 1e3, 'volt': volt, 'tau': params['tau'], 'sheet': sheet}
+    st.save_database(T2_Data, T2_path)
+    count_writes.clear()
+
+    T2_Data = t2_analysis_peaks.extract_envelopes(T2_Data, tune=False)
+    assert count_writes == {os.path.normpath(T2_path): 1}
+    t2_analysis.fit_t2(T2_Data, backend='numpy')
+    assert count_writes == {os.path.normpath(T2_path): 2}
+    assert all('params' in entry and 'x_peak' in entry for entry in st.load_database(T2_path).values())
+
+def test_t2_eff_stage_writes_the_sidecar_once(tmp_path, monkeypatch, count_writes):
+    from Pulse_NMR_61.analysing_data import t2_eff_analysis
+    from Pulse_NMR_61.create_databases import create_T2_eff_database
+    monkeypatch.chdir(tmp_path)
+    T2_eff_path = str(tmp_path / 'T2_Eff_Data') + '/'
+    monkeypatch.setattr(t2_eff_analysis, 'T2_eff_path', T2_eff_path)
+
+    T2_Eff_Data = {}
+    for i, (sheet, params) in enumerate(sw.sample_parameters(3).items()):
+        time, volt = sw.t2_eff_trace(params, 2000, np.random.default_rng(i))
+        T2_Eff_Data[f'{sheet} day 1'] = create_T2_eff_database.build_t2_eff_material(
+            sheet, {'time': time, 'volt': volt, 'T_RC': params['T_RC']})
+    st.save_database(T2_Eff_Data, T2_eff_path)
+    count_writes.clear()
+
+    t2_eff_analysis.fit_t2_eff(T2_Eff_Data, backend='numpy')
+    assert count_writes == {os.path.normpath(T2_eff_path): 1}
+    assert all('params' in entry for entry in st.load_database(T2_eff_path).values())
@@ -0,0 +1,38 @@
+import numpy as np
+import pytest
+
+from Pulse_NMR_61.analysing_data import t2_analysis as t2
+from utils.uncertainty_tools import Uncertainty
+
+
+class Recorder:
+    """Stands in for an ExportQueue, keeping the submitted renders."""
+    def __init__(self):
+        self.submitted = []
+
+    def submit(self, file_path, render, *args, **kwargs):
+        self.submitted.append((file_path, render, args))
+        return True
+
+
+def envelope() -> dict:
+    x = np.linspace(2, 200, 40)
+    y = 30.1234 * np.exp(-x / 41.2345) + 3.01234 + np.random.default_rng(0).normal(0, 0.05, len(x))
+    return {'x_peak': x, 'y_peak': y, 'delta_t': Uncertainty.constant(0.1, len(x)), 'delta_v': Uncertainty.constant(0.05, len(x))}
+
+
+@pytest.mark.parametrize('backend', ['numpy', 'root'])
+def test_canvas_is_drawn_from_the_unrounded_fit(tmp_path, monkeypatch, backend):
+    if backend == 'root':
+        pytest.importorskip('ROOT')
+    monkeypatch.chdir(tmp_path)  # The fit cache
+    data = envelope()
+    data.update(t2.fit_material('water day 1', data, backend=backend))
+    rounded = [value for value, _ in data['params'].values()]
+    assert rounded != data['popt']
+    np.testing.assert_allclose(data['popt'], [30.1234, 41.2345, 3.01234], rtol=0.05)
+
+    exports = Recorder()
+    t2.export_figure(exports, 'water day 1', data)
+    (_, _, args), = exports.submitted
+    assert list(args[4].values()) == data['popt']
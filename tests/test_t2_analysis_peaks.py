@@ -0,0 +1,60 @@
+import json
+import numpy as np
+import pytest
+
+from Pulse_NMR_61.analysing_data import t2_analysis_peaks as peaks
+from Pulse_NMR_61.create_databases import create_synthetic_workbook as sw
+
+
+@pytest.fixture
+def t2_database(tmp_path, monkeypatch):
+    """One synthetic echo train ('2 para' of day 1) and the paths of the stage moved to tmp_path."""
+    monkeypatch.setattr(peaks, 'T2_path', str(tmp_path / 'T2_Data') + '/')
+    monkeypatch.setattr(peaks, 'tuned_settings_path', str(tmp_path / 'T2_Data' / 'peak_settings.json'))
+    monkeypatch.setattr(peaks, 'plot_directory', str(tmp_path / 'Peaks') + '/')
+    (tmp_path / 'Peaks').mkdir()
+    params = sw.sample_parameters(3)['2 para']
+    time, volt = sw.t2_trace(params, 20_000, np.random.default_rng(0))
+    return {'2 para day 1': {'time': time * 1e3, 'volt': volt, 'tau': params['tau'], 'repetition_time': 100.,
+                             'day': '1', 'sheet': '2 para', 'fingerprint': 'new'}}
+
+
+def test_stale_tuned_settings():
+    tuned = {'water': {'material': 'water day 1', 'fingerprint': 'a'},
+             '2 para': {'material': '2 para day 1', 'fingerprint': 'b'},
+             'glycerine': {'material': 'glycerine day 1', 'fingerprint': 'c'}}
+    T2_Data = {'water day 1': {'fingerprint': 'a'}, '2 para day 1': {'fingerprint': 'edited'}}
+    assert peaks.stale_tuned_settings(tuned, T2_Data) == ['2 para', 'glycerine']
+
+
+def test_envelopes_are_not_tuned_by_default(t2_database, monkeypatch):
+    monkeypatch.setattr(peaks, 'tune_envelope', lambda *args, **kwargs: pytest.fail("tuned without autotune"))
+    T2_Data = peaks.extract_envelopes(t2_database)
+    data = T2_Data['2 para day 1']
+    defaults = peaks.default_settings('2 para', data['tau'])
+    assert data['peak_settings']['min_height'] == defaults['min_height']
+    assert data['peak_settings']['prominence'] == defaults['prominence']
+    assert len(data['x_peak']) > peaks.min_envelope_peaks
+
+
+def test_edited_sheet_drops_its_tuned_settings(t2_database):
+    tuned = {'2 para': {**peaks.default_settings('2 para', 0.5), 'min_height': 9.,
+                        'material': '2 para day 1', 'fingerprint': 'old'}}
+    peaks.save_tuned_settings(tuned)
+    T2_Data = peaks.extract_envelopes(t2_database, tune=False)
+    assert peaks.load_tuned_settings() == {}
+    assert T2_Data['2 para day 1']['peak_settings']['min_height'] == peaks.default_settings('2 para', 0.5)['min_height']
+
+
+def test_tuned_settings_remember_the_sheet(t2_database, monkeypatch):
+    monkeypatch.setattr(peaks, 'tune_workers', 1)
+    peaks.extract_envelopes(t2_database, tune=True)
+    with open(peaks.tuned_settings_path) as f:
+        tuned = json.load(f)
+    assert tuned['2 para']['material'] == '2 para day 1'
+    assert tuned['2 para']['fingerprint'] == 'new'
+
+
+@pytest.mark.parametrize('sample, dv', [('water', 0.5), ('4 para', 0.3), ('glycerine', 0.2), ('8 para', 0.15), ('glyc', 0.15)])
+def test_voltage_error(sample, dv):
+    assert peaks.voltage_error(sample) == dv
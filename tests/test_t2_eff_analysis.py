@@ -0,0 +1,51 @@
+import numpy as np
+
+from Pulse_NMR_61.analysing_data import t2_eff_analysis as t2e
+
+
+class Recorder:
+    """Stands in for an ExportQueue, keeping the submitted renders."""
+    def __init__(self):
+        self.submitted = []
+
+    def submit(self, file_path, render, *args, **kwargs):
+        self.submitted.append((file_path, render, args))
+        return True
+
+
+def fitted_material() -> dict:
+    time = np.linspace(0, 2, 50)
+    popt = [31.23456, 0.4123456, 3.0123456, 0.0123456, 0.1012345]
+    return {
+        'time': time, 'volt': t2e.fit_function(time, popt),
+        'root_data': {'time': time[::5], 'volt': t2e.fit_function(time[::5], popt),
+                      'delta_time': np.zeros(10), 'delta_v': np.full(10, 0.06)},
+        'params': {'0': (31.2, 0.3), '1': (0.41, 0.02), '2': (3.01, 0.05), '3': (0.012, 0.004), '4': (0.101, 0.01)},
+        'popt': popt,
+    }
+
+
+def test_figures_are_drawn_from_the_unrounded_fit():
+    data = fitted_material()
+    root_exports, plt_exports = Recorder(), Recorder()
+    t2e.export_figures(root_exports, plt_exports, 'water day 1', data)
+
+    (_, _, root_args), = root_exports.submitted
+    root_params = root_args[4]
+    assert list(root_params.values()) == data['popt']
+
+    (_, render, plt_args), = plt_exports.submitted
+    assert render is t2e.render_fit_plot
+    popt, rounded = plt_args[2], plt_args[3]
+    assert popt == data['popt']
+    assert rounded == [value for value, _ in data['params'].values()]
+
+def test_fit_results_keep_the_unrounded_values(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)  # The fit cache
+    data = fitted_material()
+    data['param_lim'] = {0: (15, 70), 1: (0.01, 1), 2: (1, 8), 3: (-0.3, 0.3), 4: (0.05, 0.5)}
+    results = t2e.fit_material('water day 1', data, backend='numpy')
+    np.testing.assert_allclose(results['popt'], data['popt'], rtol=1e-3)
+    rounded = [value for value, _ in results['params'].values()]
+    assert rounded != results['popt']
+    np.testing.assert_allclose(rounded, results['popt'], rtol=0.1)
@@ -0,0 +1,77 @@
+import os
+import json
+
+import numpy as np
+import pytest
+
+from utils import store_tools as st
+from utils.uncertainty_tools import Uncertainty, is_uncertainty_json
+
+examples = {
+    'constant': Uncertainty.constant(0.2, 500),
+    'segments': Uncertainty([0.1, 0.4, 0.2], n=10, starts=[0, 3, 7]),
+    'array': Uncertainty(np.linspace(0.1, 1., 7)),
+}
+
+
+@pytest.mark.parametrize('kind', examples)
+def test_json_round_trip(kind):
+    error = examples[kind]
+    data = json.loads(json.dumps(error.to_json()))
+    assert is_uncertainty_json(data)
+    restored = Uncertainty.from_json(data)
+    assert restored.kind == kind == error.kind and restored == error
+    np.testing.assert_array_equal(np.asarray(restored), np.asarray(error))
+
+def test_compact_json_does_not_grow_with_the_trace():
+    assert Uncertainty.constant(0.2, 10_000_000).to_json() == {'uncertainty': 'constant', 'value': 0.2, 'n': 10_000_000}
+    assert len(Uncertainty.compress(np.repeat([0.1, 0.2], 10_000)).to_json()['values']) == 2
+
+def test_behaves_like_an_array():
+    np.testing.assert_array_equal(np.asarray(examples['segments']), [0.1] * 3 + [0.4] * 4 + [0.2] * 3)
+    constant = np.asarray(examples['constant'])
+    assert constant.shape == (500,) and constant.strides == (0,)  # A broadcast view, not a copy
+    assert not constant.flags.writeable
+    assert np.asarray(examples['constant'], dtype=np.float32).dtype == np.float32
+    assert len(examples['segments']) == 10 and examples['segments'][3] == 0.4
+    assert examples['segments'][-2:].tolist() == [0.2, 0.2]
+    assert list(examples['array']) == np.linspace(0.1, 1., 7).tolist()
+    assert np.multiply(examples['constant'], 2)[0] == 0.4
+
+@pytest.mark.parametrize('errors, kind', [
+    ([0.2] * 50, 'constant'),
+    ([0.1] * 20 + [0.3] * 30, 'segments'),
+    (np.linspace(0., 1., 50), 'array'),
+    ([0.1, 0.1, 0.2, 0.3], 'array'),  # Segments would not be smaller
+    ([], 'array'),
+])
+def test_compress(errors, kind):
+    compressed = Uncertainty.compress(errors)
+    assert compressed.kind == kind
+    np.testing.assert_array_equal(np.asarray(compressed), np.asarray(errors, dtype=np.float64))
+    assert Uncertainty.compress(compressed) == compressed
+
+@pytest.mark.parametrize('values, n, starts', [
+    ([0.1, 0.2], 10, None),
+    ([0.1, 0.2], 10, [1, 5]),
+    ([0.1, 0.2], 10, [0, 0]),
+    ([0.1, 0.2], 10, [0]),
+])
+def test_invalid_segments(values, n, starts):
+    with pytest.raises(ValueError):
+        Uncertainty(values, n=n, starts=starts)
+
+def test_stored_compactly(tmp_path):
+    database = {'8 para day 1': {
+        'time': np.linspace(0, 1, 500),
+        'delta_time': examples['constant'],
+        'delta_v': Uncertainty.compress(np.linspace(0, 1, 500)),
+        'nested': {'delta_t': examples['segments']},
+    }}
+    st.save_database(database, str(tmp_path))
+    assert sorted(os.listdir(tmp_path / '8 para day 1')) == ['delta_v.npy', 'time.npy']
+
+    loaded = st.load_database(str(tmp_path))['8 para day 1']
+    assert isinstance(loaded['delta_time'], Uncertainty) and loaded['delta_time'] == examples['constant']
+    assert loaded['nested']['delta_t'] == examples['segments']
+    np.testing.assert_array_equal(loaded['delta_v'], np.linspace(0, 1, 500))
@@ -0,0 +1,36 @@
+import importlib
+from collections.abc import Callable
+
+from utils import profile_tools as pf
+
+
+class LazyModule:
+    """
+    Stands in for a module and imports it on first attribute access.
+
+    Heavy dependencies (ROOT, pandas, SciPy) are wrapped in this, so importing a
+    utils module is cheap and a stage only pays for the libraries it actually uses.
+    The import is recorded as an 'import' span of its own, so the profile does not
+    charge it to the material or phase that happened to use the module first.
+    """
+    def __init__(self, name: str, on_load: Callable[[], None] | None = None):
+        self._name = name
+        self._on_load = on_load
+        self._module = None
+
+    def __getattr__(self, attr: str):
+        if self._module is None:
+            with pf.span(self._name, 'import'):
+                self._module = importlib.import_module(self._name)
+            if self._on_load is not None:
+                self._on_load()
+        return getattr(self._module, attr)
+
+    def __repr__(self) -> str:
+        state = 'loaded' if self._module is not None else 'not loaded'
+        return f"<lazy module '{self._name}' ({state})>"
+
+
+def lazy_import(name: str, on_load: Callable[[], None] | None = None) -> LazyModule:
+    """Returns a proxy of module `name` that is only imported when first used."""
+    return LazyModule(name, on_load)
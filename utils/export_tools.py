@@ -0,0 +1,135 @@
+import os
+import json
+import hashlib
+import threading
+import multiprocessing
+from functools import partial
+from collections.abc import Callable
+from concurrent.futures import Future, ThreadPoolExecutor, ProcessPoolExecutor
+from colorama import Fore, Style
+import numpy as np
+
+from utils import profile_tools as pf
+from utils.uncertainty_tools import Uncertainty
+
+MANIFEST_FILE: str = '.exports.json'
+
+
+def _canonical(obj):
+    """Turns figure inputs into JSON-serialisable values; arrays are reduced to a hash of their content."""
+    if isinstance(obj, np.ndarray):
+        array = np.ascontiguousarray(obj)
+        return ['ndarray', str(array.dtype), list(array.shape), hashlib.sha256(array.data).hexdigest()]
+    if isinstance(obj, Uncertainty):
+        return _canonical(obj.to_json())  # Its compact form, without expanding it
+    if isinstance(obj, dict):
+        return [[str(key), _canonical(value)] for key, value in sorted(obj.items(), key=lambda item: str(item[0]))]
+    if isinstance(obj, (list, tuple)):
+        return [_canonical(value) for value in obj]
+    if isinstance(obj, np.generic):
+        return obj.item()
+    if isinstance(obj, (str, int, float, bool)) or obj is None:
+        return obj
+    return repr(obj)
+
+def inputs_hash(*inputs) -> str:
+    """SHA-256 of everything a figure is drawn from: data (by content), parameters, titles and file names."""
+    return hashlib.sha256(json.dumps(_canonical(inputs)).encode()).hexdigest()
+
+
+class ExportQueue:
+    """
+    Renders figures in the background, skipping those whose inputs did not change.
+
+    Each figure is a call `render(*args, **kwargs)` that writes `file_path`. Its inputs are
+    hashed (render function, arguments) and compared with a manifest of the last export;
+    unchanged figures that still exist on disk are not rendered again. At most
+    `max_pending` renders are queued or running at a time, and `submit` blocks when the
+    queue is full, so the figure data held in memory stays bounded.
+
+    ROOT and pyplot keep global state, so ROOT canvases are rendered in a separate worker
+    process (processes=True) and matplotlib figures with the object-oriented `Figure` API
+    in a background thread. Use as a context manager; leaving it waits for all renders,
+    saves the manifest and re-raises the first render error.
+    """
+    def __init__(self, manifest_path: str, max_pending: int = 4, processes: bool = False):
+        """
+        Args:
+            manifest_path (str): JSON file recording the inputs hash of every exported file.
+            max_pending (int, optional): Maximum number of renders queued or running. Defaults to 4.
+            processes (bool, optional): Render in one worker process instead of a thread. The render
+                function and its arguments must then be picklable. Defaults to False.
+        """
+        self.manifest_path = manifest_path
+        self._manifest: dict[str, str] = {}
+        if os.path.exists(manifest_path):
+            with open(manifest_path, 'r') as f:
+                self._manifest = json.load(f)
+
+        if processes:
+            self._executor = ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn'))
+        else:
+            self._executor = ThreadPoolExecutor(max_workers=1)
+        self._exported: dict[str, str] = {}  # Entries written by this queue
+        self._slots = threading.BoundedSemaphore(max_pending)
+        self._lock = threading.Lock()
+        self._errors: list[BaseException] = []
+        self.written, self.skipped = 0, 0
+
+    def submit(self, file_path: str, render: Callable, *args, **kwargs) -> bool:
+        """
+        Queues `render(*args, **kwargs)`, which must write `file_path`, unless its inputs are unchanged.
+
+        Returns:
+            bool: True if the figure was queued, False if it was skipped.
+        """
+        key = inputs_hash(render.__module__, render.__qualname__, file_path, args, kwargs)
+        with self._lock:
+            unchanged = self._manifest.get(file_path) == key and os.path.exists(file_path)
+            if unchanged:
+                self.skipped += 1
+        if unchanged:
+            return False
+
+        self._slots.acquire()  # Blocks while the queue is full
+        future = self._executor.submit(pf.call_in_span, render, os.path.basename(file_path), 'render', pf.context(), *args, **kwargs)
+        future.add_done_callback(partial(self._finished, file_path, key))
+        return True
+
+    def _finished(self, file_path: str, key: str, future: Future) -> None:
+        self._slots.release()
+        error = future.exception()
+        with self._lock:
+            if error is None:
+                self._manifest[file_path] = self._exported[file_path] = key
+                self.written += 1
+            else:
+                print(f"{Fore.RED}Exporting '{file_path}' failed: {error}{Style.RESET_ALL}")
+                self._errors.append(error)
+
+    def close(self) -> None:
+        """Waits for all renders and saves the manifest."""
+        self._executor.shutdown(wait=True)
+        # Merge into the manifest on disk, so several queues can share one manifest
+        manifest = {}
+        if os.path.exists(self.manifest_path):
+            with open(self.manifest_path, 'r') as f:
+                manifest = json.load(f)
+        manifest.update(self._exported)
+        os.makedirs(os.path.dirname(self.manifest_path) or '.', exist_ok=True)
+        with open(self.manifest_path + '.tmp', 'w') as f:
+            json.dump(manifest, f, indent=4)
+        os.replace(self.manifest_path + '.tmp', self.manifest_path)
+        print(f"{self.written} figures exported, {self.skipped} unchanged.")
+
+    def __enter__(self) -> 'ExportQueue':
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        self.close()
+        if exc_type is None and self._errors:
+            raise self._errors[0]
+
+
+if __name__ == '__main__':
+    pass
@@ -0,0 +1,687 @@
+import os
+import re
+import pickle
+import threading
+import multiprocessing
+from math import floor, log10
+from functools import lru_cache
+from collections.abc import Callable, Sequence
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+
+from utils import lazy_import
+from utils import model_tools as mt
+from utils import profile_tools as pf
+from utils.export_tools import inputs_hash
+
+# SciPy is only imported once a fit is actually run
+optimize = lazy_import('scipy.optimize')
+stats = lazy_import('scipy.stats')
+sparse = lazy_import('scipy.sparse')
+
+# ROOT (TFormula / TMath) functions and the NumPy functions they translate to
+NUMPY_FUNCTIONS: dict[str, str] = {
+    'exp': 'np.exp', 'log': 'np.log', 'log10': 'np.log10', 'sqrt': 'np.sqrt',
+    'abs': 'np.abs', 'fabs': 'np.abs', 'pow': 'np.power',
+    'sin': 'np.sin', 'cos': 'np.cos', 'tan': 'np.tan',
+    'asin': 'np.arcsin', 'acos': 'np.arccos', 'atan': 'np.arctan',
+    'sinh': 'np.sinh', 'cosh': 'np.cosh', 'tanh': 'np.tanh',
+    'Exp': 'np.exp', 'Log': 'np.log', 'Log10': 'np.log10', 'Sqrt': 'np.sqrt',
+    'Abs': 'np.abs', 'Power': 'np.power', 'Sin': 'np.sin', 'Cos': 'np.cos', 'Tan': 'np.tan',
+}
+NUMPY_CONSTANTS: dict[str, str] = {'pi': 'np.pi', 'Pi': 'np.pi'}
+
+_TOKEN = re.compile(r'\s*(?:(\[\d+\])|(\d+\.?\d*(?:[eE][-+]?\d+)?|\.\d+(?:[eE][-+]?\d+)?)|(TMath::\w+|\w+)|(\*\*|[-+*/^(),]))')
+
+
+@lru_cache(maxsize=None)
+def compile_formula(fit_str: str) -> Callable[[np.ndarray, Sequence[float]], np.ndarray]:
+    """
+    Compiles a ROOT TF1 formula string into a vectorised NumPy function.
+
+    Parameters are written as in ROOT ('[0]', '[1]', ...), the variable is 'x',
+    '^' is a power, and the common TMath/TFormula functions (exp, abs, sqrt, ...)
+    are supported. Each formula is translated once per process.
+
+    Args:
+        fit_str (str): The fitting function string in ROOT format (e.g. "[0] * exp(- x / [1]) + [2]").
+
+    Returns:
+        Callable: f(x, params) evaluating the formula on a whole array of x values.
+
+    Raises:
+        ValueError: If the formula contains a token or function with no NumPy equivalent.
+
+    Examples:
+        >>> f = compile_formula('[0] * exp(- x / [1]) + [2]')
+        >>> f(np.array([0., 1.]), [2., 1., 0.5]).round(3).tolist()
+        [2.5, 1.236]
+    """
+    expression, position = [], 0
+    while position < len(fit_str.rstrip()):
+        match = _TOKEN.match(fit_str, position)
+        if not match:
+            raise ValueError(f"Cannot translate '{fit_str[position:].strip()}' in fit string: {fit_str}")
+        parameter, number, name, operator = match.groups()
+        if parameter:
+            expression.append(f'p[{parameter[1:-1]}]')
+        elif number:
+            expression.append(number)
+        elif name:
+            name = name.removeprefix('TMath::')
+            if name == 'x':
+                expression.append('x')
+            elif name in NUMPY_FUNCTIONS:
+                expression.append(NUMPY_FUNCTIONS[name])
+            elif name in NUMPY_CONSTANTS:
+                expression.append(NUMPY_CONSTANTS[name])
+            else:
+                raise ValueError(f"Unsupported name '{name}' in fit string: {fit_str}")
+        else:
+            expression.append('**' if operator == '^' else operator)
+        position = match.end()
+
+    code = compile(' '.join(expression), f'<formula {fit_str}>', 'eval')
+
+    def formula(x: np.ndarray, p: Sequence[float]) -> np.ndarray:
+        return eval(code, {'np': np, '__builtins__': {}}, {'x': np.asarray(x, dtype=np.float64), 'p': p})
+
+    return formula
+
+def count_parameters(fit_str: str) -> int:
+    """Returns the number of parameters of a ROOT formula string (highest index + 1)."""
+    indices = [int(i) for i in re.findall(r'\[(\d+)\]', fit_str)]
+    return max(indices) + 1 if indices else 0
+
+def sig_digits_round(a: float, n: int = 2) -> float | int:
+    if a == 0:
+        return 0
+    rounded_num = round(a, -int(floor(log10(abs(a)))) + (n - 1))
+    return int(rounded_num) if int(rounded_num) == rounded_num else rounded_num
+
+def round_respect_to_error(a: float, err: float, n: int = 2) -> float | int:
+    rounded_err = sig_digits_round(err, n)
+    err_str = str(rounded_err)
+    m = len(err_str)
+    if '.' in err_str: m -= 1
+    return sig_digits_round(a, m)
+
+def _derivative(formula: Callable, x: np.ndarray, params: Sequence[float]) -> np.ndarray:
+    # Central difference in x, with a step relative to the scale of the data
+    h = 1e-6 * np.maximum(np.abs(x), 1.)
+    return (formula(x + h, params) - formula(x - h, params)) / (2 * h)
+
+def _bounds_and_start(n_par: int, par_limits: dict, initial: dict | None) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Lower and upper bounds and start values; bounded parameters start in the middle of their limits."""
+    lower, upper = np.full(n_par, -np.inf), np.full(n_par, np.inf)
+    p0 = np.ones(n_par)
+    for i, (par_min, par_max) in par_limits.items():
+        lower[int(i)], upper[int(i)] = par_min, par_max
+        p0[int(i)] = (par_min + par_max) / 2
+    for i, value in (initial or {}).items():
+        p0[int(i)] = value
+    return lower, upper, p0
+
+def seed_fit(data: tuple, fit_str: str, par_limits: dict, initial: dict | None = None) -> tuple[dict, dict]:
+    """
+    Limits and start values of a fit, seeded by the closed-form pre-fit of its library model.
+
+    Library models (model_tools) estimate their parameters by log-linear least squares, with the offset
+    taken from the tail of the data, and bound them within `mt.SEED_SPREAD` of these estimates. Parameters
+    the pre-fit cannot estimate, and formulas without a library model, keep `par_limits` and `initial`.
+
+    Args:
+        data (tuple): (x, y, delta_x, delta_y).
+        fit_str (str): The fitting function string in ROOT format.
+        par_limits (dict): Fallback {param_index: (min, max)} of every parameter.
+        initial (dict, optional): Fallback start values {param_index: value}.
+
+    Returns:
+        tuple[dict, dict]: {param_index: (min, max)} and {param_index: value}, with integer indices;
+        every start value lies within its limits.
+    """
+    limits = {int(i): tuple(bounds) for i, bounds in par_limits.items()}
+    start = {int(i): value for i, value in (initial or {}).items()}
+    library_model = mt.get_model(fit_str)
+    if library_model is not None and library_model.seed is not None:
+        seeded_start, seeded_limits = library_model.seed(data[0], data[1], data[3])
+        limits.update(seeded_limits)
+        start.update(seeded_start)
+        pf.count('seeded_parameters', len(seeded_start))
+    start = {i: float(np.clip(value, *limits[i])) if i in limits else value for i, value in start.items()}
+    return limits, start
+
+def _statistics(chi2_val: float, ndf: int) -> tuple[float | int, float | int]:
+    """Rounded reduced chi2 and p-value, both 0 without degrees of freedom (as ROOT reports them)."""
+    if ndf <= 0:
+        return 0, 0
+    return sig_digits_round(chi2_val / ndf, n=3), sig_digits_round(float(stats.chi2.sf(chi2_val, ndf)), n=3)
+
+def fit_key(backend: str, data: tuple, *inputs) -> str:
+    """Cache key of a fit: the backend, the (x, y, delta_x, delta_y) arrays by content and every other input."""
+    return inputs_hash(backend, [np.asarray(column, dtype=np.float64) for column in data], *inputs)
+
+
+class FitCache:
+    """
+    Persistent cache of fit results, keyed by a hash of everything a fit depends on.
+
+    Each result is a pickle file named after its key (see `fit_key`), so a material is
+    only refitted when its data, formula, limits, initial values or backend change.
+    When the cache grows beyond `max_bytes`, the least recently used results are
+    deleted. The object holds no open files, so it can be passed to worker processes.
+    """
+    def __init__(self, cache_dir: str = 'Pulse_NMR_61/create_databases/.cache/fits/',
+                 max_bytes: int = 64 << 20, refresh: bool = False):
+        """
+        Args:
+            cache_dir (str, optional): Directory of the cached results.
+            max_bytes (int, optional): Size above which old results are evicted. Defaults to 64 MiB.
+            refresh (bool, optional): Ignore the cached results and refit everything, storing
+                the new results. Defaults to False.
+        """
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.refresh = refresh
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, key + '.pkl')
+
+    def get(self, key: str):
+        """Returns the cached result of `key`, or None."""
+        if self.refresh:
+            return None
+        try:
+            with open(self._path(key), 'rb') as f:
+                value = pickle.load(f)
+            os.utime(self._path(key))  # Marks the result as recently used
+        except (OSError, EOFError, pickle.UnpicklingError):
+            return None
+        return value
+
+    def put(self, key: str, value) -> None:
+        """Stores a result, then evicts the least recently used ones if the cache is too large."""
+        os.makedirs(self.cache_dir, exist_ok=True)
+        # Unique temporary name, so concurrent workers never write the same file
+        tmp_path = f'{self._path(key)}.{os.getpid()}.{threading.get_ident()}.tmp'
+        with open(tmp_path, 'wb') as f:
+            pickle.dump(value, f)
+        os.replace(tmp_path, self._path(key))
+        self._evict()
+
+    def clear(self) -> None:
+        """Deletes every cached result."""
+        for entry in os.scandir(self.cache_dir) if os.path.isdir(self.cache_dir) else ():
+            if entry.name.endswith('.pkl'):
+                os.remove(entry.path)
+
+    def _evict(self) -> None:
+        entries = []
+        for entry in os.scandir(self.cache_dir):
+            if entry.name.endswith('.pkl'):
+                try:
+                    info = entry.stat()
+                except FileNotFoundError:  # Evicted by another worker meanwhile
+                    continue
+                entries.append((info.st_mtime, info.st_size, entry.path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+
+
+def fit_formula(data: tuple, fit_str: str, par_limits: dict[int | str, tuple[float, float] | float],
+                initial: dict[int | str, float] | None = None, max_iterations: int = 5,
+                cache: FitCache | None = None) -> dict:
+    """
+    Fits a ROOT formula string with SciPy, following the conventions of `root_tools.draw_canvas`.
+
+    As in `draw_canvas`, `par_limits` is either all (min, max) tuples, which are fitted
+    within those limits, or all single values, which are only evaluated (no fit). The
+    x errors enter through the effective variance dy^2 + (f'(x) dx)^2, as in a ROOT
+    TGraphErrors fit, by refitting until chi2 stops changing.
+
+    Args:
+        data (tuple): (x, y, delta_x, delta_y) as passed to `draw_canvas`.
+        fit_str (str): The fitting function string in ROOT format.
+        par_limits (dict): {param_index: (min, max)} or {param_index: value}.
+        initial (dict, optional): Initial values {param_index: value}. Bounded parameters
+            default to the middle of their limits, unbounded ones to 1.
+        max_iterations (int, optional): Maximum number of effective variance refits. Defaults to 5.
+        cache (FitCache, optional): Returns the stored result if the same fit was done before.
+
+    Returns:
+        dict: 'fitted_params' and 'statistics' as returned by `draw_canvas`, plus the unrounded
+        'popt' and 'perr' lists and the compiled 'function' f(x, params).
+
+    Raises:
+        ValueError: If `par_limits` mixes tuples and single values, or names a parameter
+            not found in `fit_str`.
+    """
+    formula = compile_formula(fit_str)
+    key = fit_key('scipy', data, fit_str, par_limits, initial, max_iterations) if cache is not None else None
+    if key is not None:
+        cached = cache.get(key)
+        if cached is not None:
+            pf.count('fit_cache_hits')
+            return {'function': formula, **cached}
+
+    x, y, dx, dy = (np.asarray(column, dtype=np.float64) for column in data)
+    dx, dy = np.broadcast_to(dx, x.shape), np.broadcast_to(dy, x.shape)
+    n_par = count_parameters(fit_str)
+
+    for i in list(par_limits) + list(initial or {}):
+        if f'[{i}]' not in fit_str:
+            raise ValueError(f"Parameter [{i}] not found in fit string: {fit_str}")
+
+    if all(isinstance(v, (tuple, list)) and len(v) == 2 for v in par_limits.values()):
+        lower, upper, p0 = _bounds_and_start(n_par, par_limits, initial)
+
+        def model(x_values, *params):
+            return np.broadcast_to(formula(x_values, params), x_values.shape)
+
+        # Library models come with closed-form gradients, which replace the finite differences
+        library_model = mt.get_model(fit_str)
+        jacobian = None
+        if library_model is not None:
+            def jacobian(x_values, *params):
+                return library_model.jacobian(x_values, params)
+
+        has_x_errors = bool(np.any(dx > 0))
+        sigma, chi2_val = dy, np.inf
+        evaluations, refits = 0, 0
+        for _ in range(max_iterations):
+            # Points without error get unit weight, as ROOT does when every point has zero error
+            sigma = np.where(sigma > 0, sigma, 1.)
+            popt, pcov, info, _, status = optimize.curve_fit(model, x, y, p0=p0, sigma=sigma, bounds=(lower, upper),
+                                                             absolute_sigma=True, jac=jacobian, full_output=True)
+            evaluations, refits = evaluations + info['nfev'], refits + 1
+            new_chi2 = float(np.sum(((y - model(x, *popt)) / sigma) ** 2))
+            converged = abs(new_chi2 - chi2_val) <= 1e-6 * max(new_chi2, 1.)
+            chi2_val, p0 = new_chi2, popt
+            if not has_x_errors or converged:
+                break
+            sigma = np.sqrt(dy ** 2 + (_derivative(formula, x, popt) * dx) ** 2)
+
+        perr = np.sqrt(np.diag(pcov))
+        chi2_red, p_value = _statistics(chi2_val, len(x) - n_par)
+        # Iterations are the effective variance refits; the optimiser's status is > 0 once it converged
+        pf.record_fit('scipy', evaluations, iterations=refits, converged=status > 0)
+
+    elif all(isinstance(v, (int, float)) for v in par_limits.values()):
+        # Same as draw_canvas with single values: the function is only evaluated, nothing is fitted
+        popt = np.zeros(n_par)
+        for i, value in par_limits.items():
+            popt[int(i)] = value
+        perr = np.zeros(n_par)
+        chi2_red, p_value = 0, 0
+
+    else:
+        raise ValueError("par_limits must be either all (min, max) tuples or all single values")
+
+    fitted_params: dict = {
+        f'par{i}': (round_respect_to_error(float(val), float(err)), sig_digits_round(float(err)))
+        for i, (val, err) in enumerate(zip(popt, perr))
+    }
+    result = {
+        'popt': [float(val) for val in popt],
+        'perr': [float(err) for err in perr],
+        'fitted_params': fitted_params,
+        'statistics': {
+            'chi2_red': chi2_red,
+            'p_value':  p_value
+        }
+    }
+    if key is not None:
+        cache.put(key, result)
+    return {'function': formula, **result}
+
+def pad_datasets(datasets: Sequence[tuple]) -> tuple[np.ndarray, ...]:
+    """
+    Stacks (x, y, delta_x, delta_y) datasets of different lengths into padded 2D arrays.
+
+    Returns:
+        tuple[np.ndarray, ...]: x, y, delta_x, delta_y of shape (n_datasets, longest) and the
+        boolean mask of real points. Padding repeats each dataset's first x, so models stay finite.
+    """
+    n_max = max(len(data[0]) for data in datasets)
+    x, y, dx, dy = (np.zeros((len(datasets), n_max)) for _ in range(4))
+    mask = np.zeros((len(datasets), n_max), dtype=bool)
+    for row, data in enumerate(datasets):
+        columns = [np.asarray(column, dtype=np.float64) for column in data]
+        n = len(columns[0])
+        x[row] = columns[0][0] if n else 0.
+        for target, column in zip((x, y, dx, dy), columns):
+            target[row, :n] = np.broadcast_to(column, (n,))
+        mask[row, :n] = True
+    return x, y, dx, dy, mask
+
+def _per_dataset(option: dict, names: list[str]) -> list:
+    # Options are either given per dataset ({name: option}) or shared by all of them
+    if option and set(option) == set(names):
+        return [option[name] for name in names]
+    return [option] * len(names)
+
+def fit_batch(datasets: dict[str, tuple], fit_str: str, par_limits: dict,
+              initial: dict | None = None, shared: Sequence[int] = (), max_iterations: int = 5) -> dict:
+    """
+    Fits one formula to many datasets at once, as a single stacked least squares problem.
+
+    The datasets are padded into 2D arrays with a mask, the model is evaluated for all of
+    them in one vectorised call, and one optimiser run covers the whole batch. Parameters
+    listed in `shared` take a single value common to every dataset (e.g. a global T_RC);
+    all others are fitted per dataset. The Jacobian is block sparse: each row depends on
+    its own dataset's parameters and on the shared ones only. Library models use their
+    closed-form Jacobian, other formulas finite differences on that sparsity pattern.
+
+    Args:
+        datasets (dict[str, tuple]): {material: (x, y, delta_x, delta_y)}.
+        fit_str (str): The fitting function string in ROOT format.
+        par_limits (dict): {param_index: (min, max)} for every dataset, or
+            {material: {param_index: (min, max)}} per dataset.
+        initial (dict, optional): Initial values, {param_index: value} or per material.
+        shared (Sequence[int], optional): Indices of the parameters common to all datasets.
+            Their limits are the intersection of the datasets' limits.
+        max_iterations (int, optional): Maximum number of effective variance refits. Defaults to 5.
+
+    Returns:
+        dict: 'samples' with {material: result} in the `fit_formula` layout (statistics per
+        dataset count all parameters against its own points), 'shared' with
+        {param_index: (value, error)}, and the global 'statistics' of the batch.
+    """
+    names = list(datasets)
+    if not names:
+        return {'samples': {}, 'shared': {}, 'statistics': {'chi2_red': 0, 'p_value': 0, 'success': True, 'nfev': 0}}
+    formula, library_model = compile_formula(fit_str), mt.get_model(fit_str)
+    n_par, n_samples = count_parameters(fit_str), len(names)
+
+    bounds = [_bounds_and_start(n_par, limits, start)
+              for limits, start in zip(_per_dataset(par_limits, names), _per_dataset(initial or {}, names))]
+    lower, upper, p0 = (np.array([b[k] for b in bounds]) for k in range(3))
+
+    shared = sorted({int(i) for i in shared})
+    own = [i for i in range(n_par) if i not in shared]
+    n_shared, n_own = len(shared), len(own)
+
+    theta_lower = np.concatenate([lower[:, shared].max(axis=0), lower[:, own].ravel()])
+    theta_upper = np.concatenate([upper[:, shared].min(axis=0), upper[:, own].ravel()])
+    theta0 = np.concatenate([p0[:, shared].mean(axis=0), p0[:, own].ravel()])
+    theta0 = np.clip(theta0, theta_lower, theta_upper)
+
+    x, y, dx, dy, mask = pad_datasets([datasets[name] for name in names])
+    rows_sample = np.broadcast_to(np.arange(n_samples)[:, None], mask.shape)[mask]
+    n_rows, n_theta = int(mask.sum()), n_shared + n_samples * n_own
+
+    def unpack(theta):
+        params = np.empty((n_samples, n_par))
+        params[:, shared] = theta[:n_shared]
+        params[:, own] = theta[n_shared:].reshape(n_samples, n_own)
+        return [params[:, [i]] for i in range(n_par)]  # Columns broadcast against (n_samples, n_points)
+
+    # Column of every Jacobian entry: shared parameters first, then each sample's own block
+    row_index = np.repeat(np.arange(n_rows), n_par)
+    col_index = np.empty((n_rows, n_par), dtype=int)
+    col_index[:, shared] = np.arange(n_shared)
+    col_index[:, own] = n_shared + rows_sample[:, None] * n_own + np.arange(n_own)
+    col_index = col_index.ravel()
+
+    def sparse_jacobian(values):
+        return sparse.csr_matrix((values.ravel(), (row_index, col_index)), shape=(n_rows, n_theta))
+
+    sigma = np.where(dy > 0, dy, 1.)
+    has_x_errors = bool(np.any(dx[mask] > 0))
+
+    def residuals(theta):
+        return ((formula(x, unpack(theta)) - y) / sigma)[mask]
+
+    if library_model is not None:
+        def jacobian(theta):
+            return sparse_jacobian(library_model.jacobian(x, unpack(theta))[mask] / sigma[mask][:, None])
+        jac_options = {'jac': jacobian}
+    else:
+        jac_options = {'jac': '2-point', 'jac_sparsity': sparse_jacobian(np.ones((n_rows, n_par)))}
+
+    chi2_val, evaluations, refits = np.inf, 0, 0
+    for _ in range(max_iterations):
+        solution = optimize.least_squares(residuals, theta0, bounds=(theta_lower, theta_upper),
+                                          method='trf', tr_solver='lsmr', x_scale='jac', **jac_options)
+        evaluations, refits = evaluations + solution.nfev, refits + 1
+        new_chi2 = float(np.sum(solution.fun ** 2))
+        converged = abs(new_chi2 - chi2_val) <= 1e-6 * max(new_chi2, 1.)
+        chi2_val, theta0 = new_chi2, solution.x
+        if not has_x_errors or converged:
+            break
+        derivative = _derivative(formula, x, unpack(theta0))
+        sigma = np.sqrt(dy ** 2 + (derivative * dx) ** 2)
+        sigma = np.where(sigma > 0, sigma, 1.)
+
+    pf.record_fit('batch', evaluations, iterations=refits, converged=solution.status > 0)
+
+    jac_final = solution.jac if sparse.issparse(solution.jac) else sparse.csr_matrix(solution.jac)
+    covariance = np.linalg.pinv((jac_final.T @ jac_final).toarray())
+    theta, theta_err = solution.x, np.sqrt(np.diag(covariance))
+    values, errors = np.array(unpack(theta))[..., 0].T, np.array(unpack(theta_err))[..., 0].T
+
+    samples = {}
+    sample_chi2 = np.bincount(rows_sample, weights=solution.fun ** 2, minlength=n_samples)
+    for row, name in enumerate(names):
+        chi2_red, p_value = _statistics(float(sample_chi2[row]), int(mask[row].sum()) - n_par)
+        samples[name] = {
+            'function': formula,
+            'popt': [float(val) for val in values[row]],
+            'perr': [float(err) for err in errors[row]],
+            'fitted_params': {
+                f'par{i}': (round_respect_to_error(float(val), float(err)), sig_digits_round(float(err)))
+                for i, (val, err) in enumerate(zip(values[row], errors[row]))
+            },
+            'statistics': {'chi2_red': chi2_red, 'p_value': p_value}
+        }
+
+    chi2_red, p_value = _statistics(chi2_val, n_rows - n_theta)
+    return {
+        'samples': samples,
+        'shared': {i: (float(theta[k]), float(theta_err[k])) for k, i in enumerate(shared)},
+        'statistics': {'chi2_red': chi2_red, 'p_value': p_value, 'success': bool(solution.success), 'nfev': int(solution.nfev)}
+    }
+
+
+BOOTSTRAP_METHODS: tuple[str, ...] = ('parametric', 'residuals', 'pairs')
+
+def _replicate_jacobian(formula: Callable, library_model: mt.Model | None, x: np.ndarray, params: np.ndarray) -> np.ndarray:
+    """df/dparam of every replicate, shape (n_replicates, n_points, n_par); x is (n_replicates, n_points)."""
+    columns = [params[:, [i]] for i in range(params.shape[1])]
+    if library_model is not None:
+        return np.broadcast_to(library_model.jacobian(x, columns), x.shape + (params.shape[1],))
+    # Forward differences, one parameter at a time for all replicates
+    f0 = np.broadcast_to(formula(x, columns), x.shape)
+    jacobian = np.empty(x.shape + (params.shape[1],))
+    for i in range(params.shape[1]):
+        h = 1e-7 * np.maximum(np.abs(params[:, i]), 1e-3)
+        shifted = list(columns)
+        shifted[i] = (params[:, i] + h)[:, None]
+        jacobian[..., i] = (np.broadcast_to(formula(x, shifted), x.shape) - f0) / h[:, None]
+    return jacobian
+
+def fit_replicates(x: np.ndarray, y: np.ndarray, delta_x: np.ndarray, delta_y: np.ndarray, fit_str: str,
+                   lower: np.ndarray, upper: np.ndarray, p0: np.ndarray,
+                   max_iterations: int = 100, max_refits: int = 5) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Fits one formula to many replicates of a dataset at once, with a vectorised Levenberg-Marquardt.
+
+    Every replicate is an independent fit with its own damping, but all of them are advanced
+    together: the model, the Jacobian (closed-form for library models) and the normal equations
+    of all replicates still iterating are evaluated as stacked arrays. Steps are projected onto
+    the limits. The x errors enter through the effective variance, as in `fit_formula`.
+
+    Args:
+        x, y, delta_x, delta_y (np.ndarray): Data of shape (n_replicates, n_points), or (n_points,)
+            for columns shared by all replicates.
+        fit_str (str): The fitting function string in ROOT format.
+        lower, upper (np.ndarray): Parameter limits, shape (n_par,).
+        p0 (np.ndarray): Start values, shape (n_par,) or (n_replicates, n_par).
+        max_iterations (int, optional): Maximum number of iterations per fit. Defaults to 100.
+        max_refits (int, optional): Maximum number of effective variance refits. Defaults to 5.
+
+    Returns:
+        tuple[np.ndarray, np.ndarray, np.ndarray]: Parameters (n_replicates, n_par), chi2 and
+        whether each fit converged.
+    """
+    formula, library_model = compile_formula(fit_str), mt.get_model(fit_str)
+    y = np.atleast_2d(np.asarray(y, dtype=np.float64))
+    x, dx, dy = (np.broadcast_to(np.asarray(column, dtype=np.float64), y.shape) for column in (x, delta_x, delta_y))
+    n_replicates, n_par = len(y), len(lower)
+    params = np.clip(np.broadcast_to(np.asarray(p0, dtype=np.float64), (n_replicates, n_par)), lower, upper)
+
+    def model(p, rows):
+        return np.broadcast_to(formula(x[rows], [p[:, [i]] for i in range(n_par)]), (len(rows), y.shape[1]))
+
+    all_rows = np.arange(n_replicates)
+    sigma = np.where(dy > 0, dy, 1.)
+    has_x_errors = bool(np.any(dx > 0))
+    previous_chi2 = np.full(n_replicates, np.inf)
+    for _ in range(max_refits if has_x_errors else 1):
+        residual = (y - model(params, all_rows)) / sigma
+        chi2 = np.sum(residual ** 2, axis=1)
+        damping = np.full(n_replicates, 1e-3)
+        converged = np.zeros(n_replicates, dtype=bool)
+        active = np.ones(n_replicates, dtype=bool)
+
+        for _ in range(max_iterations):
+            rows = np.flatnonzero(active)
+            if not rows.size:
+                break
+            p = params[rows]
+            jacobian = _replicate_jacobian(formula, library_model, x[rows], p) / sigma[rows][..., None]
+            transposed = jacobian.transpose(0, 2, 1)
+            normal = transposed @ jacobian
+            gradient = (transposed @ residual[rows][..., None])[..., 0]
+            # Marquardt's scaling of the damping by the diagonal keeps the step independent of the parameter units
+            scale = damping[rows][:, None] * np.maximum(np.einsum('kpp->kp', normal), 1e-12)
+            step = np.linalg.solve(normal + scale[..., None] * np.eye(n_par), gradient[..., None])[..., 0]
+
+            trial = np.clip(p + step, lower, upper)
+            trial_residual = (y[rows] - model(trial, rows)) / sigma[rows]
+            trial_chi2 = np.sum(trial_residual ** 2, axis=1)
+            better = trial_chi2 < chi2[rows]
+            improvement = chi2[rows] - trial_chi2
+
+            accepted = rows[better]
+            params[accepted], residual[accepted], chi2[accepted] = trial[better], trial_residual[better], trial_chi2[better]
+            damping[rows] = np.where(better, damping[rows] / 3, damping[rows] * 4)
+
+            # Done once an accepted step barely lowers chi2, or no step lowers it at all (a minimum on a limit)
+            done = (better & (improvement <= 1e-10 * np.maximum(chi2[rows], 1.))) | (damping[rows] > 1e10)
+            converged[rows[done]] = True
+            active[rows[done]] = False
+
+        if not has_x_errors or np.all(np.abs(chi2 - previous_chi2) <= 1e-6 * np.maximum(chi2, 1.)):
+            break
+        previous_chi2 = chi2
+        derivative = _derivative(formula, x, [params[:, [i]] for i in range(n_par)])
+        sigma = np.sqrt(dy ** 2 + (derivative * dx) ** 2)
+        sigma = np.where(sigma > 0, sigma, 1.)
+
+    return params, chi2, converged & np.isfinite(chi2)
+
+def _bootstrap_chunk(data: tuple, fit_str: str, lower: np.ndarray, upper: np.ndarray, popt: np.ndarray,
+                     method: str, n_replicates: int, seed: np.random.SeedSequence) -> tuple[np.ndarray, np.ndarray]:
+    """Refits `n_replicates` resampled copies of a dataset around its best fit `popt`; runs in a worker process."""
+    rng = np.random.default_rng(seed)
+    formula = compile_formula(fit_str)
+    x, y, dx, dy = (np.asarray(column, dtype=np.float64) for column in data)
+    dx, dy = np.broadcast_to(dx, x.shape), np.broadcast_to(dy, x.shape)
+    y_fit = np.broadcast_to(formula(x, popt), x.shape)
+
+    if method == 'parametric':
+        # New measurements drawn around the best fit, with the (effective) errors of the data
+        sigma = np.sqrt(dy ** 2 + (_derivative(formula, x, popt) * dx) ** 2)
+        y = y_fit + rng.standard_normal((n_replicates, len(x))) * np.where(sigma > 0, sigma, 1.)
+    elif method == 'residuals':
+        y = y_fit + (y - y_fit)[rng.integers(0, len(x), (n_replicates, len(x)))]
+    else:
+        # 'pairs': the points themselves are drawn with replacement
+        rows = rng.integers(0, len(x), (n_replicates, len(x)))
+        x, y, dx, dy = x[rows], y[rows], dx[rows], dy[rows]
+
+    params, _, converged = fit_replicates(x, y, dx, dy, fit_str, lower, upper, popt)
+    return params, converged
+
+def bootstrap(datasets: dict[str, tuple], fit_str: str, par_limits: dict, n_replicates: int = 1000,
+              method: str = 'parametric', initial: dict | None = None, seed: int = 0, workers: int | None = 1,
+              chunk_size: int = 250, cache: FitCache | None = None) -> dict[str, dict]:
+    """
+    Bootstrap parameter errors: refits many resampled copies of every dataset.
+
+    Each dataset is first fitted with `fit_formula` (from the cache if given). Its replicates are
+    then drawn around that fit and refitted with `fit_replicates`, `chunk_size` replicates per
+    vectorised call; with `workers` other than 1 the chunks of all datasets are spread over a pool
+    of worker processes. Every chunk has its own seed, so the result does not depend on `workers`.
+
+    Args:
+        datasets (dict[str, tuple]): {material: (x, y, delta_x, delta_y)}.
+        fit_str (str): The fitting function string in ROOT format.
+        par_limits (dict): {param_index: (min, max)} for every dataset, or per material.
+        n_replicates (int, optional): Replicates per dataset. Defaults to 1000.
+        method (str, optional): 'parametric' (Gaussian noise with the data's errors around the fit),
+            'residuals' (the fit plus resampled residuals) or 'pairs' (resampled points). Defaults to 'parametric'.
+        initial (dict, optional): Initial values of the first fit, {param_index: value} or per material.
+        seed (int, optional): Seed of the resampling. Defaults to 0.
+        workers (int | None, optional): Worker processes; 1 runs in this process, None uses one per CPU. Defaults to 1.
+        chunk_size (int, optional): Replicates fitted per vectorised call. Defaults to 250.
+        cache (FitCache, optional): Cache of the first fits.
+
+    Returns:
+        dict[str, dict]: Per material: 'method', 'replicates', 'converged' (number of replicate fits
+        that converged), and per parameter ('par0', ...) the standard deviation ('errors') and the
+        central 68% interval ('interval_68') of the converged replicates.
+
+    Raises:
+        ValueError: For an unknown `method`.
+    """
+    if method not in BOOTSTRAP_METHODS:
+        raise ValueError(f"Unknown bootstrap method '{method}', expected one of {BOOTSTRAP_METHODS}")
+    names = list(datasets)
+    n_par = count_parameters(fit_str)
+    n_chunks = -(-n_replicates // chunk_size)
+    seeds = iter(np.random.SeedSequence(seed).spawn(len(names) * n_chunks))
+
+    tasks = []
+    for name, limits, start in zip(names, _per_dataset(par_limits, names), _per_dataset(initial or {}, names)):
+        centre = fit_formula(datasets[name], fit_str, limits, initial=start, cache=cache)
+        lower, upper, _ = _bounds_and_start(n_par, limits, None)
+        data = tuple(np.asarray(column, dtype=np.float64) for column in datasets[name])
+        for offset in range(0, n_replicates, chunk_size):
+            size = min(chunk_size, n_replicates - offset)
+            tasks.append((name, (data, fit_str, lower, upper, np.array(centre['popt']), method, size, next(seeds))))
+
+    if workers == 1:
+        chunks = [_bootstrap_chunk(*args) for _, args in tasks]
+    else:
+        with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn')) as executor:
+            chunks = list(executor.map(_bootstrap_chunk, *zip(*(args for _, args in tasks))))
+    pf.count('bootstrap_replicates', n_replicates * len(names))
+
+    results = {}
+    for name in names:
+        params = np.concatenate([p for (task_name, _), (p, _) in zip(tasks, chunks) if task_name == name])
+        converged = np.concatenate([c for (task_name, _), (_, c) in zip(tasks, chunks) if task_name == name])
+        good = params[converged]
+        errors = good.std(axis=0, ddof=1) if len(good) > 1 else np.full(n_par, np.nan)
+        low, high = np.percentile(good, [15.865, 84.135], axis=0) if len(good) else (errors, errors)
+        results[name] = {
+            'method': method,
+            'replicates': n_replicates,
+            'converged': int(converged.sum()),
+            'errors': {f'par{i}': float(err) for i, err in enumerate(errors)},
+            'interval_68': {f'par{i}': (float(lo), float(hi)) for i, (lo, hi) in enumerate(zip(low, high))}
+        }
+    return results
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
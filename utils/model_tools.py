@@ -0,0 +1,256 @@
+from collections.abc import Callable, Sequence
+from dataclasses import dataclass
+import numpy as np
+
+from utils import lazy_import
+
+# SciPy is only imported once a seed is actually refined
+optimize = lazy_import('scipy.optimize')
+
+# Seeded limits reach from value / SEED_SPREAD to value * SEED_SPREAD for amplitudes and times
+SEED_SPREAD: float = 3.
+
+
+@dataclass(frozen=True)
+class Model:
+    """
+    A relaxation model with its closed-form gradient.
+
+    Attributes:
+        fit_str (str): The model as a ROOT formula string, as used by the analysis scripts.
+        param_names (tuple[str, ...]): Names of [0], [1], ... in `fit_str`.
+        function (Callable): f(x, params) -> values, vectorised over x.
+        jacobian (Callable): J(x, params) -> array of shape (len(x), n_params) of df/dparam.
+        seed (Callable | None): seed(x, y, dy) -> ({param_index: start}, {param_index: (min, max)}),
+            the closed-form pre-fit of the parameters it can estimate from the data.
+    """
+    fit_str: str
+    param_names: tuple[str, ...]
+    function: Callable[[np.ndarray, Sequence[float]], np.ndarray]
+    jacobian: Callable[[np.ndarray, Sequence[float]], np.ndarray]
+    seed: Callable[[np.ndarray, np.ndarray, np.ndarray], tuple[dict, dict]] | None = None
+
+
+def inversion_recovery(x, p):
+    """T1 inversion recovery: |A * (1 - 2 exp(-x / T1))|."""
+    A, T1 = p[0], p[1]
+    return np.abs(A * (1 - 2 * np.exp(- x / T1)))
+
+def inversion_recovery_jacobian(x, p):
+    A, T1 = p[0], p[1]
+    decay = np.exp(- x / T1)
+    sign = np.sign(A * (1 - 2 * decay))
+    return np.stack([
+        sign * (1 - 2 * decay),
+        sign * A * (-2 * decay * x / T1 ** 2),
+    ], axis=-1)
+
+def exponential_envelope(x, p):
+    """T2 echo envelope: A * exp(-x / T2) + C."""
+    A, T2, C = p[0], p[1], p[2]
+    return A * np.exp(- x / T2) + C
+
+def exponential_envelope_jacobian(x, p):
+    A, T2 = p[0], p[1]
+    decay = np.exp(- x / T2)
+    return np.stack([
+        decay,
+        A * decay * x / T2 ** 2,
+        np.ones_like(decay),
+    ], axis=-1)
+
+def rc_fid(x, p):
+    """T2* free induction decay seen through an RC filter: A * (1 - exp(-s / T_RC)) * exp(-s / T2) + C, s = x - t0."""
+    A, T2, C, t0, T_RC = p[0], p[1], p[2], p[3], p[4]
+    s = x - t0
+    return A * (1 - np.exp(- s / T_RC)) * np.exp(- s / T2) + C
+
+def rc_fid_jacobian(x, p):
+    A, T2, C, t0, T_RC = p[0], p[1], p[2], p[3], p[4]
+    s = x - t0
+    rise, decay = np.exp(- s / T_RC), np.exp(- s / T2)
+    return np.stack([
+        (1 - rise) * decay,
+        A * (1 - rise) * decay * s / T2 ** 2,
+        np.ones_like(s),
+        -A * decay * (rise / T_RC - (1 - rise) / T2),
+        -A * rise * decay * s / T_RC ** 2,
+    ], axis=-1)
+
+def _line_fit(x: np.ndarray, z: np.ndarray, weights: np.ndarray) -> tuple[float, float] | None:
+    """Weighted least squares line z = a + b x; None without two distinct x."""
+    if len(x) < 2 or np.ptp(x) == 0:
+        return None
+    root_w = np.sqrt(weights)
+    (a, b), *_ = np.linalg.lstsq(np.stack([np.ones_like(x), x], axis=-1) * root_w[:, None], z * root_w, rcond=None)
+    return float(a), float(b)
+
+def _tail(y: np.ndarray, fraction: float = 0.2) -> float:
+    """Median of the last `fraction` of the points (at least two), where a decay has reached its offset."""
+    return float(np.median(y[-max(int(fraction * len(y)), 2):]))
+
+def _linear_offset_fit(x: np.ndarray, z: np.ndarray, weights: np.ndarray, T: float) -> tuple[float, float, float]:
+    """Weighted linear least squares of z = c + a exp(-x / T) for a fixed T; returns (a, c, chi2)."""
+    root_w = np.sqrt(weights)
+    design = np.stack([np.ones_like(x), np.exp(- x / T)], axis=-1) * root_w[:, None]
+    (c, a), *_ = np.linalg.lstsq(design, z * root_w, rcond=None)
+    return float(a), float(c), float(np.sum((design @ (c, a) - z * root_w) ** 2))
+
+def _exponential_prefit(x: np.ndarray, z: np.ndarray, dz: np.ndarray, offset: float) -> tuple[float, float, float] | None:
+    """
+    Estimates z = c + a exp(-x / T), starting from the offset c = `offset` (e.g. the tail of a decay).
+
+    A weighted least squares line through ln|z - c| gives T (only the points above the noise, weighted
+    by (z - c)^2 / dz^2 as the log compresses their errors). As an offset taken from a tail that has not
+    fully decayed biases that slope, T is then refined within SEED_SPREAD of it, a and c being the linear
+    least squares solution for every T. Returns (a, T, c), or None if the data does not decay.
+    """
+    weights = 1 / np.where(dz > 0, dz, 1.) ** 2
+    sign = np.sign(np.mean(z[:max(len(z) // 3, 1)] - offset)) or 1.
+    v = sign * (z - offset)
+    keep = v > np.maximum(dz, 0.)
+    if keep.sum() < 2:
+        keep = v > 0
+    line = _line_fit(x[keep], np.log(v[keep]), weights[keep] * v[keep] ** 2) if keep.sum() >= 2 else None
+    if line is None or not line[1] < 0:
+        return None
+
+    log_T = np.log(-1 / line[1])
+    refined = optimize.minimize_scalar(lambda u: _linear_offset_fit(x, z, weights, np.exp(u))[2], method='bounded',
+                                       bounds=(log_T - np.log(SEED_SPREAD), log_T + np.log(SEED_SPREAD)))
+    T = float(np.exp(refined.x))
+    a, c, _ = _linear_offset_fit(x, z, weights, T)
+    if not (np.isfinite(a) and np.isfinite(c)) or np.sign(a) != sign:
+        return None
+    return a, T, c
+
+def _scale_limits(value: float) -> tuple[float, float]:
+    low, high = sorted((value / SEED_SPREAD, value * SEED_SPREAD))
+    return low, high
+
+def _offset_limits(value: float, width: float) -> tuple[float, float]:
+    return value - width, value + width
+
+def _sorted_data(x, y, dy) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    x, y, dy = (np.asarray(column, dtype=np.float64) for column in (x, y, dy))
+    order = np.argsort(x, kind='stable')
+    return x[order], y[order], np.broadcast_to(dy, x.shape)[order]
+
+def inversion_recovery_seed(x, y, dy) -> tuple[dict, dict]:
+    """
+    Pre-fit of |A (1 - 2 exp(-x / T1))|: the points before the minimum are negative, so the signed
+    recovery A - 2 A exp(-x / T1) is a decay onto the plateau A, which starts at the largest |V|.
+    """
+    x, y, dy = _sorted_data(x, y, dy)
+    if len(x) < 3:
+        return {}, {}
+    signed = np.where(x < x[np.argmin(y)], -y, y)
+    prefit = _exponential_prefit(x, signed, dy, float(np.max(y)))
+    if prefit is None or prefit[2] <= 0:
+        return {}, {}
+    _, T1, A = prefit
+    return {0: A, 1: T1}, {0: _scale_limits(A), 1: _scale_limits(T1)}
+
+def exponential_envelope_seed(x, y, dy) -> tuple[dict, dict]:
+    """Pre-fit of A exp(-x / T2) + C, the offset C starting from the tail of the envelope."""
+    x, y, dy = _sorted_data(x, y, dy)
+    if len(x) < 3:
+        return {}, {}
+    prefit = _exponential_prefit(x, y, dy, _tail(y))
+    if prefit is None:
+        return {}, {}
+    A, T2, C = prefit
+    return {0: A, 1: T2, 2: C}, {0: _scale_limits(A), 1: _scale_limits(T2), 2: _offset_limits(C, abs(A) / SEED_SPREAD)}
+
+def _rise_prefit(x: np.ndarray, y: np.ndarray, A: float, T2: float, C: float) -> tuple[float, float] | None:
+    """t0 and T_RC from the points before the maximum: ln(1 - (y - C) / (A exp(-x / T2))) = (t0 - x) / T_RC."""
+    rise = (y - C) / (A * np.exp(- x / T2))
+    keep = (rise > 0) & (rise < 1)
+    line = _line_fit(x[keep], np.log(1 - rise[keep]), np.ones(int(keep.sum()))) if keep.sum() >= 2 else None
+    if line is None or not line[1] < 0:
+        return None
+    T_RC = -1 / line[1]
+    return line[0] * T_RC, T_RC
+
+def rc_fid_seed(x, y, dy) -> tuple[dict, dict]:
+    """
+    Pre-fit of A (1 - exp(-(x - t0) / T_RC)) exp(-(x - t0) / T2) + C: the decay after the maximum
+    gives T2 and C (from the tail), and the rise before it, divided by that decay, a line for t0 and
+    T_RC. The decay is then refitted from t0 + 3 T_RC, where the filter has settled, and A and C solved
+    by linear least squares. Without enough rise points t0 and T_RC are left to the caller.
+    """
+    x, y, dy = _sorted_data(x, y, dy)
+    peak = int(np.argmax(y)) if len(x) else 0
+    if len(x) - peak < 3:
+        return {}, {}
+    prefit = _exponential_prefit(x[peak:], y[peak:], dy[peak:], _tail(y))
+    if prefit is None or prefit[0] <= 0:
+        return {}, {}
+    A, T2, C = prefit
+    initial = {0: A, 1: T2, 2: C}
+
+    rise = _rise_prefit(x[:peak], y[:peak], A, T2, C)
+    if rise is not None:
+        t0, T_RC = rise
+        settled = x >= max(t0 + 3 * T_RC, x[peak])
+        if settled.sum() >= 3:
+            prefit = _exponential_prefit(x[settled], y[settled], dy[settled], C)
+            if prefit is not None and prefit[0] > 0:
+                A, T2, C = prefit
+                rise = _rise_prefit(x[:peak], y[:peak], A, T2, C) or rise
+        t0, T_RC = rise
+        # With the shape fixed the model is linear in A and C
+        shape = rc_fid(x, (1., T2, 0., t0, T_RC))
+        root_w = 1 / np.where(dy > 0, dy, 1.)
+        (A, C), *_ = np.linalg.lstsq(np.stack([shape, np.ones_like(x)], axis=-1) * root_w[:, None], y * root_w, rcond=None)
+        if not A > 0:
+            return {}, {}
+        initial = {0: A, 1: T2, 2: C, 3: t0, 4: T_RC}
+
+    # t0 and T_RC are properties of the apparatus: only their start values are seeded, their limits are the caller's
+    limits = {0: _scale_limits(initial[0]), 1: _scale_limits(T2), 2: _offset_limits(initial[2], initial[0] / SEED_SPREAD)}
+    return {i: float(value) for i, value in initial.items()}, limits
+
+
+def echo_train(x, p):
+    """T2 CPMG echo train: Gaussian echoes of width w at x = 2 k tau (k >= 1) under A * exp(-x / T2), on a baseline C."""
+    A, T2, C, tau, w = p[0], p[1], p[2], p[3], p[4]
+    echo_time = 2 * tau * np.maximum(np.rint(x / (2 * tau)), 1)  # Nearest echo
+    return A * np.exp(- x / T2) * np.exp(- 0.5 * ((x - echo_time) / w) ** 2) + C
+
+
+MODELS: tuple[Model, ...] = (
+    Model('abs([0] * (1 - 2 * exp(- x / [1])))', ('A', 'T1'),
+          inversion_recovery, inversion_recovery_jacobian, inversion_recovery_seed),
+    Model('[0] * exp(- x / [1]) + [2]', ('A', 'T2', 'C'),
+          exponential_envelope, exponential_envelope_jacobian, exponential_envelope_seed),
+    Model('[0] * (1 - exp(- (x - [3]) / [4])) * exp(- (x - [3]) / [1]) + [2]', ('A', 'T2', 'C', 't0', 'T_RC'),
+          rc_fid, rc_fid_jacobian, rc_fid_seed),
+)
+
+def _normalise(fit_str: str) -> str:
+    return ''.join(fit_str.split())
+
+_MODELS_BY_FORMULA: dict[str, Model] = {_normalise(model.fit_str): model for model in MODELS}
+
+def get_model(fit_str: str) -> Model | None:
+    """Returns the library model of a ROOT formula string (whitespace is ignored), or None if there is none."""
+    return _MODELS_BY_FORMULA.get(_normalise(fit_str))
+
+
+if __name__ == '__main__':
+    # Check every closed-form gradient against central differences
+    x = np.linspace(0.05, 3, 50)
+    for model, p in zip(MODELS, ([12., 1.6], [30., 1.5, 3.], [40., 0.15, 3., 0.01, 0.1])):
+        numeric = np.stack([
+            (model.function(x, np.add(p, h)) - model.function(x, np.subtract(p, h))) / (2e-6 * p[i])
+            for i, h in enumerate(np.diag(1e-6 * np.array(p)))
+        ], axis=-1)
+        print(model.param_names, np.max(np.abs(numeric - model.jacobian(x, p))))
+
+    # Seeds of noisy data, next to the true parameters
+    rng = np.random.default_rng(0)
+    for model, p in zip(MODELS, ([12., 1.6], [30., 1.5, 3.], [40., 0.15, 3., 0.01, 0.1])):
+        y = model.function(x, p) + rng.normal(0, 0.1, len(x))
+        initial, _ = model.seed(x, y, np.full(len(x), 0.1))
+        print(model.param_names, p, [round(initial.get(i, np.nan), 3) for i in range(len(p))])
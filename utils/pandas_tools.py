@@ -1,9 +1,23 @@
-import pandas as pd
+from __future__ import annotations
+
+import os
+import re
+import glob
+import json
+import heapq
+import pickle
+import hashlib
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from collections.abc import Callable, Iterable, Iterator
 import numpy as np
-from uncertainties import ufloat
-from scipy.signal import find_peaks, savgol_filter
 
-print('PANDAS TOOLS LIBRARY')
+from utils import lazy_import
+from utils import profile_tools as pf
+
+# SciPy is only imported by the functions that use it
+signal = lazy_import('scipy.signal')
+
 
 def extract_xy_data_from_excel(
     filename: str,
@@ -27,24 +41,262 @@ def extract_xy_data_from_excel(
         tuple[np.ndarray, np.ndarray]: Two NumPy arrays: X values and Y values,
         with rows filtered to only include those where X >= 0.
     """
-    # Load the Excel sheet with no automatic header parsing
-    df = pd.read_excel(filename, sheet_name=sheet_name, header=None)
-
-    # Convert Excel column letters to zero-based indices
-    x_idx = excel_col_to_index(x_col)
-    y_idx = excel_col_to_index(y_col)
-
-    # Extract X and Y columns starting from the header row
-    x = df.iloc[header_row:, x_idx]
-    y = df.iloc[header_row:, y_idx]
+    # Stream only the two columns, from the header row to the end of the sheet
+    first_row = header_row + 1  # Excel rows are 1-based
+    columns = read_ranges(filename, {'xy': {'x': f'{x_col}{first_row}:{x_col}', 'y': f'{y_col}{first_row}:{y_col}'}},
+                          sheet_names=[sheet_name])[sheet_name]['xy']
+    x, y = columns['x'], columns['y']
 
     # Filter out rows where X is negative or NaN
     valid_mask = x >= 0
-    x = x[valid_mask].to_numpy()
-    y = y[valid_mask].to_numpy()
+    x = x[valid_mask]
+    y = y[valid_mask]
 
     return x, y
 
+def file_sha256(filename: str, block_size: int = 1 << 20) -> str:
+    """Return the SHA-256 hex digest of a file's content, read in blocks."""
+    digest = hashlib.sha256()
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+def parse_range(ref: str) -> tuple[int, int, int | None, bool]:
+    """
+    Parses a single-column cell range of a layout spec.
+
+    Args:
+        ref (str): A cell ('AA5'), a column range ('T8:T19'), or a column range open
+            to the end of the sheet ('AA10:AA').
+
+    Returns:
+        tuple[int, int, int | None, bool]: 0-based column, first and last 1-based rows
+            (None: to the end of the sheet), and whether `ref` is a single cell.
+    """
+    match = re.fullmatch(r'([A-Za-z]+)(\d+)(?::([A-Za-z]+)(\d*))?', ref.strip())
+    if match is None:
+        raise ValueError(f"Invalid cell range '{ref}'")
+    col, first_row, last_col, last_row = match.groups()
+    if last_col is None:
+        return excel_col_to_index(col), int(first_row), int(first_row), True
+    if last_col.upper() != col.upper():
+        raise ValueError(f"Cell range '{ref}' spans several columns; give each column its own name")
+    return excel_col_to_index(col), int(first_row), int(last_row) if last_row else None, False
+
+def load_layout(path: str) -> dict[str, dict[str, str]]:
+    """Loads a layout spec: {measurement: {name: cell range}}, see `parse_range`."""
+    with open(path, 'r') as f:
+        layout = json.load(f)
+    for ranges in layout.values():
+        for ref in ranges.values():
+            parse_range(ref)  # Fail on a typo now rather than halfway through a workbook
+    return layout
+
+def _to_float(values: list) -> np.ndarray:
+    # Numbers are kept, empty or text cells become NaN
+    return np.array([value if isinstance(value, (int, float)) and not isinstance(value, bool) else np.nan
+                     for value in values], dtype=np.float64)
+
+def read_ranges(filename: str, layout: dict[str, dict[str, str]], sheet_names: list[str] | None = None) -> dict[str, dict[str, dict]]:
+    """
+    Reads the named cell ranges of a layout spec from every sheet of a workbook.
+
+    The workbook is opened in read-only mode and each sheet is streamed row by row,
+    keeping only the requested cells, so memory grows with the requested columns
+    rather than with the sheet. Reading stops at the last requested row when no
+    range is open-ended.
+
+    Args:
+        filename (str): Path to the Excel file.
+        layout (dict[str, dict[str, str]]): {measurement: {name: cell range}}, e.g.
+            {'T2': {'time': 'AA10:AA', 'tau': 'AA5'}}; see `parse_range`.
+        sheet_names (list[str] | None, optional): Sheets to read. Defaults to all, in workbook order.
+
+    Returns:
+        dict[str, dict[str, dict]]: {sheet: {measurement: {name: value}}}. Single cells give the cell's
+            value, column ranges a float64 array with NaN for empty or text cells; open-ended ranges
+            end at their last non-empty cell.
+    """
+    from openpyxl import load_workbook  # Imported here so importing the module stays cheap
+
+    ranges = {(measurement, name): parse_range(ref) for measurement, names in layout.items() for name, ref in names.items()}
+    min_row = min(first for _, first, _, _ in ranges.values())
+    max_row = None if any(last is None for _, _, last, _ in ranges.values()) else max(last for _, _, last, _ in ranges.values())
+    min_col = min(col for col, _, _, _ in ranges.values())
+    max_col = max(col for col, _, _, _ in ranges.values())
+
+    workbook = load_workbook(filename, read_only=True, data_only=True)
+    try:
+        sheets = {}
+        for sheet_name in sheet_names or workbook.sheetnames:
+            worksheet = workbook[sheet_name]
+            values = {key: [] for key in ranges}
+            with pf.span(sheet_name, 'read'):
+                rows = worksheet.iter_rows(min_row=min_row, max_row=max_row, min_col=min_col + 1, max_col=max_col + 1, values_only=True)
+                for row_number, row in enumerate(rows, start=min_row):
+                    for key, (col, first, last, _) in ranges.items():
+                        if first <= row_number and (last is None or row_number <= last):
+                            values[key].append(row[col - min_col] if col - min_col < len(row) else None)
+
+            cells: dict[str, dict] = {measurement: {} for measurement in layout}
+            for (measurement, name), (_, _, last, single) in ranges.items():
+                column = values[(measurement, name)]
+                if single:
+                    cells[measurement][name] = column[0] if column else None
+                    continue
+                if last is None:
+                    while column and column[-1] is None:
+                        column.pop()
+                cells[measurement][name] = _to_float(column)
+            sheets[sheet_name] = cells
+        return sheets
+    finally:
+        workbook.close()
+
+def layout_sha256(layout: dict[str, dict[str, str]]) -> str:
+    return hashlib.sha256(json.dumps(layout, sort_keys=True).encode()).hexdigest()
+
+def snapshot_path(content_sha256: str, layout: dict[str, dict[str, str]], cache_dir: str) -> str:
+    """Cache file of a workbook's snapshot; it changes with the workbook's content and with the layout."""
+    return os.path.join(cache_dir, f'{content_sha256}_{layout_sha256(layout)[:16]}.pkl')
+
+def load_workbook_snapshot(filename: str, layout: dict[str, dict[str, str]],
+                           cache_dir: str = 'Pulse_NMR_61/create_databases/.cache/') -> dict[str, dict[str, dict]]:
+    """
+    Reads the layout's cell ranges from every sheet of a workbook once and caches the result on disk.
+
+    The snapshot is keyed by the workbook's content hash and by the layout, so an edited
+    workbook (or layout) is re-read while an unchanged one is loaded straight from the cache.
+
+    Args:
+        filename (str): Path to the Excel file.
+        layout (dict[str, dict[str, str]]): {measurement: {name: cell range}}, see `read_ranges`.
+        cache_dir (str): Directory holding the cached snapshots.
+
+    Returns:
+        dict[str, dict[str, dict]]: {sheet: {measurement: {name: value}}}, in workbook order.
+    """
+    with pf.span(os.path.basename(filename), 'read'):
+        path = snapshot_path(file_sha256(filename), layout, cache_dir)
+        if os.path.exists(path):
+            pf.count('snapshot_hits')
+            # Plain arrays in dicts: a cache hit needs neither pandas nor openpyxl
+            with open(path, 'rb') as f:
+                return pickle.load(f)
+
+        sheets = read_ranges(filename, layout)
+        os.makedirs(cache_dir, exist_ok=True)
+        with open(path + '.tmp', 'wb') as f:
+            pickle.dump(sheets, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(path + '.tmp', path)
+        return sheets
+
+def workbook_day(filename: str) -> str:
+    """Day label of a measurements workbook: '3' for 'Measurements_day_3.xlsx', else the file name without extension."""
+    stem = os.path.splitext(os.path.basename(filename))[0]
+    match = re.search(r'day_?(\d+)', stem, flags=re.IGNORECASE)
+    return match.group(1) if match else stem
+
+def material_key(day: str, sheet_name: str) -> str:
+    """Name of the material measured on sheet `sheet_name` of day `day`, e.g. '2 para day 3'."""
+    return f'{sheet_name} day {day}'
+
+def load_workbooks(pattern: str, layout: dict[str, dict[str, str]], cache_dir: str = 'Pulse_NMR_61/create_databases/.cache/',
+                   workers: int | None = None) -> dict[str, dict]:
+    """
+    Loads the layout's cell ranges from every workbook matching a glob pattern, reading the new or edited ones concurrently.
+
+    Workbooks whose snapshot is already cached (see `load_workbook_snapshot`) are
+    only loaded; the others are parsed in worker processes, one workbook each.
+
+    Args:
+        pattern (str): Glob pattern of the workbooks, e.g. 'Measurements/Measurements_day_*.xlsx'.
+        layout (dict[str, dict[str, str]]): {measurement: {name: cell range}}, see `read_ranges`.
+        cache_dir (str): Directory holding the cached snapshots.
+        workers (int | None, optional): Worker processes parsing workbooks (None: one per CPU, 1: parse serially).
+
+    Returns:
+        dict[str, dict]: Per day (see `workbook_day`), in day order: {'file': path, 'sha256': content hash,
+            'sheets': {sheet: {measurement: {name: value}}}}.
+    """
+    files = glob.glob(pattern)
+    if not files:
+        raise FileNotFoundError(f"No workbooks match '{pattern}'")
+    # Natural order, so day 10 comes after day 9
+    files.sort(key=lambda f: [int(part) if part.isdigit() else part for part in re.split(r'(\d+)', workbook_day(f))])
+
+    hashes = {f: file_sha256(f) for f in files}
+    days = [workbook_day(f) for f in files]
+    if len(set(days)) != len(days):
+        raise ValueError(f"Several workbooks matching '{pattern}' have the same day: {files}")
+
+    new = [f for f in files if not os.path.exists(snapshot_path(hashes[f], layout, cache_dir))]
+    workers = min(workers or os.cpu_count() or 1, len(new))
+    if workers > 1:
+        # Each worker writes its workbook's snapshot; the snapshots are then read back from the cache
+        context = pf.context()
+        with ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context('spawn')) as pool:
+            for future in [pool.submit(pf.call_in_span, _parse_workbook, os.path.basename(f), 'read', context, f, layout, cache_dir)
+                           for f in new]:
+                future.result()
+
+    return {day: {'file': f, 'sha256': hashes[f], 'sheets': load_workbook_snapshot(f, layout, cache_dir)}
+            for day, f in zip(days, files)}
+
+def _parse_workbook(filename: str, layout: dict[str, dict[str, str]], cache_dir: str) -> None:
+    load_workbook_snapshot(filename, layout, cache_dir)
+
+def cells_fingerprint(cells: dict, *settings) -> str:
+    """SHA-256 of the named cells of a sheet (see `read_ranges`) and of the settings applied to them."""
+    digest = hashlib.sha256(repr(settings).encode())
+    for name in sorted(cells):
+        value = cells[name]
+        digest.update(name.encode())
+        digest.update(value.tobytes() if isinstance(value, np.ndarray) else repr(value).encode())
+    return digest.hexdigest()
+
+def ingest_workbooks(workbooks: dict[str, dict], measurement: str, build_material: Callable, fingerprint: Callable,
+                     database: dict[str, dict], skipped_sheets: tuple[str, ...] = ('question',)) -> tuple[dict[str, dict], list[str]]:
+    """
+    Builds the materials whose cells changed since `database` was built.
+
+    Every material is tagged with the day and sheet it was read from and with the
+    fingerprint of the cells it was built from, so editing one sheet rebuilds only
+    that sheet's material, and adding a day's workbook only builds that day's.
+
+    Args:
+        workbooks (dict[str, dict]): Workbooks per day, as returned by `load_workbooks`.
+        measurement (str): Measurement of the layout the materials are built from, e.g. 'T1'.
+        build_material (Callable): build_material(sheet_name, cells) -> dict of the material's fields,
+            where `cells` are the measurement's named cells of the sheet.
+        fingerprint (Callable): fingerprint(sheet_name, cells) -> hash of the cells and settings build_material uses.
+        database (dict[str, dict]): The materials built so far, keyed by `material_key(day, sheet)`.
+        skipped_sheets (tuple[str, ...], optional): Sheets that hold no measurement.
+
+    Returns:
+        tuple[dict[str, dict], list[str]]: The new or rebuilt materials, and the materials of `database` to
+            delete: sheets removed from a day's workbook and materials built before they were fingerprinted.
+            Materials of days whose workbook no longer matches the pattern are kept.
+    """
+    new, seen = {}, set()
+    for day, workbook in workbooks.items():
+        for sheet_name, sheet in workbook['sheets'].items():
+            if sheet_name in skipped_sheets: continue
+            material = material_key(day, sheet_name)
+            seen.add(material)
+            cells = sheet[measurement]
+            sheet_fingerprint = fingerprint(sheet_name, cells)
+            if database.get(material, {}).get('fingerprint') == sheet_fingerprint:
+                continue
+            with pf.span(material, 'read', material=material):
+                new[material] = {**build_material(sheet_name, cells),
+                                 'day': day, 'sheet': sheet_name, 'fingerprint': sheet_fingerprint}
+
+    stale = [material for material, data in database.items() if material not in seen
+             and ('fingerprint' not in data or data['day'] in workbooks)]
+    return new, stale
+
 def smooth_xy_data(x: np.ndarray, y: np.ndarray, window_length: int = 101, polyorder: int = 3):
     """
     Smooth y-data using Savitzky-Golay filter.
@@ -65,7 +317,7 @@ def smooth_xy_data(x: np.ndarray, y: np.ndarray, window_length: int = 101, polyo
     if window_length % 2 == 0:
         window_length += 1  # ensure it's odd
 
-    y_smooth = savgol_filter(y, window_length, polyorder)
+    y_smooth = signal.savgol_filter(y, window_length, polyorder)
     return x, y_smooth
 
 def get_peaks(x: np.ndarray, y: np.ndarray, min_time_between_peaks: float, min_height: float, prominence: float = 0.5):
@@ -74,13 +326,250 @@ def get_peaks(x: np.ndarray, y: np.ndarray, min_time_between_peaks: float, min_h
     min_distance_samples = int(min_time_between_peaks / dt)
 
     # Find peaks with constraints
-    peak_indices, properties = find_peaks(y, height=min_height, distance=min_distance_samples, prominence=prominence)
+    peak_indices, properties = signal.find_peaks(y, height=min_height, distance=min_distance_samples, prominence=prominence)
 
     x_peaks = x[peak_indices]
     y_peaks = y[peak_indices]
 
     return x_peaks, y_peaks
 
+def _chord_deviation(x: np.ndarray, r: np.ndarray, lo: int, hi: int) -> tuple[float, int]:
+    """Largest vertical distance of r[lo+1:hi] from the chord between samples lo and hi, and where it is."""
+    if hi - lo < 2:
+        return -1., -1
+    span = x[hi] - x[lo]
+    slope = (r[hi] - r[lo]) / span if span else 0.
+    deviation = np.abs(r[lo + 1:hi] - (r[lo] + slope * (x[lo + 1:hi] - x[lo])))
+    k = int(np.argmax(deviation))
+    return float(deviation[k]), lo + 1 + k
+
+def decimate_trace(
+    x: np.ndarray,
+    y: np.ndarray,
+    n_points: int | None = None,
+    tolerance: float | None = None,
+    reference: np.ndarray | None = None
+    ) -> np.ndarray:
+    """
+    Picks the samples that best describe a trace, for a point budget or an error bound.
+
+    Starting from the first sample, the peak and the last sample, the sample farthest from
+    the piecewise-linear curve through the kept samples is added until `n_points` are kept
+    or every dropped sample is within `tolerance` of that curve. Regions of high curvature
+    (the rise and the peak of a T2* trace) therefore get dense samples and the flat tail
+    sparse ones, instead of a fixed stride.
+
+    Args:
+        x (np.ndarray): Independent variable, increasing (e.g., time).
+        y (np.ndarray): Dependent variable (e.g., voltage).
+        n_points (int, optional): Maximum number of samples to keep.
+        tolerance (float, optional): Largest allowed distance, in y units, between a dropped
+            sample and the curve through the kept ones. At least one of the two must be given.
+        reference (np.ndarray, optional): Curve the distances are measured on, e.g. a smoothed
+            `y`, so that single noise spikes are not picked. Defaults to `y`.
+
+    Returns:
+        np.ndarray: Sorted indices of the kept samples.
+    """
+    if n_points is None and tolerance is None:
+        raise ValueError("Give a point budget (n_points), an error bound (tolerance) or both.")
+    x = np.asarray(x, dtype=np.float64)
+    r = np.asarray(y if reference is None else reference, dtype=np.float64)
+    if len(r) <= 2:
+        return np.arange(len(r))
+
+    kept = sorted({0, int(np.argmax(r)), len(r) - 1})
+    heap = []  # Segments between kept samples, largest deviation first
+    for lo, hi in zip(kept[:-1], kept[1:]):
+        deviation, idx = _chord_deviation(x, r, lo, hi)
+        if idx >= 0:
+            heapq.heappush(heap, (-deviation, lo, hi, idx))
+
+    while heap:
+        if n_points is not None and len(kept) >= n_points:
+            break
+        deviation, lo, hi, idx = heapq.heappop(heap)
+        if tolerance is not None and -deviation <= tolerance:
+            break
+        kept.append(idx)
+        for a, b in ((lo, idx), (idx, hi)):
+            deviation, split = _chord_deviation(x, r, a, b)
+            if split >= 0:
+                heapq.heappush(heap, (-deviation, a, b, split))
+    return np.sort(kept)
+
+def iter_chunks(*arrays: np.ndarray, chunk_size: int = 1 << 16) -> Iterator[tuple[np.ndarray, ...]]:
+    """Yields aligned slices of at most `chunk_size` samples; slices of memory-mapped arrays stay on disk until used."""
+    for start in range(0, len(arrays[0]), chunk_size):
+        yield tuple(array[start:start + chunk_size] for array in arrays)
+
+def smooth_chunks(chunks: Iterable[tuple[np.ndarray, np.ndarray]], window_length: int = 101, polyorder: int = 3) -> Iterator[tuple[np.ndarray, np.ndarray]]:
+    """
+    Streaming version of `smooth_xy_data`: smooths a trace given as (x, y) chunks.
+
+    Only `window_length` samples are carried between chunks, and the output is the
+    same as smoothing the whole trace at once, edges included.
+
+    Args:
+        chunks (Iterable[tuple[np.ndarray, np.ndarray]]): Consecutive (x, y) chunks of the trace.
+        window_length (int): Length of the filter window (made odd if it is even).
+        polyorder (int): Polynomial order to use in the filter.
+
+    Yields:
+        tuple[np.ndarray, np.ndarray]: Consecutive (x, y_smooth) chunks (not aligned with the input chunks).
+    """
+    if window_length % 2 == 0:
+        window_length += 1  # ensure it's odd
+    half = window_length // 2
+
+    x_buf, y_buf = np.empty(0), np.empty(0)
+    emitted = 0  # First sample of the buffer that has not been yielded yet
+    total = 0
+    for x, y in chunks:
+        x_buf, y_buf = np.concatenate([x_buf, x]), np.concatenate([y_buf, y])
+        total += len(y)
+        if len(y_buf) < window_length:
+            continue
+        # Samples with a full window inside the buffer are exact; the first buffer also holds the true left edge
+        y_smooth = signal.savgol_filter(y_buf, window_length, polyorder)
+        stop = len(y_buf) - half
+        if stop > emitted:
+            yield x_buf[emitted:stop], y_smooth[emitted:stop]
+        # Keep a full window so the right edge can still be fitted if the trace ends here
+        keep = len(y_buf) - window_length
+        x_buf, y_buf, emitted = x_buf[keep:], y_buf[keep:], max(stop, emitted) - keep
+
+    if total < window_length:
+        raise ValueError(f"Window length ({window_length}) is larger than data size ({total}).")
+    yield x_buf[emitted:], signal.savgol_filter(y_buf, window_length, polyorder)[emitted:]
+
+def _select_by_distance(peaks: np.ndarray, priority: np.ndarray, distance: int) -> np.ndarray:
+    """The `distance` condition of `find_peaks`: higher peaks first, same tie order."""
+    keep = np.ones(len(peaks), dtype=bool)
+    for j in np.argsort(priority)[::-1]:
+        if not keep[j]:
+            continue
+        lo = np.searchsorted(peaks, peaks[j] - distance, side='right')
+        hi = np.searchsorted(peaks, peaks[j] + distance, side='left')
+        keep[lo:j] = False
+        keep[j + 1:hi] = False
+    return keep
+
+def stream_peaks(
+    chunks: Iterable[tuple[np.ndarray, np.ndarray]],
+    min_time_between_peaks: float,
+    min_height: float,
+    prominence: float = 0.5
+    ) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Streaming version of `get_peaks`: finds the envelope peaks of a trace given as (x, y) chunks.
+
+    Local maxima (plateaus included) are found chunk by chunk, carrying over only the
+    trailing plateau. The left base of each prominence is taken from a running summary
+    of the samples already seen (their suffix maxima with the minima in between), and
+    the right base is tracked until a higher sample arrives. The distance and prominence
+    conditions are then applied to the candidates exactly as `find_peaks` does, so memory
+    is bounded by the chunk size plus a few numbers per candidate above `min_height`.
+
+    The sample spacing is (x[-1] - x[0]) / (n - 1), the exact mean of the spacings; it can
+    only differ from `get_peaks` if `min_time_between_peaks / dt` is within rounding of an integer.
+
+    Args:
+        chunks (Iterable[tuple[np.ndarray, np.ndarray]]): Consecutive (x, y) chunks of the trace,
+            e.g. from `iter_chunks` over memory-mapped arrays.
+        min_time_between_peaks (float): Minimum distance between peaks, in x units.
+        min_height (float): Minimum peak height.
+        prominence (float, optional): Minimum peak prominence. Defaults to 0.5.
+
+    Returns:
+        tuple[np.ndarray, np.ndarray]: x and y of the peaks.
+    """
+    # Summary of the samples before the buffer: values before the first suffix maximum (low),
+    # the strictly decreasing suffix maxima (records) and the minimum after each of them (gaps)
+    low, records, gaps = np.inf, np.empty(0), np.empty(0)
+    x_buf, y_buf, offset = np.empty(0), np.empty(0), 0
+    x_first, x_last, n_samples = None, None, 0
+
+    candidates = []  # Per buffer: positions, x, y, left minima and right minima of the candidate peaks
+    n_candidates = 0
+    # Candidates whose right base is not found yet: index, height and running minimum
+    pending, pending_y, pending_min = np.empty(0, dtype=int), np.empty(0), np.empty(0)
+    resolved, resolved_min = [], []
+
+    for x, y in chunks:
+        if len(y) == 0:
+            continue
+        if x_first is None:
+            x_first = x[0]
+        x_last, n_samples = x[-1], n_samples + len(y)
+        x_buf, y_buf = np.concatenate([x_buf, x]), np.concatenate([y_buf, np.asarray(y, dtype=np.float64)])
+
+        # Right bases of earlier candidates: stop at the first higher sample
+        if len(pending):
+            first_higher = np.searchsorted(np.maximum.accumulate(y_buf), pending_y, side='right')
+            running_min = np.minimum.accumulate(y_buf)
+            seen = first_higher > 0
+            pending_min[seen] = np.minimum(pending_min[seen], running_min[first_higher[seen] - 1])
+            done = first_higher < len(y_buf)
+            resolved.append(pending[done])
+            resolved_min.append(pending_min[done])
+            pending, pending_y, pending_min = pending[~done], pending_y[~done], pending_min[~done]
+
+        # Complete local maxima of the buffer, then their prominences against the summary prefix
+        peaks = signal.find_peaks(y_buf)[0]
+        if min_height is not None:
+            peaks = peaks[y_buf[peaks] >= min_height]
+        if len(peaks):
+            prefix = np.r_[low, np.stack([records, gaps], axis=-1).ravel()]
+            prefix = prefix[np.isfinite(prefix)]  # Empty gaps are left out
+            full = np.concatenate([prefix, y_buf])
+            _, left_bases, right_bases = signal.peak_prominences(full, peaks + len(prefix))
+            suffix_max = np.maximum.accumulate(y_buf[::-1])[::-1]
+            suffix_min = np.minimum.accumulate(y_buf[::-1])[::-1]
+            truncated = suffix_max[peaks + 1] <= y_buf[peaks]
+
+            candidates.append((offset + peaks, x_buf[peaks], y_buf[peaks], full[left_bases], full[right_bases]))
+            pending = np.r_[pending, n_candidates + np.flatnonzero(truncated)]
+            pending_y = np.r_[pending_y, y_buf[peaks[truncated]]]
+            pending_min = np.r_[pending_min, suffix_min[peaks[truncated]]]
+            n_candidates += len(peaks)
+
+        # Carry the trailing plateau and the sample before it, fold the rest into the summary
+        changes = np.flatnonzero(y_buf != y_buf[-1])
+        carry = max(changes[-1], 0) if len(changes) else 0
+        folded = y_buf[:carry]
+        if len(folded):
+            later_max = np.r_[np.maximum.accumulate(folded[::-1])[::-1][1:], -np.inf]
+            new_records = np.flatnonzero(folded > later_max)
+            bounds = np.r_[new_records, len(folded)]
+            new_gaps = np.array([folded[a + 1:b].min() if b > a + 1 else np.inf for a, b in zip(bounds[:-1], bounds[1:])])
+            before = folded[:new_records[0]].min() if new_records[0] > 0 else np.inf
+
+            survive = int(np.sum(records > folded.max()))
+            dropped = np.r_[records[survive:], gaps[survive:], before].min()
+            records, gaps = records[:survive], gaps[:survive].copy()
+            if survive:
+                gaps[-1] = min(gaps[-1], dropped)
+            else:
+                low = min(low, dropped)
+            records = np.concatenate([records, folded[new_records]])
+            gaps = np.concatenate([gaps, new_gaps])
+        x_buf, y_buf, offset = x_buf[carry:], y_buf[carry:], offset + carry
+
+    if not n_candidates:
+        return np.empty(0), np.empty(0)
+
+    positions, x_cand, y_cand, left_min, right_min = (np.concatenate(column) for column in zip(*candidates))
+    right_min[np.concatenate(resolved + [pending])] = np.concatenate(resolved_min + [pending_min])
+    dt = (x_last - x_first) / (n_samples - 1)
+    distance = int(min_time_between_peaks / dt)
+    if distance < 1:
+        raise ValueError('`distance` must be greater or equal to 1')
+    keep = _select_by_distance(positions, y_cand, np.ceil(distance))
+    prominences = y_cand - np.maximum(left_min, right_min)
+    keep &= prominences >= prominence
+    return x_cand[keep], y_cand[keep]
+
 def excel_col_to_index(col: str) -> int:
     """
     Convert an Excel-style column label (e.g., 'A', 'BP') to a 0-based index.
@@ -0,0 +1,228 @@
+import os
+import glob
+import threading
+import traceback
+import multiprocessing
+from time import perf_counter, sleep
+from dataclasses import dataclass, field
+from collections.abc import Callable
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, FIRST_COMPLETED, wait, as_completed
+from tqdm import tqdm
+
+from utils import profile_tools as pf
+
+
+@dataclass
+class Stage:
+    """
+    A pipeline stage: a callable with named inputs and outputs.
+
+    Attributes:
+        name (str): Name used in logs and timings.
+        func (Callable): Called with the inputs as keyword arguments.
+        inputs (tuple[str, ...]): Names of the results this stage consumes.
+        outputs (tuple[str, ...]): Names given to the returned value(s). With several
+            outputs the callable must return a tuple of the same length.
+        resources (tuple[str, ...]): Shared, non thread-safe resources the stage uses
+            (e.g. 'ROOT', 'matplotlib'). Stages sharing a resource never run at the same time.
+    """
+    name: str
+    func: Callable
+    inputs: tuple[str, ...] = ()
+    outputs: tuple[str, ...] = ()
+    resources: tuple[str, ...] = field(default_factory=tuple)
+
+
+def _check_graph(stages: list[Stage], available: set[str]) -> None:
+    """Raises ValueError for duplicate outputs, missing inputs or dependency cycles."""
+    producers: dict[str, str] = {}
+    for stage in stages:
+        for output in stage.outputs:
+            if output in producers or output in available:
+                raise ValueError(f"Output '{output}' of stage '{stage.name}' is produced more than once.")
+            producers[output] = stage.name
+
+    for stage in stages:
+        for name in stage.inputs:
+            if name not in producers and name not in available:
+                raise ValueError(f"Input '{name}' of stage '{stage.name}' is not produced by any stage.")
+
+    done, pending = set(available), list(stages)
+    while pending:
+        ready = [stage for stage in pending if all(name in done for name in stage.inputs)]
+        if not ready:
+            raise ValueError(f"Dependency cycle between stages: {[stage.name for stage in pending]}")
+        for stage in ready:
+            done.update(stage.outputs)
+            pending.remove(stage)
+
+def run_pipeline(stages: list[Stage], max_workers: int = 4, initial: dict | None = None) -> tuple[dict, dict[str, float]]:
+    """
+    Runs the stages in one process, starting every stage as soon as its inputs exist.
+
+    Independent stages run concurrently in a thread pool and results are passed
+    between stages in memory. If a stage raises, no further stages are started,
+    the running ones are awaited and the exception is re-raised.
+
+    Args:
+        stages (list[Stage]): The stages of the pipeline, in any order.
+        max_workers (int, optional): Maximum number of stages running at once. Defaults to 4.
+        initial (dict, optional): Results available before any stage runs.
+
+    Returns:
+        tuple[dict, dict[str, float]]: All results by name, and the wall time of each stage in seconds.
+    """
+    results: dict = dict(initial or {})
+    _check_graph(stages, set(results))
+
+    locks = {name: threading.Lock() for stage in stages for name in stage.resources}
+    timings: dict[str, float] = {}
+
+    def run_stage(stage: Stage):
+        # Locks are always taken in sorted order so two stages can never deadlock
+        held = [locks[name] for name in sorted(stage.resources)]
+        for lock in held:
+            lock.acquire()
+        try:
+            print(f"Running {stage.name}...")
+            start = perf_counter()
+            with pf.span(stage.name, 'stage', stage=stage.name):
+                value = stage.func(**{name: results[name] for name in stage.inputs})
+            timings[stage.name] = perf_counter() - start
+            print(f"Finished {stage.name}.\n")
+            return value
+        finally:
+            for lock in reversed(held):
+                lock.release()
+
+    pending = list(stages)
+    running: dict = {}
+    error: BaseException | None = None
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        while pending or running:
+            if error is None:
+                ready = [stage for stage in pending if all(name in results for name in stage.inputs)]
+                for stage in ready:
+                    pending.remove(stage)
+                    running[executor.submit(run_stage, stage)] = stage
+            if not running:
+                break
+
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                stage = running.pop(future)
+                try:
+                    value = future.result()
+                except Exception as exc:
+                    print(f"Error running {stage.name}, stopped.")
+                    error = error or exc
+                    continue
+                if len(stage.outputs) == 1:
+                    results[stage.outputs[0]] = value
+                elif stage.outputs:
+                    results.update(zip(stage.outputs, value))
+
+    if error is not None:
+        raise error
+    return results, timings
+
+def map_materials(func: Callable, database: dict[str, dict], workers: int | None = 1,
+                  on_result: Callable[[str, object], None] | None = None, phase: str = 'fit') -> dict:
+    """
+    Applies `func(material, data)` to every material of a database.
+
+    With `workers` other than 1 the materials are fanned out over a pool of
+    worker processes. The pool uses the 'spawn' start method, so every worker
+    is a fresh interpreter with its own ROOT state. `func` must therefore be
+    a module-level function and its return value picklable (e.g. fitted
+    parameters and statistics, not canvases). Workers should not write to
+    shared files; the caller stores the gathered results.
+
+    Args:
+        func (Callable): Function of (material, data) returning the material's results.
+        database (dict[str, dict]): The {material: data} database.
+        workers (int | None, optional): Number of worker processes. 1 runs serially in
+            this process, None uses one worker per CPU. Defaults to 1.
+        on_result (Callable, optional): Called in this process as `on_result(material, result)`
+            as soon as each material is done (in completion order), e.g. to queue its figure.
+        phase (str, optional): Phase under which each material is recorded by `profile_tools`. Defaults to 'fit'.
+
+    Returns:
+        dict: {material: result}, in the order of `database` regardless of completion order.
+    """
+    # Every material is a profiling span, in the worker that runs it, carrying the caller's stage
+    attrs = pf.context()
+    if workers == 1:
+        results = {}
+        for material, data in tqdm(database.items()):
+            results[material] = pf.call_in_span(func, material, phase, {**attrs, 'material': material}, material, data)
+            if on_result is not None:
+                on_result(material, results[material])
+        return results
+
+    context = multiprocessing.get_context('spawn')
+    with ProcessPoolExecutor(max_workers=workers, mp_context=context) as executor:
+        futures = {
+            executor.submit(pf.call_in_span, func, material, phase, {**attrs, 'material': material}, material, data): material
+            for material, data in database.items()
+            }
+        for future in tqdm(as_completed(futures), total=len(futures)):
+            if on_result is not None:
+                on_result(futures[future], future.result())
+        results = {material: future.result() for future, material in futures.items()}
+        return {material: results[material] for material in database}
+
+def file_signatures(pattern: str) -> dict[str, tuple[int, int]]:
+    """Size and modification time of every file matching a glob pattern."""
+    signatures = {}
+    for path in glob.glob(pattern):
+        stat = os.stat(path)
+        signatures[path] = (stat.st_size, stat.st_mtime_ns)
+    return signatures
+
+def watch(pattern: str, on_change: Callable[[], object], interval: float = 1.) -> None:
+    """
+    Calls `on_change()` now, then again whenever a file matching `pattern` is added, removed or saved, until interrupted.
+
+    A change is only acted upon once the files stayed unchanged for `interval` seconds, so a
+    workbook is not read while it is still being written. An exception raised by `on_change`
+    is printed and watching goes on.
+
+    Args:
+        pattern (str): Glob pattern of the watched files.
+        on_change (Callable): Called without arguments, e.g. a run of the pipeline.
+        interval (float, optional): Seconds between two polls of the files. Defaults to 1.
+    """
+    last = None
+    try:
+        while True:
+            current = file_signatures(pattern)
+            if current != last:
+                sleep(interval)
+                if file_signatures(pattern) != current:
+                    continue  # Still being written
+                last = current
+                try:
+                    on_change()
+                except Exception:
+                    traceback.print_exc()
+                print(f"Watching {pattern} (Ctrl-C to stop)")
+            sleep(interval)
+    except KeyboardInterrupt:
+        print("Stopped watching.")
+
+def format_duration(seconds: float) -> str:
+    if seconds >= 60:
+        minutes = int(seconds // 60)
+        return f"{minutes} minutes and {seconds % 60:.2f} seconds"
+    return f"{seconds:.2f} seconds"
+
+def print_timings(timings: dict[str, float]) -> None:
+    """Prints the wall time of each stage, slowest first."""
+    width = max((len(name) for name in timings), default=0)
+    for name, seconds in sorted(timings.items(), key=lambda item: item[1], reverse=True):
+        print(f"{name:<{width}}  {format_duration(seconds)}")
+
+
+if __name__ == '__main__':
+    pass
@@ -0,0 +1,191 @@
+import os
+import sys
+import json
+import threading
+from time import time, perf_counter, thread_time
+from collections import defaultdict
+from collections.abc import Callable
+from contextlib import contextmanager
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+# The trace file is passed through the environment, so spawned worker processes record into it too
+PROFILE_ENV: str = 'PULSE_NMR_PROFILE'
+
+_local = threading.local()
+_write_lock = threading.Lock()
+
+
+def enable(path: str) -> None:
+    """Starts recording spans as JSON lines to `path` (emptied first), in this process and the workers it starts."""
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    open(path, 'w').close()
+    os.environ[PROFILE_ENV] = os.path.abspath(path)
+
+def disable() -> None:
+    os.environ.pop(PROFILE_ENV, None)
+
+def enabled() -> bool:
+    return PROFILE_ENV in os.environ
+
+
+def peak_rss_mb() -> float | None:
+    """Peak resident memory of this process so far, in MB (None where the platform does not report it)."""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in kilobytes on Linux
+    return peak / (1 << 20) if sys.platform == 'darwin' else peak / (1 << 10)
+
+def _stack() -> list[dict]:
+    if not hasattr(_local, 'stack'):
+        _local.stack = []
+    return _local.stack
+
+def context() -> dict:
+    """Attributes (stage, material, ...) of the enclosing spans, to carry a span's context into another thread or process."""
+    stack = _stack()
+    return dict(stack[-1]['attrs']) if stack else {}
+
+def _write(record: dict) -> None:
+    line = (json.dumps(record, default=str) + '\n').encode()
+    with _write_lock:
+        # A single write to a file opened for appending, so lines from several processes do not interleave
+        fd = os.open(os.environ[PROFILE_ENV], os.O_WRONLY | os.O_APPEND | os.O_CREAT)
+        try:
+            os.write(fd, line)
+        finally:
+            os.close(fd)
+
+
+@contextmanager
+def span(name: str, phase: str, **attrs):
+    """
+    Records the wall time, CPU time, peak memory and counters of a block of code.
+
+    Spans nest per thread: a span inherits the attributes of the enclosing ones (e.g. the
+    stage and the material), and its counters are added to its parent's when it ends.
+    The wall and CPU time of the 'import' spans nested in a span (first uses of lazily
+    imported modules, see `utils.lazy_import`) are recorded as its 'import_wall' and
+    'import_cpu', so that `print_summary` can leave them out. Nothing is recorded unless
+    `enable` was called.
+
+    Args:
+        name (str): Name of the span, e.g. the stage or the material.
+        phase (str): What the block does: 'stage', 'read', 'fit', 'peaks', 'render', 'write', ...
+        **attrs: Attributes stored with the span and inherited by nested spans (e.g. material='water').
+    """
+    if not enabled():
+        yield
+        return
+
+    stack = _stack()
+    entry = {'attrs': {**context(), **attrs}, 'counters': defaultdict(int), 'imports': [0., 0.]}
+    stack.append(entry)
+    start_rss = peak_rss_mb()
+    start_time, start_wall, start_cpu = time(), perf_counter(), thread_time()
+    try:
+        yield
+    finally:
+        wall, cpu = perf_counter() - start_wall, thread_time() - start_cpu
+        stack.pop()
+        if stack:
+            for counter, value in entry['counters'].items():
+                stack[-1]['counters'][counter] += value
+            imports = (wall, cpu) if phase == 'import' else entry['imports']
+            stack[-1]['imports'] = [total + value for total, value in zip(stack[-1]['imports'], imports)]
+        end_rss = peak_rss_mb()
+        _write({
+            'name': name,
+            'phase': phase,
+            **entry['attrs'],
+            'start': start_time,
+            'wall': wall,
+            'cpu': cpu,
+            'peak_rss_mb': end_rss,
+            # Non-zero only when this span raised the process's memory high-water mark
+            'peak_rss_growth_mb': None if end_rss is None else end_rss - start_rss,
+            'counters': dict(entry['counters']),
+            'import_wall': entry['imports'][0],
+            'import_cpu': entry['imports'][1],
+            'pid': os.getpid(),
+            'tid': threading.get_ident(),
+        })
+
+def call_in_span(func: Callable, name: str, phase: str, attrs: dict, *args, **kwargs):
+    """`func(*args, **kwargs)` inside a span; module-level, so it can be sent to worker processes and threads."""
+    with span(name, phase, **attrs):
+        return func(*args, **kwargs)
+
+
+def count(counter: str, n: int | float = 1) -> None:
+    """Adds `n` to a counter of the innermost open span of this thread (no-op outside spans)."""
+    stack = _stack()
+    if stack:
+        stack[-1]['counters'][counter] += n
+
+def record_fit(backend: str, evaluations: int, iterations: int | None = None, converged: bool = True) -> None:
+    """Counts one fit: its function evaluations, iterations (if the optimiser reports them) and convergence."""
+    count('fits')
+    count(f'fits_{backend}')
+    count('evaluations', evaluations)
+    if iterations is not None:
+        count('iterations', iterations)
+    if not converged:
+        count('not_converged')
+
+
+def read_trace(path: str) -> list[dict]:
+    """The spans recorded in a JSON lines trace."""
+    with open(path, 'r') as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+def write_chrome_trace(path: str, output_path: str) -> None:
+    """Converts a JSON lines trace into a Chrome trace file (chrome://tracing, Perfetto)."""
+    events = []
+    for record in read_trace(path):
+        args = {key: value for key, value in record.items() if key not in ('name', 'phase', 'start', 'wall', 'pid', 'tid')}
+        events.append({
+            'name': record['name'], 'cat': record['phase'], 'ph': 'X',
+            'ts': record['start'] * 1e6, 'dur': record['wall'] * 1e6,
+            'pid': record['pid'], 'tid': record['tid'], 'args': args,
+        })
+    with open(output_path, 'w') as f:
+        json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
+
+def own_time(record: dict) -> tuple[float, float]:
+    """Wall and CPU time of a span without the imports nested in it."""
+    return record['wall'] - record.get('import_wall', 0.), record['cpu'] - record.get('import_cpu', 0.)
+
+def print_summary(path: str, top: int = 10) -> None:
+    """
+    Prints the total time of each phase and the slowest material spans. Module imports are
+    their own 'import' phase and are not counted in the time of the spans they occurred in.
+    """
+    records = read_trace(path)
+    totals: dict[str, list[float]] = defaultdict(lambda: [0., 0.])
+    for record in records:
+        if record['phase'] != 'stage':
+            wall, cpu = own_time(record)
+            totals[record['phase']][0] += wall
+            totals[record['phase']][1] += cpu
+    print(f"{'phase':<10} {'wall':>10} {'cpu':>10}")
+    for phase, (wall, cpu) in sorted(totals.items(), key=lambda item: item[1][0], reverse=True):
+        print(f"{phase:<10} {wall:9.2f}s {cpu:9.2f}s")
+
+    per_material = sorted((r for r in records if r.get('material') and r['name'] == r['material']),
+                          key=lambda record: own_time(record)[0], reverse=True)
+    print("Slowest materials:")
+    for record in per_material[:top]:
+        counters = ', '.join(f'{key}={value}' for key, value in record['counters'].items())
+        if record.get('import_wall'):
+            counters = f"(+{record['import_wall']:.3f}s imports) " + counters
+        print(f"  {record.get('stage', ''):<26} {record['phase']:<7} {record['material']:<14} {own_time(record)[0]:8.3f}s  {counters}")
+
+
+if __name__ == '__main__':
+    # python -m utils.profile_tools trace.jsonl: prints the summary of a recorded trace
+    print_summary(sys.argv[1])
@@ -0,0 +1,129 @@
+from __future__ import annotations
+
+import re
+from collections.abc import Iterable
+import numpy as np
+
+from utils import lazy_import
+
+# pandas is only imported once a table is built or read
+pd = lazy_import('pandas')
+
+# The relaxation times of the results table; each has a value column and an '_err' column
+QUANTITIES: tuple[str, ...] = ('T1', 'T2', 'T2_Eff')
+# Index levels: the material (sheet and day, as named throughout the pipeline), the concentration of its sheet and the day
+INDEX: tuple[str, ...] = ('material', 'concentration', 'day')
+
+_CONCENTRATION = re.compile(r'^\s*(\d+(?:\.\d*)?|\.\d+)')
+
+
+def error_column(quantity: str) -> str:
+    return quantity + '_err'
+
+def value_columns() -> list[str]:
+    """Columns of the table, in order: every quantity followed by its error."""
+    return [column for quantity in QUANTITIES for column in (quantity, error_column(quantity))]
+
+def concentration_of(sheet_name: str) -> float:
+    """Concentration of a sheet from its leading number ('0.5 para' -> 0.5); NaN if the name has none."""
+    match = _CONCENTRATION.match(sheet_name)
+    return float(match.group(1)) if match else np.nan
+
+def split_material(material: str) -> tuple[str, str]:
+    """(sheet, day) of a material named by `pt.material_key`, e.g. '2 para day 3' -> ('2 para', '3'); day '' if untagged."""
+    sheet, _, day = material.rpartition(' day ')
+    return (sheet, day) if sheet else (material, '')
+
+
+def results_table(rows: Iterable[dict]) -> pd.DataFrame:
+    """
+    Builds the typed results table.
+
+    Args:
+        rows (Iterable[dict]): One dict per material with 'material', optionally 'sheet' and 'day'
+            (otherwise taken from the material name), and a (value, error) pair per quantity.
+
+    Returns:
+        pd.DataFrame: float64 value and error columns (see `value_columns`), indexed by
+        material, concentration and day, sorted for fast lookups.
+    """
+    records = []
+    for row in rows:
+        sheet, day = split_material(row['material'])
+        sheet, day = row.get('sheet') or sheet, str(row.get('day') or day)
+        record = {'material': row['material'], 'concentration': concentration_of(sheet), 'day': day}
+        for quantity in QUANTITIES:
+            record[quantity], record[error_column(quantity)] = row[quantity]
+        records.append(record)
+    table = pd.DataFrame.from_records(records, columns=[*INDEX, *value_columns()])
+    table = table.astype({column: np.float64 for column in ('concentration', *value_columns())})
+    return table.set_index(list(INDEX)).sort_index()
+
+
+def write_results(table: pd.DataFrame, path: str) -> None:
+    """Writes the table as CSV, the index levels first; floats are written in full so they read back exactly."""
+    table.to_csv(path)
+
+def read_results(path: str) -> pd.DataFrame:
+    """
+    Reads a results table with one vectorised read (the C parser, every column with its dtype).
+
+    Tables written before the value and error columns were split, with '[value, error]' lists in
+    the cells and no concentration or day, are converted with vectorised string operations.
+    """
+    header = pd.read_csv(path, nrows=0).columns
+    if error_column(QUANTITIES[0]) in header:
+        floats = ['concentration', *value_columns()]
+        # Days and materials stay strings; only empty float cells (NaN when written) are missing
+        table = pd.read_csv(path, dtype={'material': str, 'day': str, **dict.fromkeys(floats, np.float64)},
+                            keep_default_na=False, na_values=dict.fromkeys(floats, ['']))
+        return table.set_index(list(INDEX)).sort_index()
+    return _read_legacy_results(path)
+
+def _read_legacy_results(path: str) -> pd.DataFrame:
+    legacy = pd.read_csv(path, dtype=str)
+    table = pd.DataFrame({'material': legacy['material']})
+    # Vectorised `split_material`: materials named without a day keep the whole name as the sheet
+    parts = legacy['material'].str.rpartition(' day ')
+    tagged = parts[0] != ''
+    sheets = parts[0].where(tagged, legacy['material'])
+    table['concentration'] = pd.to_numeric(sheets.str.extract(_CONCENTRATION.pattern, expand=False), errors='coerce')
+    table['day'] = parts[2].where(tagged, '')
+    for quantity in QUANTITIES:
+        pair = legacy[quantity].str.strip('[]() ').str.split(',', n=1, expand=True)
+        table[quantity] = pair[0].astype(np.float64)
+        table[error_column(quantity)] = pair[1].astype(np.float64)
+    return table.set_index(list(INDEX)).sort_index()
+
+
+def query_results(table: pd.DataFrame, material=None, concentration=None, day=None) -> pd.DataFrame:
+    """
+    Rows of the table matching every given index value, selected with vectorised masks on the index.
+
+    Args:
+        table (pd.DataFrame): A results table (see `results_table`).
+        material, concentration, day (optional): A value or a list of values of that index level;
+            `concentration` also takes a (min, max) tuple, both ends included.
+
+    Returns:
+        pd.DataFrame: The matching rows, in table order.
+    """
+    mask = np.ones(len(table), dtype=bool)
+    for level, wanted in (('material', material), ('concentration', concentration), ('day', day)):
+        if wanted is None:
+            continue
+        values = table.index.get_level_values(level)
+        if level == 'concentration' and isinstance(wanted, tuple):
+            mask &= (values >= wanted[0]) & (values <= wanted[1])
+        else:
+            wanted = [str(value) for value in np.atleast_1d(wanted)] if level == 'day' else np.atleast_1d(wanted)
+            mask &= values.isin(wanted)
+    return table[mask]
+
+def value_error(table: pd.DataFrame, quantity: str) -> tuple[np.ndarray, np.ndarray]:
+    """The values and errors of one quantity as float64 arrays."""
+    return table[quantity].to_numpy(dtype=np.float64), table[error_column(quantity)].to_numpy(dtype=np.float64)
+
+
+if __name__ == '__main__':
+    pass
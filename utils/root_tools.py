@@ -1,25 +1,106 @@
+from __future__ import annotations
+
 import os
 import time
-from math import floor, log10
+import threading
+from itertools import count
+from typing import TYPE_CHECKING
 from colorama import Fore, Style
-from uncertainties import ufloat
-import ROOT
-from ROOT import TGraphErrors, TF1
+import numpy as np
+
+from utils import lazy_import
+from utils import fit_tools as ft
+from utils import profile_tools as pf
+# The rounding helpers live in fit_tools so the ROOT-free fitting path can use them
+from utils.fit_tools import sig_digits_round, round_respect_to_error
+
+if TYPE_CHECKING:
+    from uncertainties import ufloat
+    from ROOT import TGraphErrors, TF1
 
-print("ROOT TOOLS LIBRARY")
+# ROOT takes seconds to import, so it is only loaded when a ROOT object is first needed
+ROOT = lazy_import('ROOT', on_load=lambda: print("ROOT TOOLS LIBRARY"))
+
+def as_buffers(*columns) -> tuple[np.ndarray, ...]:
+    """Converts columns (lists, Series or arrays) into contiguous float64 arrays that ROOT reads as double*."""
+    return tuple(np.ascontiguousarray(column, dtype=np.float64) for column in columns)
 
 def generate_data_points(x_data, y_data, delta_x, delta_y):
-    # Generate the data points with error bars
-    graph = ROOT.TGraphErrors(len(x_data))
-    for i, (x, y, dx, dy) in enumerate(zip(x_data, y_data, delta_x, delta_y)):
-        graph.SetPoint(i, x, y)
-        graph.SetPointError(i, dx, dy)
-    
+    # Generate the data points with error bars, passing all points to ROOT in a single call
+    x, y, dx, dy = as_buffers(x_data, y_data, delta_x, delta_y)
+    graph = ROOT.TGraphErrors(len(x), x, y, dx, dy)
+
     graph.GetYaxis().CenterTitle()
     return graph
 
-def create_tf1(fit_str, fit_name: str, x_min: float, x_max: float, params: dict[int | str, float], colour=2):
-    fit_func: TF1 = ROOT.TF1(fit_name, fit_str, x_min, x_max)
+def evaluate_fit(fitline: TF1, x_data, fit_str: str | None = None) -> np.ndarray:
+    """
+    Evaluates a fitted TF1 on a whole array of x values.
+
+    When the formula string is given and can be translated to NumPy, all points are
+    evaluated at once with the TF1's current parameters; otherwise `TF1.Eval` is
+    called point by point.
+    """
+    x, = as_buffers(x_data)
+    if fit_str is not None:
+        try:
+            formula = ft.compile_formula(fit_str)
+        except ValueError:
+            pass
+        else:
+            params = [fitline.GetParameter(i) for i in range(fitline.GetNpar())]
+            return np.broadcast_to(formula(x, params), x.shape).astype(np.float64)
+    return np.array([fitline.Eval(xi) for xi in x])
+
+# Compiled prototype TF1 of every formula string used in this process (see `pooled_tf1`)
+_tf1_pool: dict[str, TF1] = {}
+_tf1_pool_lock = threading.Lock()
+_tf1_names = count()
+
+def pooled_tf1(fit_str: str, x_min: float, x_max: float, fit_name: str | None = None) -> TF1:
+    """
+    A fresh TF1 of a formula, copied from a prototype compiled once per process.
+
+    Building a TF1 from a string makes cling parse the formula and, for a new formula, JIT-compile
+    it (about 15 ms with ROOT 6.40, which reuses the compiled function for later TF1s of the same
+    string but still parses each one). The first TF1 of each formula string is kept as a prototype
+    that is never fitted or drawn, and every call returns a copy of it, which shares the compiled
+    function and skips the parsing. A copy starts with zero parameters and errors, no limits and
+    the range [x_min, x_max].
+
+    Args:
+        fit_str (str): The formula string in ROOT format.
+        x_min (float): Lower end of the range.
+        x_max (float): Upper end of the range.
+        fit_name (str, optional): Name of the TF1. Defaults to a unique 'tf1_<n>'; copies are not
+            registered in ROOT's list of functions, so names do not clash.
+
+    Returns:
+        TF1: The new function.
+    """
+    with _tf1_pool_lock:
+        prototype = _tf1_pool.get(fit_str)
+        if prototype is None:
+            prototype = ROOT.TF1(f'tf1_prototype_{len(_tf1_pool)}', fit_str, x_min, x_max)
+            prototype.Eval(x_min)  # Compiled now, so no copy has to
+            _tf1_pool[fit_str] = prototype
+            pf.count('tf1_compiled')
+        else:
+            pf.count('tf1_reused')
+    fit_func: TF1 = ROOT.TF1(prototype)
+    # The copy is not in ROOT's list of functions, but inherits the prototype's flag saying it is
+    fit_func.SetBit(ROOT.TF1.kNotGlobal)
+    fit_func.SetName(fit_name or f'tf1_{next(_tf1_names)}')
+    fit_func.SetRange(x_min, x_max)
+    return fit_func
+
+def clear_tf1_pool() -> None:
+    """Drops the compiled prototypes, e.g. after a session that used many one-off formulas."""
+    with _tf1_pool_lock:
+        _tf1_pool.clear()
+
+def create_tf1(fit_str, fit_name: str | None, x_min: float, x_max: float, params: dict[int | str, float], colour=2):
+    fit_func: TF1 = pooled_tf1(fit_str, x_min, x_max, fit_name)
     for i, param_val in params.items():
             if f'[{i}]' not in fit_str:
                 raise ValueError(f"Parameter [{i}] not found in fit string: {fit_str}")
@@ -34,22 +115,26 @@ def create_tf1(fit_str, fit_name: str, x_min: float, x_max: float, params: dict[
     fit_func.SetLineColor(colour)
     return fit_func
 
-def fit_custom(graph: TGraphErrors, fit_str: str, fit_name: str,
+def fit_custom(graph: TGraphErrors, fit_str: str, fit_name: str | None,
                x_min: float = 0, x_max: float = 10, colour=2,
-               par_limits: dict[int | str, tuple[float, float]] | None = None) -> TF1:
+               par_limits: dict[int | str, tuple[float, float]] | None = None,
+               fit_options: str = '', initial: dict[int | str, float] | None = None) -> TF1:
     """
     Fits a TGraphErrors object using a custom function defined by a fit string.
 
     Parameters:
         graph (TGraphErrors): The graph to be fitted.
         fit_str (str): The fitting function string in ROOT format (e.g., "[0]*x + [1]").
-        fit_name (str): Name assigned to the TF1 fitting object.
+        fit_name (str | None): Name assigned to the TF1 fitting object (None: a unique name, see `pooled_tf1`).
         x_min (float, optional): Minimum x-range for the fit. Defaults to 0.
         x_max (float, optional): Maximum x-range for the fit. Defaults to 10.
         colour (int, optional): Line colour for the fit function. Defaults to red.
         par_limits (dict[int, tuple[float, float]], optional): 
             Optional dictionary of parameter limits in the form 
             {param_index: (min, max)}.
+        fit_options (str, optional): Options passed to `TGraph::Fit`, e.g. 'Q'.
+        initial (dict[int, float], optional): Start values {param_index: value} of Minuit,
+            e.g. from `ft.seed_fit`.
 
     Returns:
         TF1: The fitted TF1 object.
@@ -57,7 +142,10 @@ def fit_custom(graph: TGraphErrors, fit_str: str, fit_name: str,
     Raises:
         ValueError: If a parameter index in `par_limits` is not found in `fit_str`.
     """
-    fit_func: TF1 = ROOT.TF1(fit_name, fit_str, x_min, x_max)
+    fit_func: TF1 = pooled_tf1(fit_str, x_min, x_max, fit_name)
+
+    for i, value in (initial or {}).items():
+        fit_func.SetParameter(int(i), value)
 
     if par_limits:
         for i, (par_min, par_max) in par_limits.items():
@@ -70,29 +158,30 @@ def fit_custom(graph: TGraphErrors, fit_str: str, fit_name: str,
                     raise ValueError(f"Cannot convert string '{i}' to integer.")
             fit_func.SetParLimits(i, par_min, par_max)
 
-    graph.Fit(fit_name)
+    # 'S' returns the fit result, whose call count and status feed the profiling counters
+    # The function is passed itself, as pooled copies are not looked up by name
+    fit_result = graph.Fit(fit_func, fit_options + 'S')
+    pf.record_fit('minuit', fit_result.NCalls() if fit_result.Get() else 0, converged=int(fit_result) == 0)
     fit_func.SetLineColor(colour)
     fit_func.SetNpx(2000)
     return fit_func
 
 def fit_linear(graph, name: str, colour=0):
     # Fit the function to the main graph
-    funct = ROOT.TF1(name, "[0] * x + [1]", 15, 135)
+    funct = pooled_tf1("[0] * x + [1]", 15, 135, name)
     #funct.SetParLimits(0, 160., 180.)
     #funct.SetParLimits(1, -5., 5.)
     if colour: funct.SetLineColor(colour)
-    graph.Fit(name)
+    graph.Fit(funct)
     return funct
 
-def generate_residuals(fitline, x_data, y_data, delta_x, delta_y):
+def generate_residuals(fitline, x_data, y_data, delta_x, delta_y, fit_str: str | None = None):
     label_size = 0.035
     res_pad_height = 0.35
 
-    residuals_graph = ROOT.TGraphErrors(len(x_data))
-    for i, (x, y, dx, dy) in enumerate(zip(x_data, y_data, delta_x, delta_y)):
-        residual = y - fitline.Eval(x)
-        residuals_graph.SetPoint(i, x, residual)
-        residuals_graph.SetPointError(i, dx, dy)
+    x, y, dx, dy = as_buffers(x_data, y_data, delta_x, delta_y)
+    residuals = np.ascontiguousarray(y - evaluate_fit(fitline, x, fit_str))
+    residuals_graph = ROOT.TGraphErrors(len(x), x, residuals, dx, dy)
 
     residuals_graph.GetXaxis().SetTitleSize(label_size / res_pad_height)
 
@@ -103,7 +192,7 @@ def generate_residuals(fitline, x_data, y_data, delta_x, delta_y):
     residuals_graph.SetTitle('')
 
     # Draw a horizontal line at y=0 in blue
-    line = ROOT.TLine(min(x_data), 0, max(x_data), 0)
+    line = ROOT.TLine(x.min(), 0, x.max(), 0)
     line.SetLineColor(4)  # Blue colour
 
     return residuals_graph, line
@@ -133,36 +222,60 @@ def create_residuals_canvas(logy: bool = False):
 
     return canvas, main_pad, residuals_pad
 
-def draw_canvas(data: tuple, titles: dict[str, str], fit_str, x_range, par_limits, file_name=None, file_type: str = '.png'):
-    title, x_title, y_title = titles['title'], titles['x_title'], titles['y_title']
-    canvas, main_pad, res_pad = create_residuals_canvas()
+def fit_graph(data: tuple, fit_str: str, x_range, par_limits, gradient: bool = False,
+              cache: ft.FitCache | None = None, initial: dict[int | str, float] | None = None) -> dict:
+    """
+    Fits the data points without drawing anything; the fitting half of `draw_canvas`.
+
+    Args:
+        data (tuple): (x, y, delta_x, delta_y).
+        fit_str (str): The fitting function string in ROOT format.
+        x_range (tuple[float, float]): Range of the fit function.
+        par_limits (dict): All {param_index: (min, max)} to fit, or all {param_index: value}
+            to only evaluate the function with these values.
+        gradient (bool, optional): Fit with option 'G', i.e. with `TF1::GradientPar`, which is only
+            exact when ROOT generated the formula's gradient with clad and takes finite differences
+            otherwise. Defaults to False; the closed-form gradients of model_tools are used by the
+            SciPy backends (`ft.fit_formula`, `ft.fit_batch`).
+        cache (FitCache, optional): Reuses the result of an identical earlier fit. The returned
+            TF1 then carries the stored parameters, errors, chi2 and NDF instead of being refitted.
+        initial (dict, optional): Start values {param_index: value} of the fit, e.g. from `ft.seed_fit`.
 
-    main_pad.cd()
+    Returns:
+        dict: 'graph', 'fit', 'fitted_params' and 'statistics'.
+    """
     graph = generate_data_points(*data)
-    
+
     if all(isinstance(v, (tuple, list)) and len(v) == 2 for v in par_limits.values()):
         # Case: all values are tuples of length 2 → (min, max)
-        fit_function = fit_custom(graph, fit_str, fit_str,
-                                x_min=x_range[0], x_max=x_range[1], par_limits=par_limits)
+        key = ft.fit_key('root', data, fit_str, x_range, par_limits, gradient, initial) if cache is not None else None
+        cached = cache.get(key) if key is not None else None
+        if cached is not None:
+            pf.count('fit_cache_hits')
+            fit_function = create_tf1(fit_str, None, x_range[0], x_range[1], dict(enumerate(cached['values'])))
+            for i, err in enumerate(cached['errors']):
+                fit_function.SetParError(i, err)
+            fit_function.SetChisquare(cached['chi2'])
+            fit_function.SetNDF(cached['ndf'])
+        else:
+            fit_function = fit_custom(graph, fit_str, None,
+                                    x_min=x_range[0], x_max=x_range[1], par_limits=par_limits,
+                                    fit_options='G' if gradient else '', initial=initial)
+            if key is not None:
+                cache.put(key, {
+                    'values': [fit_function.GetParameter(i) for i in range(fit_function.GetNpar())],
+                    'errors': [fit_function.GetParError(i) for i in range(fit_function.GetNpar())],
+                    'chi2': fit_function.GetChisquare(),
+                    'ndf': fit_function.GetNDF()
+                })
         
     elif all(isinstance(v, (int, float)) for v in par_limits.values()):
         # Case: all values are single values
-        fit_function = create_tf1(fit_str, fit_str, x_range[0], x_range[1], par_limits)
+        fit_function = create_tf1(fit_str, None, x_range[0], x_range[1], par_limits)
     
     else:
         raise ValueError("par_limits must be either all (min, max) tuples or all single values")
 
-    graph.Draw('AP')
-    fit_function.Draw('same')
-    graph.GetYaxis().SetTitle(y_title)
-    graph.SetTitle(title)
-
-    res_pad.cd()
-    res, line = generate_residuals(fit_function, *data)
-    res.Draw('AP')
-    line.Draw('same')
-    res.GetXaxis().SetTitle(x_title)
-
     try:
         chi2_red: float = sig_digits_round(fit_function.GetChisquare() / fit_function.GetNDF(), n=3)
     except ZeroDivisionError:
@@ -181,6 +294,36 @@ def draw_canvas(data: tuple, titles: dict[str, str], fit_str, x_range, par_limit
     print(f"Chi2_Red = {chi2_red}")
     print(f"P_value = {p_value}")
 
+    return {
+        'graph': graph,
+        'fit': fit_function,
+        'fitted_params': fitted_params,
+        'statistics': {
+            'chi2_red': chi2_red,
+            'p_value':  p_value
+        }
+    }
+
+def draw_canvas(data: tuple, titles: dict[str, str], fit_str, x_range, par_limits, file_name=None, file_type: str = '.png',
+                gradient: bool = False):
+    title, x_title, y_title = titles['title'], titles['x_title'], titles['y_title']
+    canvas, main_pad, res_pad = create_residuals_canvas()
+
+    main_pad.cd()
+    fitted = fit_graph(data, fit_str, x_range, par_limits, gradient=gradient)
+    graph, fit_function = fitted['graph'], fitted['fit']
+
+    graph.Draw('AP')
+    fit_function.Draw('same')
+    graph.GetYaxis().SetTitle(y_title)
+    graph.SetTitle(title)
+
+    res_pad.cd()
+    res, line = generate_residuals(fit_function, *data, fit_str=fit_str)
+    res.Draw('AP')
+    line.Draw('same')
+    res.GetXaxis().SetTitle(x_title)
+
     canvas.Update()
     if file_name:
         save_canvas(canvas, file_name, recreate=True, filetype=file_type)
@@ -191,25 +334,17 @@ def draw_canvas(data: tuple, titles: dict[str, str], fit_str, x_range, par_limit
         'fit': fit_function,
         'residuals': res,
         'res_line': line,
-        'fitted_params': fitted_params,
-        'statistics': {
-            'chi2_red': chi2_red,
-            'p_value':  p_value
-        }
+        'fitted_params': fitted['fitted_params'],
+        'statistics': fitted['statistics']
     }
 
-def sig_digits_round(a: float, n: int = 2) -> float | int:
-    if a == 0:
-        return 0
-    rounded_num = round(a, -int(floor(log10(abs(a)))) + (n - 1))
-    return int(rounded_num) if int(rounded_num) == rounded_num else rounded_num
-
-def round_respect_to_error(a: float, err: float, n: int = 2) -> float | int:
-    rounded_err = sig_digits_round(err, n)
-    err_str = str(rounded_err)
-    m = len(err_str)
-    if '.' in err_str: m -= 1
-    return sig_digits_round(a, m)
+def render_canvas(data: tuple, titles: dict[str, str], fit_str: str, x_range, params: dict, file_name: str, file_type: str = '.png') -> None:
+    """
+    Draws and saves the canvas of an existing fit, given its parameter values.
+
+    Returns nothing, so it can be queued on an `export_tools.ExportQueue` running in a worker process.
+    """
+    draw_canvas(data, titles, fit_str, x_range, params, file_name=file_name, file_type=file_type)
 
 def ufloat_to_str(measured: ufloat, n: int = 2) -> str:
     std:  float | int = sig_digits_round(measured.s, n)
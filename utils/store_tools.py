@@ -0,0 +1,231 @@
+import os
+import json
+import shutil
+import numpy as np
+
+from utils import profile_tools as pf
+from utils.uncertainty_tools import Uncertainty, is_uncertainty_json
+
+# Keys whose values are whole traces and are therefore stored as typed arrays
+TRACE_KEYS: tuple[str, ...] = ('time', 'volt', 'delta_time', 'delta_v', 'x_peak', 'y_peak', 'delta_t')
+META_FILE: str = 'meta.json'
+
+
+def _json_default(obj):
+    # NumPy scalars (e.g. cells read by pandas) are not JSON serialisable
+    if isinstance(obj, np.generic):
+        return obj.item()
+    if isinstance(obj, np.ndarray):
+        return obj.tolist()
+    if isinstance(obj, Uncertainty):
+        return obj.to_json()
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+def _read_meta(store_dir: str) -> dict:
+    meta_path = os.path.join(store_dir, META_FILE)
+    if not os.path.exists(meta_path):
+        return {}
+    with open(meta_path, 'r') as f:
+        return json.load(f)
+
+def _write_meta(store_dir: str, meta: dict) -> None:
+    # Write to a temporary file first so an interrupted run never leaves a broken sidecar
+    meta_path = os.path.join(store_dir, META_FILE)
+    with open(meta_path + '.tmp', 'w') as f:
+        json.dump(meta, f, indent=4, default=_json_default)
+    os.replace(meta_path + '.tmp', meta_path)
+
+def _array_path(store_dir: str, material: str, key: str) -> str:
+    # Nested keys such as 'root_data/time' become 'root_data.time.npy'
+    return os.path.join(store_dir, material, key.replace('/', '.') + '.npy')
+
+def _split_fields(fields: dict, array_keys: tuple[str, ...], prefix: str = '') -> tuple[dict, dict]:
+    """Separates trace arrays (flattened to 'parent/key' names) from the small metadata fields."""
+    arrays, meta = {}, {}
+    for key, value in fields.items():
+        if isinstance(value, dict):
+            sub_arrays, sub_meta = _split_fields(value, array_keys, prefix=f'{prefix}{key}/')
+            arrays.update(sub_arrays)
+            if sub_meta or not sub_arrays:
+                meta[key] = sub_meta
+        elif isinstance(value, Uncertainty) and value.kind != 'array':
+            # A constant or per-segment error is a few numbers in the sidecar instead of a trace
+            meta[key] = value.to_json()
+        elif key in array_keys and isinstance(value, (list, np.ndarray, Uncertainty)):
+            arrays[prefix + key] = np.asarray(value, dtype=np.float64)
+        else:
+            meta[key] = value
+    return arrays, meta
+
+def _set_nested(target: dict, key: str, value) -> None:
+    *parents, leaf = key.split('/')
+    for parent in parents:
+        target = target.setdefault(parent, {})
+    target[leaf] = value
+
+def _uncertainty_keys(meta: dict, prefix: str = ''):
+    """Names ('parent/key') of the compact uncertainties in the metadata fields."""
+    for key, value in meta.items():
+        if is_uncertainty_json(value):
+            yield prefix + key
+        elif isinstance(value, dict):
+            yield from _uncertainty_keys(value, prefix=f'{prefix}{key}/')
+
+def _revive(fields: dict) -> None:
+    # Compact uncertainties are read back as Uncertainty objects
+    for key, value in fields.items():
+        if is_uncertainty_json(value):
+            fields[key] = Uncertainty.from_json(value)
+        elif isinstance(value, dict):
+            _revive(value)
+
+def _pop_nested(target: dict, key: str) -> None:
+    *parents, leaf = key.split('/')
+    for parent in parents:
+        target = target.get(parent)
+        if not isinstance(target, dict):
+            return
+    target.pop(leaf, None)
+
+def _merge(target: dict, update: dict) -> None:
+    for key, value in update.items():
+        if isinstance(value, dict) and isinstance(target.get(key), dict) and not is_uncertainty_json(value):
+            _merge(target[key], value)
+        else:
+            target[key] = value
+
+def save_database(database: dict[str, dict], store_dir: str, array_keys: tuple[str, ...] = TRACE_KEYS) -> None:
+    """
+    Writes a {material: fields} database as one .npy file per trace plus a JSON sidecar.
+
+    Args:
+        database (dict[str, dict]): Database in the same layout as the JSON databases.
+        store_dir (str): Directory of the store. Existing materials are replaced: their
+            directories are emptied, so no trace of a field they no longer have is left behind.
+        array_keys (tuple[str, ...], optional): Field names stored as float64 arrays.
+            Nested dictionaries (e.g. 'root_data') are searched for these keys too.
+    """
+    os.makedirs(store_dir, exist_ok=True)
+    meta = _read_meta(store_dir)
+    # Replaced materials leave the sidecar before their traces are deleted, so an interrupted
+    # run never leaves an entry pointing to missing arrays
+    replaced = [material for material in database if material in meta]
+    for material in replaced:
+        del meta[material]
+    if replaced:
+        _write_meta(store_dir, meta)
+
+    for material, fields in database.items():
+        with pf.span(material, 'write', material=material):
+            shutil.rmtree(os.path.join(store_dir, material), ignore_errors=True)
+            meta[material] = _write_fields(store_dir, material, {'fields': {}, 'arrays': []}, fields, array_keys)
+    # The sidecar is written once for the whole database
+    _write_meta(store_dir, meta)
+
+
+def update_material(store_dir: str, material: str, fields: dict, array_keys: tuple[str, ...] = TRACE_KEYS) -> None:
+    """
+    Adds or replaces fields of a single material.
+
+    Only the arrays present in `fields` are written; all other traces of the
+    store are left untouched, and the sidecar is the only file rewritten.
+    To update several materials, use `update_materials`.
+
+    Args:
+        store_dir (str): Directory of the store.
+        material (str): Material (sheet) name.
+        fields (dict): Fields to add or replace, e.g. {'params': ..., 'statistics': ...}.
+        array_keys (tuple[str, ...], optional): Field names stored as float64 arrays.
+    """
+    update_materials(store_dir, {material: fields}, array_keys)
+
+def update_materials(store_dir: str, updates: dict[str, dict], array_keys: tuple[str, ...] = TRACE_KEYS) -> None:
+    """
+    Adds or replaces fields of several materials, reading and writing the sidecar once.
+
+    Args:
+        store_dir (str): Directory of the store.
+        updates (dict[str, dict]): {material: fields to add or replace}; see `update_material`.
+        array_keys (tuple[str, ...], optional): Field names stored as float64 arrays.
+    """
+    if not updates:
+        return
+    meta = _read_meta(store_dir)
+    for material, fields in updates.items():
+        with pf.span(material, 'write', material=material):
+            entry = meta.setdefault(material, {'fields': {}, 'arrays': []})
+            _write_fields(store_dir, material, entry, fields, array_keys)
+    _write_meta(store_dir, meta)
+
+def _write_fields(store_dir: str, material: str, entry: dict, fields: dict, array_keys: tuple[str, ...]) -> dict:
+    """Writes the traces of `fields` and merges the rest into the sidecar entry of the material; returns the entry."""
+    arrays, new_meta = _split_fields(fields, array_keys)
+    if arrays:
+        os.makedirs(os.path.join(store_dir, material), exist_ok=True)
+    for key, array in arrays.items():
+        np.save(_array_path(store_dir, material, key), array)
+        if key not in entry['arrays']:
+            entry['arrays'].append(key)
+        _pop_nested(entry['fields'], key)  # E.g. a compact uncertainty the array replaces
+    # A trace now held as a compact uncertainty in the sidecar replaces its old array
+    for key in _uncertainty_keys(new_meta):
+        if key in entry['arrays']:
+            entry['arrays'].remove(key)
+            os.remove(_array_path(store_dir, material, key))
+
+    _merge(entry['fields'], new_meta)
+    return entry
+
+def load_material(store_dir: str, material: str, keys: tuple[str, ...] | None = None, mmap: bool = True) -> dict:
+    """
+    Loads a single material, memory-mapping its traces so they are only read on access.
+
+    Args:
+        store_dir (str): Directory of the store.
+        material (str): Material (sheet) name.
+        keys (tuple[str, ...], optional): Array names to load (e.g. ('time', 'volt')).
+            Defaults to all arrays of the material.
+        mmap (bool, optional): Memory-map the arrays read-only instead of reading them. Defaults to True.
+
+    Returns:
+        dict: The material's fields with the traces as NumPy arrays.
+    """
+    with pf.span(material, 'read', material=material):
+        entry = _read_meta(store_dir)[material]
+        return _assemble(store_dir, material, entry, keys, mmap)
+
+def load_database(store_dir: str, mmap: bool = True) -> dict[str, dict]:
+    """Loads every material of the store; see `load_material`."""
+    meta = _read_meta(store_dir)
+    database = {}
+    for material, entry in meta.items():
+        with pf.span(material, 'read', material=material):
+            database[material] = _assemble(store_dir, material, entry, None, mmap)
+    return database
+
+def remove_materials(store_dir: str, materials: list[str]) -> None:
+    """Deletes materials from the store, with their traces."""
+    meta = _read_meta(store_dir)
+    for material in materials:
+        meta.pop(material, None)
+        shutil.rmtree(os.path.join(store_dir, material), ignore_errors=True)
+    if materials:
+        _write_meta(store_dir, meta)
+
+def load_meta(store_dir: str) -> dict[str, dict]:
+    """Loads only the metadata and results of every material, without touching the traces."""
+    return {material: entry['fields'] for material, entry in _read_meta(store_dir).items()}
+
+def _assemble(store_dir: str, material: str, entry: dict, keys: tuple[str, ...] | None, mmap: bool) -> dict:
+    data = json.loads(json.dumps(entry['fields']))  # Deep copy, the sidecar stays untouched
+    _revive(data)
+    mmap_mode = 'r' if mmap else None
+    for key in entry['arrays']:
+        if keys is not None and key not in keys:
+            continue
+        _set_nested(data, key, np.load(_array_path(store_dir, material, key), mmap_mode=mmap_mode))
+    return data
+
+
+if __name__ == '__main__':
+    pass
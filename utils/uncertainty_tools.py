@@ -0,0 +1,126 @@
+from __future__ import annotations
+
+import numpy as np
+
+
+class Uncertainty:
+    """
+    Per-point uncertainties of a trace, stored compactly.
+
+    Most traces carry one error for every point (the resolution of the scope), or one
+    error per segment of consecutive points, yet were stored as lists as long as the
+    trace. An `Uncertainty` keeps a single value, one value per segment, or (when the
+    errors really differ point by point) the full array, and behaves like a read-only
+    float64 array of its length: `np.asarray`, ROOT buffers and SciPy's `sigma` get the
+    per-point values through `__array__`. A constant is handed out as a broadcast view,
+    so it takes no memory until a copy is actually made.
+    """
+    __slots__ = ('values', 'starts', 'n')
+
+    def __init__(self, values, n: int | None = None, starts=None):
+        """
+        Args:
+            values (float | array_like): The error of every segment, or of every point when
+                `starts` is None and `n` is not given.
+            n (int | None, optional): Number of points. Required for a constant or segments.
+            starts (array_like | None, optional): Index of the first point of each segment
+                (the first is 0), one per value.
+        """
+        values = np.atleast_1d(np.asarray(values, dtype=np.float64))
+        if starts is None and n is None:
+            starts = None if len(values) != 1 else np.zeros(1, dtype=np.int64)
+            n = len(values) if starts is None else 1
+        elif starts is None:
+            if len(values) != 1:
+                raise ValueError("Give the segment starts of several values, or omit n for one value per point")
+            starts = np.zeros(1, dtype=np.int64)
+        else:
+            starts = np.asarray(starts, dtype=np.int64)
+            if len(starts) != len(values) or (len(starts) and starts[0] != 0) or np.any(np.diff(starts) <= 0):
+                raise ValueError("Segment starts must begin at 0, increase, and match the values one to one")
+        self.values, self.starts, self.n = values, starts, int(n)
+
+    @classmethod
+    def constant(cls, value: float, n: int) -> Uncertainty:
+        """The same error for all `n` points."""
+        return cls(value, n=n)
+
+    @classmethod
+    def compress(cls, errors) -> Uncertainty:
+        """
+        The most compact representation of per-point errors: consecutive equal values become one
+        segment, and the full array is kept when segments would not save memory.
+        """
+        if isinstance(errors, Uncertainty):
+            errors = np.asarray(errors)
+        errors = np.asarray(errors, dtype=np.float64).ravel()
+        if len(errors) == 0:
+            return cls(errors)
+        starts = np.flatnonzero(np.r_[True, errors[1:] != errors[:-1]])
+        if 2 * len(starts) >= len(errors):
+            return cls(errors)
+        return cls(errors[starts], n=len(errors), starts=starts)
+
+    @property
+    def kind(self) -> str:
+        """'constant', 'segments' or 'array'."""
+        if self.starts is None:
+            return 'array'
+        return 'constant' if len(self.values) == 1 else 'segments'
+
+    def __len__(self) -> int:
+        return self.n
+
+    def __array__(self, dtype=None, copy=None) -> np.ndarray:
+        if self.kind == 'constant':
+            array = np.broadcast_to(self.values[0], (self.n,))
+        elif self.kind == 'segments':
+            array = np.repeat(self.values, np.diff(np.r_[self.starts, self.n]))
+        else:
+            array = self.values
+        if copy or (dtype is not None and np.dtype(dtype) != array.dtype):
+            array = np.array(array, dtype=dtype, copy=True)
+        return array
+
+    def __getitem__(self, key):
+        return np.asarray(self)[key]
+
+    def __iter__(self):
+        return iter(np.asarray(self))
+
+    def __eq__(self, other) -> bool:
+        if not isinstance(other, Uncertainty):
+            return NotImplemented
+        return self.n == other.n and np.array_equal(np.asarray(self), np.asarray(other))
+
+    def __repr__(self) -> str:
+        if self.kind == 'constant':
+            return f"Uncertainty.constant({float(self.values[0])!r}, n={self.n})"
+        return f"Uncertainty({self.kind}, {len(self.values)} values, n={self.n})"
+
+    def tolist(self) -> list[float]:
+        return np.asarray(self).tolist()
+
+    def to_json(self) -> dict:
+        """Compact JSON form; a constant or segments take a few numbers whatever the trace length."""
+        if self.kind == 'constant':
+            return {'uncertainty': 'constant', 'value': float(self.values[0]), 'n': self.n}
+        if self.kind == 'segments':
+            return {'uncertainty': 'segments', 'values': self.values.tolist(), 'starts': self.starts.tolist(), 'n': self.n}
+        return {'uncertainty': 'array', 'values': self.values.tolist()}
+
+    @classmethod
+    def from_json(cls, data: dict) -> Uncertainty:
+        if data['uncertainty'] == 'constant':
+            return cls.constant(data['value'], data['n'])
+        if data['uncertainty'] == 'segments':
+            return cls(data['values'], n=data['n'], starts=data['starts'])
+        return cls(data['values'])
+
+def is_uncertainty_json(value) -> bool:
+    """Whether a JSON value is the compact form of an `Uncertainty` (see `Uncertainty.to_json`)."""
+    return isinstance(value, dict) and 'uncertainty' in value
+
+
+if __name__ == '__main__':
+    pass